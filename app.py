@@ -1,35 +1,88 @@
 import argparse
 import logging
 import os
+import shlex
+import sys
+import zlib
 from argparse import Namespace
 from datetime import datetime
 from pathlib import Path
-from time import sleep
-from typing import Tuple, List
+from time import sleep, monotonic, time
+from typing import Dict, Tuple, List, Optional, Set
 
 import sentry_sdk
 
+import process_tools
 from chapter_worker import ChapterWorker
+from conversion_cache import ConversionCache
+from file_utils import destination_view
+from ftp_catalog import FtpCatalog
+from journal import JobJournal
+from leases import LeaseManager, Lease
+from metrics import get_metrics
+from planner import build_plan, write_plan
+from process_runner import ProcessRunner
+from scheduler import Job, JobScheduler, link_jobs
+from scratch import ScratchManager
+from state_store import StateStore
+from tool_daemon import ToolDaemonPool
 from tr_worker import TrWorker
 from verse_worker import VerseWorker
+from watcher import create_watcher, Debouncer
 
 
 class App:
 
-    def __init__(self, input_dir: Path, verbose=False, hour=0, minute=0):
+    def __init__(self, input_dir: Path, verbose=False, hour=0, minute=0, state: StateStore = None, jobs=1,
+                 watch=False):
         self.__ftp_dir = input_dir
+        self.__state = state
         self.verbose = verbose
         self.hour = hour
         self.minute = minute
+        self.jobs = jobs
+        self.watch = watch
 
         self.sleep_timer = 60
+        self.job_timeout = None
+
+        # Scratch space of the jobs: directory (e.g. a tmpfs) and budget in bytes
+        self.scratch_root: Optional[Path] = None
+        self.scratch_budget: Optional[int] = None
+
+        # Fair share of the jobs between languages: weight and max number of concurrent jobs per language
+        self.language_weights: Dict[str, float] = {}
+        self.language_limits: Dict[str, int] = {}
+
+        # Metrics of the last run: Prometheus textfile and JSON
+        self.metrics_file: Optional[Path] = None
+        self.metrics_json: Optional[Path] = None
+
+        # Work sharing with the other nodes on the same FTP mount
+        self.leases: Optional[LeaseManager] = None
+        self.lease_batch = max(1, jobs)
+        self.lease_retry_interval = 30.0
+        self.__running_jobs: List[Job] = []
+
+        # Watch mode
+        self.watch_mode = 'auto'
+        self.debounce_delay = 30.0
+        self.poll_interval = 300.0
+        self.reconcile_interval = 24 * 60 * 60
+
+        # Jobs done before a crash are not run again
+        self.__journal = JobJournal(state, self.__ftp_dir) if state is not None else None
+
+        self.__chapter_worker = ChapterWorker(self.__ftp_dir, self.verbose, self.__state, self.jobs)
+        self.__verse_worker = VerseWorker(self.__ftp_dir, self.verbose, self.jobs)
+        self.__tr_worker = TrWorker(self.__ftp_dir, self.verbose, self.jobs)
 
     def start(self):
         """ Start app """
 
-        chapter_worker = ChapterWorker(self.__ftp_dir, self.verbose)
-        verse_worker = VerseWorker(self.__ftp_dir, self.verbose)
-        tr_worker = TrWorker(self.__ftp_dir, self.verbose)
+        if self.watch:
+            self.start_watching()
+            return
 
         while True:
             now = datetime.now()
@@ -37,22 +90,235 @@ class App:
             seconds_since_target_time = (now - target_time).total_seconds()
 
             if 0 <= seconds_since_target_time < self.sleep_timer:
-                chapter_worker.execute()
-                verse_worker.execute()
-                tr_worker.execute()
-
-                report = self.get_report(
-                    (
-                        chapter_worker.get_report(),
-                        verse_worker.get_report(),
-                        tr_worker.get_report()
-                    )
-                )
-                if report is not None:
-                    logging.error("Fetcher pipeline worker", extra=report)
+                # Walk the FTP tree once and share the index with all the workers
+                self.process(FtpCatalog.scan(self.__ftp_dir))
 
             sleep(self.sleep_timer)
 
+    def start_watching(self):
+        """ Process books as soon as their uploads finish, with a periodic full reconciliation """
+
+        watcher = create_watcher(self.__ftp_dir, self.watch_mode, self.poll_interval)
+        debouncer = Debouncer(self.debounce_delay)
+        last_reconcile = None
+
+        # Files written by the workers themselves should not queue their books again
+        own_files = {}
+
+        try:
+            while True:
+                if (last_reconcile is None or watcher.overflowed or
+                        monotonic() - last_reconcile >= self.reconcile_interval):
+                    logging.debug('Running full reconciliation')
+                    watcher.overflowed = False
+                    last_reconcile = monotonic()
+                    own_files = self.get_created_files(self.process(FtpCatalog.scan(self.__ftp_dir)))
+
+                for path in watcher.read(timeout=1.0):
+                    if self.get_book_scope(path) is None:
+                        continue
+                    if path in own_files and own_files[path] == self.get_file_state(path):
+                        continue
+                    debouncer.add(path)
+
+                scopes = {self.get_book_scope(p) for p in debouncer.pop_settled()}
+                scopes.discard(None)
+
+                if scopes:
+                    logging.debug(f'Processing changed books: {sorted(scopes)}')
+                    own_files = self.get_created_files(self.process(FtpCatalog.scan(self.__ftp_dir, scopes)))
+        finally:
+            watcher.close()
+
+    def process(self, catalog: FtpCatalog) -> Optional[dict]:
+        """ Process the catalog, sharing the books with the other nodes if leases are enabled """
+
+        if self.leases is None:
+            return self.run_workers(catalog)
+
+        return self.run_sharded(catalog)
+
+    def run_sharded(self, catalog: FtpCatalog) -> Optional[dict]:
+        """ Claim books with pending work in batches and process them. Books claimed by other nodes
+        are retried until those nodes release them or their leases expire """
+
+        pending = self.find_pending_books(catalog)
+
+        # Nodes start at different books, so they don't compete for the same lease files
+        books = sorted(pending)
+        if books:
+            offset = zlib.crc32(self.leases.node_id.encode('utf-8')) % len(books)
+            books = books[offset:] + books[:offset]
+
+        reports = []
+        while books:
+            leases = self.leases.acquire_many(books, self.lease_batch)
+            if len(leases) == 0:
+                logging.debug(f'{len(books)} books are claimed by other nodes, waiting...')
+                sleep(self.lease_retry_interval)
+                continue
+
+            scopes = [lease.scope for lease in leases]
+            books = [b for b in books if b not in scopes]
+
+            try:
+                # Other nodes may have processed the books since the catalog was scanned
+                reports.append(self.run_workers(FtpCatalog.scan(self.__ftp_dir, scopes)))
+            finally:
+                for lease in leases:
+                    self.leases.release(lease)
+
+        return self.get_report([r for r in reports if r is not None])
+
+    def find_pending_books(self, catalog: FtpCatalog) -> Set[Tuple[str, str, str]]:
+        """ Find (lang, resource, book) of the books with work: chapters or verses to convert, or TR files
+        to create. Books whose outputs are complete are not claimed """
+
+        chapter_jobs, verse_jobs, tr_jobs = self.plan_jobs(catalog)
+
+        return {tuple(job.scope[:3]) for job in chapter_jobs + verse_jobs + tr_jobs if job.scope is not None}
+
+    def cancel_book(self, lease: Lease):
+        """ Stop the jobs of a book that has been taken over by another node """
+
+        for job in list(self.__running_jobs):
+            if job.scope is not None and tuple(job.scope[:3]) == lease.scope:
+                job.cancel()
+
+    def plan_jobs(self, catalog: FtpCatalog, describe=False) -> Tuple[List[Job], List[Job], List[Job]]:
+        """ Plan chapter, verse and TR jobs of the catalog and link them """
+
+        chapter_jobs = self.__chapter_worker.plan_jobs(catalog, describe)
+        verse_jobs = self.__verse_worker.plan_jobs(catalog, describe)
+        tr_jobs = self.__tr_worker.plan_jobs(catalog, describe, chapter_jobs + verse_jobs)
+
+        # Verses of a chapter are converted after the chapter has been split,
+        # TR files are created after the verses of the chapter or the book are ready
+        link_jobs(verse_jobs, chapter_jobs)
+        link_jobs(tr_jobs, chapter_jobs + verse_jobs)
+
+        return chapter_jobs, verse_jobs, tr_jobs
+
+    def plan(self, catalog: FtpCatalog) -> dict:
+        """ Describe the jobs a run would start, without running them """
+
+        with destination_view():
+            chapter_jobs, verse_jobs, tr_jobs = self.plan_jobs(catalog, describe=True)
+
+        return build_plan(chapter_jobs + verse_jobs + tr_jobs, self.__ftp_dir, self.jobs,
+                          self.language_weights, self.language_limits)
+
+    def run_workers(self, catalog: FtpCatalog) -> Optional[dict]:
+        """ Run all the workers on the catalog as one pipeline and report the changes.
+        TR files of a book are created as soon as its chapters and verses have been processed """
+
+        started = monotonic()
+        jobs = []
+        interrupted = True
+
+        with ScratchManager(self.scratch_root, self.scratch_budget) as scratch:
+            try:
+                # Remote directories are listed once per run
+                with destination_view():
+                    chapter_jobs, verse_jobs, tr_jobs = self.plan_jobs(catalog)
+                    jobs = chapter_jobs + verse_jobs + tr_jobs
+
+                    # Jobs done before a crash are reported with this run
+                    resumed = None
+                    if self.__journal is not None:
+                        self.__running_jobs, resumed = self.__journal.resume(jobs)
+                    else:
+                        self.__running_jobs = jobs
+
+                    scheduler = JobScheduler(scratch, self.jobs, self.job_timeout, self.__journal,
+                                             self.language_weights, self.language_limits)
+                    scheduler.run(self.__running_jobs)
+                interrupted = False
+            finally:
+                self.__running_jobs = []
+                if self.__journal is not None:
+                    self.__journal.close(jobs, interrupted)
+
+        self.__chapter_worker.finish(chapter_jobs)
+        self.__verse_worker.finish(verse_jobs)
+        self.__tr_worker.finish(tr_jobs)
+
+        report = self.get_report(
+            (
+                self.__chapter_worker.get_report(),
+                self.__verse_worker.get_report(),
+                self.__tr_worker.get_report()
+            ) + ((resumed,) if resumed is not None else ())
+        )
+        if report is not None:
+            logging.error("Fetcher pipeline worker", extra=report)
+
+        self.write_metrics(report, monotonic() - started)
+
+        return report
+
+    def write_metrics(self, report: Optional[dict], duration: float):
+        """ Export metrics of the run (including the scan before it) and start measuring the next one """
+
+        metrics = get_metrics()
+
+        metrics.add_time('run', duration)
+        metrics.set('last_run_timestamp_seconds', time())
+        for key in ('resources_created', 'resources_deleted', 'metadata_fixed', 'errors'):
+            metrics.set(key, len(report[key]) if report is not None else 0)
+
+        try:
+            metrics.write(self.metrics_file, self.metrics_json)
+        except OSError as e:
+            logging.warning(f'Could not write metrics: {e}')
+
+        metrics.reset()
+
+    def get_created_files(self, report: Optional[dict]) -> Dict[Path, Tuple[int, int]]:
+        """ Get size and modification time of the files created by the workers """
+
+        created = {}
+        if report is None:
+            return created
+
+        for resource in report["resources_created"]:
+            path = self.__ftp_dir.joinpath(resource)
+
+            # Split verses are reported as their directory
+            files = [p for p in path.iterdir() if p.is_file()] if path.is_dir() else [path]
+
+            for file in files:
+                state = self.get_file_state(file)
+                if state is not None:
+                    created[file] = state
+
+        return created
+
+    @staticmethod
+    def get_file_state(path: Path) -> Optional[Tuple[int, int]]:
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def get_book_scope(self, path: Path) -> Optional[Tuple[str, str, str]]:
+        """ Get (lang, resource, book) of an uploaded wav file, or None if the file doesn't trigger work """
+
+        try:
+            parts = path.relative_to(self.__ftp_dir).parts
+        except ValueError:
+            return None
+
+        if path.suffix != '.wav' or 'CONTENTS' not in parts or len(parts) < 5:
+            return None
+
+        # Skip hidden files (partial uploads, lease files)
+        if any(p.startswith('.') for p in parts):
+            return None
+
+        return parts[0], parts[1], parts[2]
+
     @staticmethod
     def get_report(reports):
         """ Generate workers report """
@@ -60,18 +326,91 @@ class App:
         report = {
             "resources_created": [],
             "resources_deleted": [],
+            "metadata_fixed": [],
+            "errors": [],
         }
         for r in reports:
             report["resources_created"] += r["resources_created"]
             report["resources_deleted"] += r["resources_deleted"]
+            report["metadata_fixed"] += r.get("metadata_fixed", [])
+            report["errors"] += r["errors"]
 
         if (len(report["resources_created"]) > 0 or
-                len(report["resources_deleted"]) > 0):
+                len(report["resources_deleted"]) > 0 or
+                len(report["errors"]) > 0):
             return report
 
         return None
 
 
+def parse_size(value: str) -> int:
+    """ Parse size in bytes with an optional K, M, G or T suffix """
+
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+    number = value.strip().upper().rstrip('B')
+    multiplier = 1
+    if number and number[-1] in units:
+        multiplier = units[number[-1]]
+        number = number[:-1]
+
+    try:
+        size = int(float(number) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid size: {value}')
+
+    if size < 1:
+        raise argparse.ArgumentTypeError(f'Invalid size: {value}')
+
+    return size
+
+
+def parse_tool_limit(value: str) -> Tuple[str, int]:
+    """ Parse tool concurrency limit: <tool>=<number> """
+
+    tool, sep, limit = value.partition('=')
+    if not sep or not tool or not limit.isdigit() or int(limit) < 1:
+        raise argparse.ArgumentTypeError(f'Invalid tool limit: {value}. Expected <tool>=<number>')
+
+    return Path(tool).stem, int(limit)
+
+
+def parse_rendition(value: str) -> process_tools.Rendition:
+    """ Parse mp3 rendition: <quality>=<bitrate in kbps> """
+
+    quality, sep, bitrate = value.partition('=')
+    bitrate = bitrate.lower().rstrip('k')
+    if not sep or not quality or '/' in quality or not bitrate.isdigit() or int(bitrate) < 1:
+        raise argparse.ArgumentTypeError(f'Invalid rendition: {value}. Expected <quality>=<kbps>')
+    if quality == process_tools.BASE_QUALITY:
+        raise argparse.ArgumentTypeError(f'Invalid rendition: {value}. {quality} is converted by the encoder')
+
+    return process_tools.Rendition(quality, int(bitrate))
+
+
+def parse_language_weight(value: str) -> Tuple[str, float]:
+    """ Parse language weight: <lang>=<number> """
+
+    lang, sep, weight = value.partition('=')
+    try:
+        if not sep or not lang or float(weight) <= 0:
+            raise ValueError
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid language weight: {value}. Expected <lang>=<number>')
+
+    return lang, float(weight)
+
+
+def parse_language_limit(value: str) -> Tuple[str, int]:
+    """ Parse language concurrency limit: <lang>=<number> """
+
+    lang, sep, limit = value.partition('=')
+    if not sep or not lang or not limit.isdigit() or int(limit) < 1:
+        raise argparse.ArgumentTypeError(f'Invalid language limit: {value}. Expected <lang>=<number>')
+
+    return lang, int(limit)
+
+
 def get_arguments() -> Tuple[Namespace, List[str]]:
     """ Parse command line arguments """
 
@@ -81,8 +420,71 @@ def get_arguments() -> Tuple[Namespace, List[str]]:
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable logs from subprocess")
     parser.add_argument("-hr", "--hour", type=int, default=0, help="Hour, when to execute workers")
     parser.add_argument("-mn", "--minute", type=int, default=0, help="Minute, when to execute workers")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of jobs to run in parallel")
+    parser.add_argument("--tool-command", type=str, default="java -jar",
+                        help="Command that runs a tool in a new process. The jar path is appended to it")
+    parser.add_argument("--tool-daemon", type=str, default=None,
+                        help="Command that starts a resident tool daemon. The jar path is appended to it")
+    parser.add_argument("--tool-daemon-pool", type=int, default=1, help="Number of resident daemons per tool")
+    parser.add_argument("--tool-timeout", type=float, default=None, help="Timeout of a tool call in seconds")
+    parser.add_argument("--tool-limit", type=parse_tool_limit, action="append", default=[],
+                        help="Max number of concurrent processes of a tool, e.g. audio-compressor-cli=2")
+    parser.add_argument("--rendition", type=parse_rendition, action="append", default=[],
+                        help="Also encode wav files into mp3/<quality> at the given bitrate, e.g. low=64")
+    parser.add_argument("--ffmpeg", type=str, default=None,
+                        help="Command that runs ffmpeg, encodes the renditions of a file in a single pass")
+    parser.add_argument("--cache-dir", type=lambda p: Path(p).absolute(), default=None,
+                        help="Directory of the conversion cache, converted files are reused from it")
+    parser.add_argument("--cache-size", type=parse_size, default=parse_size('10G'),
+                        help="Max size of the conversion cache, e.g. 10G. Least recently used files are evicted")
+    parser.add_argument("--language-weight", type=parse_language_weight, action="append", default=[],
+                        help="Share of the workers a language gets when others wait too, e.g. en=2 (default: 1)")
+    parser.add_argument("--language-limit", type=parse_language_limit, action="append", default=[],
+                        help="Max number of concurrent jobs of a language, e.g. en=4")
+    parser.add_argument("--job-timeout", type=float, default=None,
+                        help="Timeout of a job (chapter, verse group, TR file) in seconds")
+    parser.add_argument("--scratch-dir", type=lambda p: Path(p).absolute(), default=None,
+                        help="Directory for the scratch files of the jobs, e.g. a tmpfs (default: system temp dir)")
+    parser.add_argument("--scratch-budget", type=parse_size, default=None,
+                        help="Max scratch space of the running jobs, e.g. 2G. Jobs wait for space when it's used up")
+    parser.add_argument("--shard", action="store_true",
+                        help="Share the work with other nodes running on the same FTP directory")
+    parser.add_argument("--node-id", type=str, default=None,
+                        help="Name of this node in the lease files (default: hostname-pid)")
+    parser.add_argument("--lease-ttl", type=float, default=600.0,
+                        help="Seconds after which the lease of a node that stopped renewing it can be taken over")
+    parser.add_argument("--lease-batch", type=int, default=None,
+                        help="Number of books to claim at once (default: number of jobs)")
+    parser.add_argument("--metrics-file", type=lambda p: Path(p).absolute(), default=None,
+                        help="Write metrics of every run into this file in Prometheus textfile format")
+    parser.add_argument("--metrics-json", type=lambda p: Path(p).absolute(), default=None,
+                        help="Write metrics of every run into this JSON file")
+    parser.add_argument("--plan", nargs="?", const="-", default=None, metavar="FILE",
+                        help="Write the jobs a run would start with their estimated costs and the resources "
+                             "they would create or delete into a JSON file (stdout if no file is given) and exit")
+    parser.add_argument("-sf", "--state-file", type=lambda p: Path(p).absolute(), default=Path("state.db").absolute(),
+                        help="State database file")
+    parser.add_argument("--rebuild-state", action="store_true",
+                        help="Drop the state database, so all the files are processed again")
+    parser.add_argument("--verify", action="store_true",
+                        help="Verify the state database against the input directory and exit "
+                             "(with code 1 if invalid records have been dropped)")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="Process uploads as soon as they finish instead of once a day")
+    parser.add_argument("--watch-mode", choices=['auto', 'inotify', 'poll'], default='auto',
+                        help="How to detect uploads in watch mode")
+    parser.add_argument("--debounce", type=float, default=30.0,
+                        help="Seconds a file must stay unchanged before it is processed in watch mode")
+    parser.add_argument("--poll-interval", type=float, default=300.0,
+                        help="Seconds between scans when polling for changes in watch mode")
+    parser.add_argument("--reconcile-interval", type=float, default=24 * 60 * 60,
+                        help="Seconds between full scans of the input directory in watch mode")
 
-    return parser.parse_known_args()
+    args, unknown = parser.parse_known_args()
+    if args.rendition and args.ffmpeg is None:
+        parser.error('--rendition needs --ffmpeg')
+
+    return args, unknown
 
 
 def main():
@@ -102,8 +504,69 @@ def main():
         traces_sample_rate=0.0
     )
 
-    app = App(args.input_dir, args.verbose, args.hour, args.minute)
-    app.start()
+    process_tools.use_process_runner(ProcessRunner(dict(args.tool_limit), args.tool_timeout))
+    process_tools.use_tool_command(shlex.split(args.tool_command))
+
+    process_tools.use_renditions(args.rendition)
+    if args.ffmpeg is not None:
+        process_tools.use_ffmpeg(shlex.split(args.ffmpeg))
+
+    if args.cache_dir is not None:
+        process_tools.use_conversion_cache(
+            ConversionCache(args.cache_dir, args.cache_size, process_tools.encoder_version())
+        )
+
+    state = StateStore(args.state_file)
+
+    if args.verify:
+        valid, invalid = state.verify()
+        state.close()
+
+        # The summary is the output of the command, it's written whatever the log level is
+        sys.stdout.write(f'State verified: {valid} valid, {invalid} invalid records\n')
+        sys.exit(1 if invalid > 0 else 0)
+
+    if args.rebuild_state:
+        logging.debug(f'Rebuilding state: {args.state_file}')
+        state.clear()
+
+    app = App(args.input_dir, args.verbose, args.hour, args.minute, state, args.jobs, args.watch)
+    app.job_timeout = args.job_timeout
+    app.scratch_root = args.scratch_dir
+    app.scratch_budget = args.scratch_budget
+    app.language_weights = dict(args.language_weight)
+    app.language_limits = dict(args.language_limit)
+    app.metrics_file = args.metrics_file
+    app.metrics_json = args.metrics_json
+    app.watch_mode = args.watch_mode
+    app.debounce_delay = args.debounce
+    app.poll_interval = args.poll_interval
+    app.reconcile_interval = args.reconcile_interval
+
+    if args.plan is not None:
+        plan = app.plan(FtpCatalog.scan(args.input_dir))
+        write_plan(plan, None if args.plan == '-' else Path(args.plan).absolute())
+        state.close()
+        return
+
+    if args.shard:
+        app.leases = LeaseManager(args.input_dir, args.node_id, args.lease_ttl, on_lost=app.cancel_book)
+        if args.lease_batch is not None:
+            app.lease_batch = max(1, args.lease_batch)
+
+    tool_daemon = None
+    if args.tool_daemon is not None:
+        tool_daemon = ToolDaemonPool(shlex.split(args.tool_daemon), args.tool_daemon_pool, args.tool_timeout)
+        process_tools.use_tool_daemon(tool_daemon)
+
+    try:
+        app.start()
+    finally:
+        if app.leases is not None:
+            app.leases.close()
+        if tool_daemon is not None:
+            process_tools.use_tool_daemon(None)
+            tool_daemon.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,359 @@
+""" Measure the workers end to end on a synthetic FTP tree, with stub tools instead of the jars.
+
+Usage: python benchmarks/pipeline.py [--langs 2] [--resources 1] [--books 2] [--chapters 4] [--verses 8]
+                                     [--baseline benchmarks/baseline.json] [--save-baseline]
+
+Part of the chapters are processed before the measurement (verse files, mp3, cue and TR files exist),
+the rest are new chapter files (with or without verse markers) and uploaded verse files.
+Chapter, verse and TR workers run one after another on a copy of the tree, then the whole pipeline
+runs on a fresh copy. Every stage runs in its own process to measure its wall time, peak RSS,
+bytes read and written (including the tools) and the tool processes it has started.
+The results are compared with the baseline, the script fails if a stage has become slower or heavier. """
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import shlex
+import shutil
+import struct
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+import process_tools  # noqa: E402
+from chapter_worker import ChapterWorker  # noqa: E402
+from ftp_catalog import FtpCatalog  # noqa: E402
+from riff import CUE_POINT, pack_chunk  # noqa: E402
+from tr_worker import TrWorker  # noqa: E402
+from verse_worker import VerseWorker  # noqa: E402
+
+BENCHMARK_DIR = Path(__file__).absolute().parent
+REPO_DIR = BENCHMARK_DIR.parent
+STUB_TOOL = f'{shlex.quote(sys.executable)} {shlex.quote(str(BENCHMARK_DIR.joinpath("stub_tool.py")))}'
+
+BOOKS = ['gen', 'exo', 'lev', 'num', 'deu', 'jos', 'jdg', 'rut', 'psa', 'pro', 'mat', 'mrk', 'luk', 'jhn', 'act']
+SAMPLE_RATE = 44100
+
+STAGES = ['chapter', 'verse', 'tr']
+
+# Metrics that depend on the machine load, and metrics that should be the same on every run
+TIMING_METRICS = ['wall_s', 'cpu_s', 'peak_rss_mb', 'tool_peak_rss_mb']
+COUNT_METRICS = ['bytes_read', 'bytes_written', 'processes']
+COUNT_TOLERANCE = 0.01
+
+# Differences of short stages below these values are noise
+TIMING_SLACK = {'wall_s': 0.25, 'cpu_s': 0.25, 'peak_rss_mb': 5.0, 'tool_peak_rss_mb': 5.0}
+
+
+def chapter_wav(verses: int, verse_seconds: float, seed: int, marked=True) -> bytes:
+    """ 16 bit mono chapter recording, with a cue point and a verse label at the start of every verse """
+
+    fmt = struct.pack('<HHIIHH', 1, 1, SAMPLE_RATE, SAMPLE_RATE * 2, 2, 16)
+
+    verse_frames = int(SAMPLE_RATE * verse_seconds)
+    pattern = bytes((i * 7 + seed) % 256 for i in range(4096))
+    data_size = verse_frames * verses * 2
+    data = (pattern * (data_size // len(pattern) + 1))[:data_size]
+
+    metadata = {
+        'language': 'en',
+        'version': 'ulb',
+        'startv': '1',
+        'endv': str(verses),
+        'markers': {str(v + 1): v * verse_frames for v in range(verses)} if marked else {}
+    }
+    info = b'INFO' + pack_chunk(b'IART', json.dumps(metadata).encode('utf-8') + b'\0')
+
+    chunks = pack_chunk(b'fmt ', fmt) + pack_chunk(b'LIST', info)
+
+    if marked:
+        cue = struct.pack('<I', verses) + b''.join(
+            CUE_POINT.pack(v + 1, v * verse_frames, b'data', 0, 0, v * verse_frames) for v in range(verses)
+        )
+        labels = b'adtl' + b''.join(
+            pack_chunk(b'labl', struct.pack('<I', v + 1) + str(v + 1).encode('utf-8') + b'\0') for v in range(verses)
+        )
+        chunks += pack_chunk(b'cue ', cue) + pack_chunk(b'LIST', labels)
+
+    chunks += pack_chunk(b'data', data)
+
+    return b'RIFF' + struct.pack('<I', 4 + len(chunks)) + b'WAVE' + chunks
+
+
+def generate_tree(root: Path, args: argparse.Namespace):
+    """ Create chapter files, process part of them with the stub tools and add the new uploads """
+
+    rng = random.Random(args.seed)
+    uploads = []
+
+    for li in range(args.langs):
+        lang = f'l{li}'
+        for ri in range(args.resources):
+            res = 'ulb' if ri == 0 else f'r{ri}'
+            for bi in range(args.books):
+                book = BOOKS[bi] if bi < len(BOOKS) else f'b{bi}'
+                for ci in range(1, args.chapters + 1):
+                    chapter_dir = root.joinpath(lang, res, book, str(ci), 'CONTENTS')
+                    name = f'{lang}_{res}_b{bi + 1:02d}_{book}_c{ci:02d}'
+                    seed = rng.randrange(256)
+
+                    if rng.random() < args.processed:
+                        # Processed below, before the uploads are added
+                        wav_dir = chapter_dir.joinpath('wav', 'chapter')
+                        wav_dir.mkdir(parents=True, exist_ok=True)
+                        wav_dir.joinpath(f'{name}.wav').write_bytes(
+                            chapter_wav(args.verses, args.verse_seconds, seed, rng.random() >= args.unmarked)
+                        )
+                    elif rng.random() < args.verse_uploads:
+                        uploads.append((chapter_dir.joinpath('wav', 'chunk'), name, seed, None))
+                    else:
+                        uploads.append((chapter_dir.joinpath('wav', 'chapter'), name, seed,
+                                        rng.random() >= args.unmarked))
+
+    catalog = FtpCatalog.scan(root)
+    ChapterWorker(root, jobs=args.jobs).execute(catalog)
+    TrWorker(root, jobs=args.jobs).execute(catalog)
+
+    for upload_dir, name, seed, marked in uploads:
+        upload_dir.mkdir(parents=True, exist_ok=True)
+        if marked is None:
+            # Verse files as they come from the recorder, one take per verse
+            for vi in range(1, args.verses + 1):
+                upload_dir.joinpath(f'{name}_v{vi:02d}_t01.wav').write_bytes(
+                    chapter_wav(1, args.verse_seconds, (seed + vi) % 256, False)
+                )
+        else:
+            upload_dir.joinpath(f'{name}.wav').write_bytes(
+                chapter_wav(args.verses, args.verse_seconds, seed, marked)
+            )
+
+
+def read_proc_io() -> Dict[str, int]:
+    """ I/O counters of this process and its finished children """
+
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                counters[key.strip()] = int(value)
+    except (OSError, ValueError):
+        pass
+
+    return counters
+
+
+def run_stage(stage: str, root: Path, jobs: int) -> dict:
+    """ Run a stage in this process and measure it """
+
+    runner = process_tools.get_process_runner()
+    io_before = read_proc_io()
+    start = perf_counter()
+
+    if stage == 'pipeline':
+        from app import App
+
+        App(root, jobs=jobs).run_workers(FtpCatalog.scan(root))
+    elif stage == 'chapter':
+        ChapterWorker(root, jobs=jobs).execute()
+    elif stage == 'verse':
+        VerseWorker(root, jobs=jobs).execute()
+    elif stage == 'tr':
+        TrWorker(root, jobs=jobs).execute()
+    else:
+        raise ValueError(f'Unknown stage: {stage}')
+
+    wall = perf_counter() - start
+    io_after = read_proc_io()
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    processes = runner.started_processes()
+
+    return {
+        'wall_s': round(wall, 3),
+        'cpu_s': round(own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime, 3),
+        'peak_rss_mb': round(own.ru_maxrss / 1024, 1),
+        'tool_peak_rss_mb': round(children.ru_maxrss / 1024, 1),
+        'bytes_read': io_after.get('rchar', 0) - io_before.get('rchar', 0),
+        'bytes_written': io_after.get('wchar', 0) - io_before.get('wchar', 0),
+        'processes': sum(processes.values()),
+        'processes_per_tool': processes
+    }
+
+
+def measure(stage: str, root: Path, args: argparse.Namespace) -> dict:
+    """ Run the stage in a new process, so its peak RSS and I/O are its own """
+
+    command = [
+        sys.executable, __file__, '--run-stage', stage, '--root', str(root),
+        '--jobs', str(args.jobs), '--tool-command', args.tool_command
+    ]
+    if args.trace:
+        command.append('--trace')
+
+    result = subprocess.run(command, cwd=REPO_DIR, stdout=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'Stage {stage} exited with code {result.returncode}')
+
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def run_benchmark(template: Path, work_dir: Path, args: argparse.Namespace) -> Dict[str, dict]:
+    """ Measure the stages one after another on a copy of the tree, then the pipeline on a fresh copy.
+    With repeats, the fastest run of every stage is kept """
+
+    results: Dict[str, dict] = {}
+
+    for i in range(args.repeat):
+        runs = [('stages', STAGES), ('pipeline', ['pipeline'])]
+        for name, stages in runs:
+            root = work_dir.joinpath(f'{name}-{i}')
+            shutil.copytree(template, root)
+
+            for stage in stages:
+                metrics = measure(stage, root, args)
+                if stage not in results or metrics['wall_s'] < results[stage]['wall_s']:
+                    results[stage] = metrics
+
+            shutil.rmtree(root)
+
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """ Find metrics that are worse than in the baseline """
+
+    regressions = []
+
+    for stage, metrics in results.items():
+        if stage not in baseline:
+            continue
+
+        for metric in TIMING_METRICS + COUNT_METRICS:
+            allowed = tolerance if metric in TIMING_METRICS else COUNT_TOLERANCE
+            value = metrics.get(metric)
+            base = baseline[stage].get(metric)
+            if value is None or base is None:
+                continue
+
+            if value > base * (1 + allowed) and value - base > TIMING_SLACK.get(metric, 0):
+                regressions.append(f'{stage} {metric}: {value} (baseline {base}, +{allowed:.0%} allowed)')
+
+    return regressions
+
+
+def print_results(results: Dict[str, dict], baseline: Optional[Dict[str, dict]]):
+    metrics = TIMING_METRICS + COUNT_METRICS
+    print(f'{"stage":<10}' + ''.join(f'{m:>18}' for m in metrics))
+
+    for stage, values in results.items():
+        print(f'{stage:<10}' + ''.join(f'{values[m]:>18}' for m in metrics))
+        if baseline is not None and stage in baseline:
+            print(f'{"baseline":<10}' + ''.join(f'{baseline[stage].get(m, "-"):>18}' for m in metrics))
+
+
+def get_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the workers on a synthetic FTP tree')
+    parser.add_argument('--langs', type=int, default=2)
+    parser.add_argument('--resources', type=int, default=1)
+    parser.add_argument('--books', type=int, default=2)
+    parser.add_argument('--chapters', type=int, default=4)
+    parser.add_argument('--verses', type=int, default=8)
+    parser.add_argument('--verse-seconds', type=float, default=2.0, help='Length of the verse recordings')
+    parser.add_argument('--processed', type=float, default=0.5, help='Share of the chapters processed before')
+    parser.add_argument('--unmarked', type=float, default=0.25, help='Share of the chapters without verse markers')
+    parser.add_argument('--verse-uploads', type=float, default=0.25,
+                        help='Share of the new chapters uploaded as verse files')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-j', '--jobs', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3, help='Run every stage several times, keep the fastest run')
+    parser.add_argument('--tool-command', type=str, default=STUB_TOOL,
+                        help='Command that runs the tools, the jar path is appended (default: the stub tools)')
+    parser.add_argument('--baseline', type=Path, default=BENCHMARK_DIR.joinpath('baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed increase of wall time, CPU time and memory against the baseline')
+    parser.add_argument('--output', type=Path, default=None, help='Write the results into a JSON file')
+    parser.add_argument('-t', '--trace', action='store_true', help='Enable tracing output')
+
+    # Internal: run a single stage in this process
+    parser.add_argument('--run-stage', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--root', type=Path, default=None, help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def get_params(args: argparse.Namespace) -> dict:
+    """ Parameters the results depend on """
+
+    keys = ['langs', 'resources', 'books', 'chapters', 'verses', 'verse_seconds', 'processed', 'unmarked',
+            'verse_uploads', 'seed', 'jobs']
+    return {k: getattr(args, k) for k in keys}
+
+
+def main():
+    args = get_arguments()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s: %(message)s',
+                        level=logging.DEBUG if args.trace else logging.CRITICAL)
+
+    process_tools.use_tool_command(shlex.split(args.tool_command))
+
+    if args.run_stage is not None:
+        print(json.dumps(run_stage(args.run_stage, args.root, args.jobs)))
+        return
+
+    os.chdir(REPO_DIR)
+
+    with TemporaryDirectory() as tmp:
+        template = Path(tmp).joinpath('template')
+        template.mkdir()
+
+        start = perf_counter()
+        generate_tree(template, args)
+        files = sum(len(f) for _, _, f in os.walk(template))
+        print(f'Generated {files} files in {perf_counter() - start:.1f}s')
+
+        results = run_benchmark(template, Path(tmp), args)
+
+    params = get_params(args)
+    baseline = None
+    if args.baseline.exists() and not args.save_baseline:
+        data = json.loads(args.baseline.read_text())
+        if data.get('params') == params:
+            baseline = data.get('results', {})
+        else:
+            print(f'Baseline {args.baseline} has been recorded with other parameters, skipping comparison')
+
+    print_results(results, baseline)
+
+    if args.output is not None:
+        args.output.write_text(json.dumps({'params': params, 'results': results}, indent=2))
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps({'params': params, 'results': results}, indent=2) + '\n')
+        print(f'Baseline saved: {args.baseline}')
+        return
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions:')
+            for r in regressions:
+                print(f'  {r}')
+            sys.exit(1)
+
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
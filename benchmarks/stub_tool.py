@@ -0,0 +1,71 @@
+""" Fast stand-in for the jar tools, to measure the pipeline without the JVM and the encoder.
+
+Usage: python benchmarks/stub_tool.py tools/<tool>.jar <tool arguments>
+
+Run the app with `--tool-command "python benchmarks/stub_tool.py"` to use it instead of `java -jar`.
+bttConverter leaves the file as it is, tr-chunk-browser-cli splits the chapter into 3 verses,
+audio-compressor-cli writes an mp3 file (a tenth of the wav file) and a cue file next to every wav file. """
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from riff import parse_wav, write_wav  # noqa: E402
+
+SPLIT_VERSES = 3
+
+
+def get_option(args: list, name: str) -> str:
+    return args[args.index(name) + 1]
+
+
+def split_chapter(input_file: Path, output_dir: Path):
+    """ Split chapter into equal verses """
+
+    buffer = input_file.read_bytes()
+    wav = parse_wav(buffer)
+
+    frames = wav.data_size // wav.block_align
+    step = frames // SPLIT_VERSES
+
+    for i in range(SPLIT_VERSES):
+        start = wav.data_offset + i * step * wav.block_align
+        end = wav.data_offset + (frames if i == SPLIT_VERSES - 1 else (i + 1) * step) * wav.block_align
+        output_file = output_dir.joinpath(f'{input_file.stem}_v{i + 1:02d}.wav')
+        write_wav(output_file, wav.fmt, buffer[start:end], str(i + 1))
+
+
+def compress(input_file_or_dir: Path):
+    """ Write mp3 and cue files next to the wav files """
+
+    if input_file_or_dir.is_dir():
+        files = sorted(input_file_or_dir.glob('*.wav'))
+    else:
+        files = [input_file_or_dir]
+
+    for f in files:
+        data = f.read_bytes()
+        f.with_suffix('.mp3').write_bytes(b'ID3' + data[::10])
+        f.with_suffix('.cue').write_text(f'FILE "{f.with_suffix(".mp3").name}" MP3\n')
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit('Usage: stub_tool.py <jar> <arguments>')
+
+    tool = Path(sys.argv[1]).stem
+    args = sys.argv[2:]
+
+    if tool == 'bttConverter':
+        return
+    elif tool == 'tr-chunk-browser-cli':
+        split_chapter(Path(get_option(args, '-f')), Path(get_option(args, '-o')))
+    elif tool == 'audio-compressor-cli':
+        compress(Path(get_option(args, '-i')))
+    else:
+        sys.exit(f'Unknown tool: {tool}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+""" Stub tool daemon that speaks the tool_daemon protocol without running any real tool.
+
+Usage: python benchmarks/stub_tool_daemon.py tools/<tool>.jar
+
+Arguments "--stub-sleep <seconds>", "--stub-fail" and "--stub-crash" in a request
+make the stub sleep, return a non-zero code or exit, to test timeouts and restarts. """
+
+import json
+import struct
+import sys
+import time
+
+HEADER = struct.Struct('>I')
+
+
+def read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def main():
+    jar = sys.argv[1] if len(sys.argv) > 1 else ''
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+
+    while True:
+        header = read_exactly(stdin, HEADER.size)
+        if header is None:
+            return
+
+        (length,) = HEADER.unpack(header)
+        request = json.loads(read_exactly(stdin, length).decode('utf-8'))
+        args = request.get('args', [])
+
+        if '--stub-crash' in args:
+            sys.exit(1)
+        if '--stub-sleep' in args:
+            time.sleep(float(args[args.index('--stub-sleep') + 1]))
+
+        response = {
+            'id': request.get('id'),
+            'returncode': 1 if '--stub-fail' in args else 0,
+            'stdout': f'{jar} {" ".join(args)}',
+            'stderr': ''
+        }
+
+        data = json.dumps(response).encode('utf-8')
+        stdout.write(HEADER.pack(len(data)) + data)
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
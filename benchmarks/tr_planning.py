@@ -0,0 +1,114 @@
+""" Compare TR planning of the previous TrWorker implementation (regex matching of every
+verse file against every existing TR and list removal) with the indexed one.
+
+Usage: python benchmarks/tr_planning.py [--langs 4] [--books 10] [--chapters 20] [--verses 20] """
+
+import argparse
+import re
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from ftp_catalog import FtpCatalog, Kind  # noqa: E402
+from tr_worker import TrWorker  # noqa: E402
+
+
+def generate_tree(root: Path, langs: int, books: int, chapters: int, verses: int):
+    """ Create empty verse files (wav, mp3 hi and low) and TR files for every other chapter """
+
+    for li in range(langs):
+        lang = f'l{li}'
+        for bi in range(books):
+            book = f'b{bi}'
+            for ci in range(1, chapters + 1):
+                contents = root.joinpath(lang, 'ulb', book, str(ci), 'CONTENTS')
+                for media in ('wav/verse', 'mp3/hi/verse', 'mp3/low/verse'):
+                    media_dir = contents.joinpath(media)
+                    media_dir.mkdir(parents=True, exist_ok=True)
+                    ext = media[:3]
+                    for vi in range(1, verses + 1):
+                        media_dir.joinpath(f'{lang}_ulb_{book}_c{ci:02d}_v{vi:02d}.{ext}').touch()
+
+                    if ci % 2 == 0:
+                        tr_dir = contents.joinpath('tr', media)
+                        tr_dir.mkdir(parents=True, exist_ok=True)
+                        tr_dir.joinpath(f'{lang}_ulb_{book}_c{ci}.tr').touch()
+
+
+def legacy_plan(catalog: FtpCatalog, verse_regex: str):
+    """ TR planning as it was done before the indexed lookups """
+
+    existent_tr = []
+    for entry in catalog.entries(Kind.TR):
+        existent_tr.append((entry.chapter is not None, entry.path))
+
+    book_tr_files = []
+    chapter_tr_files = []
+
+    entries = catalog.entries(Kind.VERSE_WAV) + catalog.entries(Kind.MP3)
+    for entry in entries:
+        if entry.grouping != 'verse' or not re.search(verse_regex, entry.path.name):
+            continue
+
+        src_file = entry.path
+        book_tr_files.append(src_file)
+        chapter_tr_files.append(src_file)
+
+        regex = fr'{entry.lang}\/{entry.resource}\/{entry.book}(?:\/{entry.chapter})?\/' \
+                fr'CONTENTS\/tr\/{entry.media}(?:\/{entry.quality})?\/{entry.grouping}'
+
+        for is_chapter, tr in existent_tr:
+            if not re.search(regex, str(tr)):
+                continue
+
+            if not is_chapter and src_file in book_tr_files:
+                book_tr_files.remove(src_file)
+            elif is_chapter and src_file in chapter_tr_files:
+                chapter_tr_files.remove(src_file)
+
+    return chapter_tr_files, book_tr_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TR planning')
+    parser.add_argument('--langs', type=int, default=4)
+    parser.add_argument('--books', type=int, default=10)
+    parser.add_argument('--chapters', type=int, default=20)
+    parser.add_argument('--verses', type=int, default=20)
+    parser.add_argument('--skip-legacy', action='store_true', help='Do not run the previous implementation')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        generate_tree(root, args.langs, args.books, args.chapters, args.verses)
+
+        catalog = FtpCatalog.scan(root)
+        files = len(catalog.entries(Kind.VERSE_WAV)) + len(catalog.entries(Kind.MP3))
+        trs = len(catalog.entries(Kind.TR))
+        print(f'Verse files: {files}, TR files: {trs}')
+
+        worker = TrWorker(root)
+        start = perf_counter()
+        chapter_groups, book_groups = worker.plan_tr_groups(catalog)
+        indexed = perf_counter() - start
+
+        chapter_files = sum(len(f) for f in chapter_groups.values())
+        book_files = sum(len(f) for f in book_groups.values())
+        print(f'Indexed: {indexed:.3f}s ({chapter_files} chapter TR files, {book_files} book TR files)')
+
+        if not args.skip_legacy:
+            start = perf_counter()
+            chapter_tr_files, book_tr_files = legacy_plan(catalog, r'_c[\d]+_v[\d]+(?:_t[\d]+)?\..*$')
+            legacy = perf_counter() - start
+
+            print(f'Legacy: {legacy:.3f}s ({len(chapter_tr_files)} chapter TR files, '
+                  f'{len(book_tr_files)} book TR files)')
+            print(f'Speedup: {legacy / max(indexed, 1e-9):.1f}x')
+
+
+
+if __name__ == '__main__':
+    main()
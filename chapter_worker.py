@@ -1,121 +1,369 @@
 import logging
-import re
+from concurrent.futures import Future
+from functools import partial
 from pathlib import Path
-from typing import Dict
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional
 
-from file_utils import init_temp_dir, rm_tree, copy_dir, check_file_exists, copy_file, check_dir_empty, has_new_files, \
-    rel_path
-from process_tools import fix_metadata, split_chapter, convert_to_mp3
+from file_utils import rm_tree, copy_dir, check_file_exists, copy_file, check_dir_empty, has_new_files, \
+    rel_path, remote_file_path, file_digest, record_digests, path_exists, remove_file, destination_view
+from ftp_catalog import FtpCatalog, CatalogEntry
+from metrics import get_metrics
+from process_tools import stage_wav_file, split_chapter, convert_to_mp3_batch, start_convert_to_mp3, \
+    wait_convert_to_mp3, wait_tool, get_renditions, rendition_file, start_encode_renditions, Rendition, \
+    BASE_QUALITY
+from planner import read_header, audio_seconds, estimate_cost
+from riff import split_wav, get_verses, check_metadata, RiffError, WavInfo
+from scheduler import Job, JobScheduler, merge_reports
+from scratch import ScratchManager
+from state_store import StateStore
+
+
+class ChapterConversion(NamedTuple):
+    """ Started conversion of a chapter file: base rendition (None if it exists remotely)
+    and the other renditions missing remotely """
+    base: Optional[Future]
+    renditions: Dict[Rendition, List[Path]]
+    futures: List[Future]
+
+
+def _published_qualities() -> List[str]:
+    """ Mp3 qualities a chapter can have published: hi, low (packed into tr files) and the other renditions """
+
+    qualities = [BASE_QUALITY, 'low']
+    return qualities + [r.quality for r in get_renditions() if r.quality not in qualities]
 
 
 class ChapterWorker:
 
-    def __init__(self, input_dir: Path, verbose=False):
+    def __init__(self, input_dir: Path, verbose=False, state: StateStore = None, jobs=1):
         self.__ftp_dir = input_dir
-        self.__temp_dir = None
-
-        self.__chapter_regex = r'_c[\d]+\..*$'
+        self.__catalog = None
+        self.__state = state
+        self.__lock = Lock()
 
         self.verbose = verbose
+        self.jobs = jobs
+        self.job_timeout = None
+        self.scratch_root = None
+        self.scratch_budget = None
 
         self.resources_created = []
         self.resources_deleted = []
+        self.metadata_fixed = []
+        self.errors = []
 
-    def execute(self):
+    def execute(self, catalog: FtpCatalog = None):
         """ Execute worker """
 
         logging.debug("Chapter worker started!")
 
-        self.clear_report()
-        self.__temp_dir = init_temp_dir()
+        with ScratchManager(self.scratch_root, self.scratch_budget) as scratch:
+            with destination_view():
+                jobs = self.plan_jobs(catalog)
 
-        for src_file in self.__ftp_dir.rglob('*.wav'):
-            # Process chapter files only
-            if not re.search(self.__chapter_regex, str(src_file)):
-                continue
+                scheduler = JobScheduler(scratch, self.jobs, self.job_timeout)
+                scheduler.run(jobs)
+            self.finish(jobs)
 
-            # Extract necessary path parts
-            root_parts = self.__ftp_dir.parts
-            parts = src_file.parts[len(root_parts):]
+        logging.debug('Chapter worker finished!')
 
-            lang = parts[0]
-            resource = parts[1]
-            book = parts[2]
-            chapter = parts[3]
-            grouping = parts[6]
+    def plan_jobs(self, catalog: FtpCatalog = None, describe=False) -> List[Job]:
+        """ Create a job per changed chapter file. Cost is estimated from the duration in the WAV header.
+        Describe lists the resources every job is expected to create or delete """
 
-            target_dir = self.__temp_dir.joinpath(lang, resource, book, chapter, grouping)
-            remote_dir = self.__ftp_dir.joinpath(lang, resource, book, chapter, "CONTENTS")
-            verses_dir = target_dir.joinpath("verses")
-            verses_dir.mkdir(parents=True, exist_ok=True)
-            target_file = target_dir.joinpath(src_file.name)
+        self.clear_report()
+        self.__catalog = catalog if catalog is not None else FtpCatalog.scan(self.__ftp_dir)
+
+        jobs = []
+        for entry in self.__catalog.chapter_wavs():
+            # Skip chapters that haven't changed since they were processed last time
+            unchanged = self.__state is not None and self.__state.is_unchanged(
+                entry.path, entry.size, entry.mtime_ns, self.__catalog.exists
+            ) and self.has_renditions(entry)
+            get_metrics().hit('skip', unchanged, stage='chapter')
+
+            if unchanged:
+                logging.debug(f'Chapter file is unchanged: {entry.path}. Skipping...')
+                continue
 
-            logging.debug(f'Found chapter file: {src_file}')
+            wav = read_header(entry.path)
+            verses = self.get_marked_verses(wav, entry.book)
+
+            # Chapter and verses are encoded into every rendition, the tool splits chapters without markers
+            renditions = len(get_renditions())
+            cost = estimate_cost(
+                tool_calls=(2 if verses else 4) + 2 * (renditions - 1),
+                audio_seconds=audio_seconds(wav, entry.size) * 2 * renditions,
+                copy_bytes=entry.size * 3
+            )
 
-            # Copy source file to temp dir
-            logging.debug(f'Copying file {src_file} to {target_file}')
-            target_file.write_bytes(src_file.read_bytes())
+            # A chapter without published verses is a new upload, the others reconcile the published verses
+            remote_dir = self.__ftp_dir.joinpath(entry.lang, entry.resource, entry.book, entry.chapter, "CONTENTS")
+            urgent = check_dir_empty(remote_dir.joinpath("wav", "verse"))
+
+            # Staged chapter, split verses and their copies for the encoder
+            job = Job(f'chapter {entry.path}', partial(self.process_chapter, entry), scope=entry.key,
+                      scratch_size=entry.size * 3, cost=cost, fingerprint=f'{entry.size}:{entry.mtime_ns}',
+                      urgent=urgent)
+            if describe:
+                self.describe_job(entry, verses, job)
+            jobs.append(job)
+
+        return jobs
+
+    def has_renditions(self, entry: CatalogEntry) -> bool:
+        """ Check if the chapter mp3 file exists in every rendition, e.g. a rendition has been added since
+        the chapter was processed """
+
+        remote_dir = self.__ftp_dir.joinpath(entry.lang, entry.resource, entry.book, entry.chapter, "CONTENTS")
+
+        return all(
+            self.__catalog.exists(remote_file_path(entry.path, remote_dir, 'mp3', entry.grouping, r.quality))
+            for r in get_renditions()[1:]
+        )
+
+    @staticmethod
+    def get_marked_verses(wav: Optional[WavInfo], book: str) -> List[str]:
+        """ Labels of the verses the chapter is split into natively, empty if the tool splits it """
+
+        if wav is None:
+            return []
+
+        verse_width = 3 if book == 'psa' else 2
+        return [label for label, _, _ in get_verses(wav, verse_width)]
+
+    def describe_job(self, entry: CatalogEntry, verses: List[str], job: Job):
+        """ Find the resources the chapter job would create or delete.
+        A new chapter always replaces the resources published from it, a published chapter only if
+        its split verses differ from the published ones (these are conditional).
+        Verses of chapters without markers are only known after the tool has split them """
+
+        remote_dir = self.__ftp_dir.joinpath(entry.lang, entry.resource, entry.book, entry.chapter, "CONTENTS")
+        grouping = entry.grouping
+
+        is_new = check_dir_empty(remote_dir.joinpath("wav", "verse"))
+
+        cleaned = self.find_cleaned_resources(entry.lang, entry.resource, entry.book, entry.chapter)
+        job.planned_deleted += cleaned
+        self.plan_created(job, not is_new, remote_dir.joinpath("wav", "verse"))
+        if not is_new:
+            job.planned_conditional.update(cleaned)
+
+        renditions = get_renditions()[1:]
+
+        # Existing files are created again only if they are deleted by the cleaning
+        verse_files = [entry.path.with_name(f'{entry.path.stem}_v{label}.wav') for label in verses]
+        for f in verse_files:
+            base_exists = check_file_exists(f, remote_dir, 'mp3') or check_file_exists(f, remote_dir, 'cue')
+            self.plan_created(job, base_exists and not is_new,
+                              remote_file_path(f, remote_dir, 'mp3'), remote_file_path(f, remote_dir, 'cue'))
+            for r in renditions:
+                self.plan_created(job, check_file_exists(f, remote_dir, 'mp3', quality=r.quality) and not is_new,
+                                  remote_file_path(f, remote_dir, 'mp3', quality=r.quality))
+
+        chapter_mp3_exists = check_file_exists(entry.path, remote_dir, 'mp3', grouping)
+        chapter_cue_exists = check_file_exists(entry.path, remote_dir, 'cue', grouping)
+        self.plan_created(job, (chapter_mp3_exists or chapter_cue_exists) and not is_new,
+                          remote_file_path(entry.path, remote_dir, 'mp3', grouping),
+                          remote_file_path(entry.path, remote_dir, 'cue', grouping))
+        for r in renditions:
+            self.plan_created(job, check_file_exists(entry.path, remote_dir, 'mp3', grouping, r.quality) and not is_new,
+                              remote_file_path(entry.path, remote_dir, 'mp3', grouping, r.quality))
+
+    @staticmethod
+    def plan_created(job: Job, conditional: bool, *paths: Path):
+        job.planned_created += paths
+        if conditional:
+            job.planned_conditional.update(paths)
+
+    def find_cleaned_resources(self, lang, resource, book, chapter) -> List[Path]:
+        """ Existing resources the cleaning of a new or updated chapter deletes """
 
-            # Try to fix wav metadata
-            logging.debug(f'Fixing metadata: {target_file}')
-            fix_metadata(target_file, self.verbose)
+        remote_book_dir = self.__ftp_dir.joinpath(lang, resource, book, "CONTENTS")
+        remote_chapter_dir = self.__ftp_dir.joinpath(lang, resource, book, chapter, "CONTENTS")
+        book_name_tr = f'{lang}_{resource}_{book}.tr'
+        chapter_name_tr = f'{lang}_{resource}_{book}_c{chapter}.tr'
 
-            # Split chapter files into verses
+        qualities = _published_qualities()
+
+        paths = [remote_chapter_dir.joinpath("mp3", q, "chapter") for q in qualities]
+        paths.append(remote_chapter_dir.joinpath("cue", "chapter"))
+        paths.append(remote_chapter_dir.joinpath("wav", "verse"))
+        paths += [remote_chapter_dir.joinpath("mp3", q, "verse") for q in qualities]
+        paths.append(remote_chapter_dir.joinpath("cue", "verse"))
+        paths.append(remote_book_dir.joinpath("tr", "wav", "verse", book_name_tr))
+        paths += [remote_book_dir.joinpath("tr", "mp3", q, "verse", book_name_tr) for q in qualities]
+        paths.append(remote_chapter_dir.joinpath("tr", "wav", "verse", chapter_name_tr))
+        paths += [remote_chapter_dir.joinpath("tr", "mp3", q, "verse", chapter_name_tr) for q in qualities]
+
+        return [p for p in paths if path_exists(p)]
+
+    def finish(self, jobs: List[Job]):
+        """ Collect reports of the finished jobs """
+
+        merge_reports(jobs, self.resources_created, self.resources_deleted, self.errors, self.metadata_fixed)
+
+    def process_chapter(self, entry: CatalogEntry, job: Job):
+        """ Split and convert chapter file """
+
+        src_file = entry.path
+
+        lang = entry.lang
+        resource = entry.resource
+        book = entry.book
+        chapter = entry.chapter
+        grouping = entry.grouping
+
+        target_dir = job.scratch_dir.joinpath(grouping)
+        remote_dir = self.__ftp_dir.joinpath(lang, resource, book, chapter, "CONTENTS")
+        verses_dir = target_dir.joinpath("verses")
+        verses_dir.mkdir(parents=True, exist_ok=True)
+        target_file = target_dir.joinpath(src_file.name)
+
+        logging.debug(f'Found chapter file: {src_file}')
+        digest = file_digest(src_file) if self.__state is not None else None
+
+        # Split chapter file into verses at its markers, reading the source file in place if its metadata is valid.
+        # Otherwise the verses are split from the fixed copy, so they don't carry the invalid metadata
+        try:
+            problem = check_metadata(src_file)
+        except OSError as e:
+            problem = str(e)
+
+        split_file = src_file
+        if problem is not None:
+            self.stage_chapter(src_file, target_file, job)
+            split_file = target_file
+
+        logging.debug(f'Splitting chapter {split_file} into {verses_dir}')
+        if not self.split_verses(split_file, verses_dir, book):
+            # Let the tool split the fixed copy of the chapter
+            self.stage_chapter(src_file, target_file, job)
             logging.debug(f'Splitting chapter {target_file} into {verses_dir}')
             split_chapter(target_file, verses_dir, self.verbose)
 
-            target_verse_dir = remote_dir.joinpath("wav", "verse")
+        target_verse_dir = remote_dir.joinpath("wav", "verse")
 
-            is_new = check_dir_empty(target_verse_dir)
-            is_changed = has_new_files(verses_dir, target_verse_dir)
+        is_new = check_dir_empty(target_verse_dir)
+        is_changed = has_new_files(verses_dir, target_verse_dir)
 
-            cleaning = is_new or is_changed
+        cleaning = is_new or is_changed
 
-            # If we have a new or updated chapter WAV file
-            # delete all the chapter related resources:
-            # split verses, converted files and TR files
-            if cleaning:
+        # If we have a new or updated chapter WAV file
+        # delete all the chapter related resources:
+        # split verses, converted files and TR files
+        if cleaning:
+            # Chapters of the same book can be processed in parallel
+            # and share book TR files
+            with self.__lock:
                 # Delete related chapter files
-                self.delete_chapter_files(lang, resource, book, chapter)
+                self.delete_chapter_files(lang, resource, book, chapter, job)
 
                 # Delete related verse files
-                self.delete_verse_files(lang, resource, book, chapter)
+                self.delete_verse_files(lang, resource, book, chapter, job)
 
                 # Delete related book TR files
-                self.delete_tr_book_files(lang, resource, book)
+                self.delete_tr_book_files(lang, resource, book, job)
 
                 # Delete related chapter TR files
-                self.delete_tr_chapter_files(lang, resource, book, chapter)
+                self.delete_tr_chapter_files(lang, resource, book, chapter, job)
 
-            # Copy original verse files
-            logging.debug(
-                f'Copying original verse files from {verses_dir} into {remote_dir}'
-            )
-            t_dir = copy_dir(verses_dir, remote_dir)
-            if cleaning:
-                self.resources_created.append(str(rel_path(t_dir, self.__ftp_dir)))
+        # Copy original verse files
+        logging.debug(
+            f'Copying original verse files from {verses_dir} into {remote_dir}'
+        )
+        t_dir = copy_dir(verses_dir, remote_dir)
+        if t_dir is not None:
+            for f in t_dir.iterdir():
+                self.__catalog.add(f)
+        if cleaning:
+            job.resources_created.append(str(rel_path(t_dir, self.__ftp_dir)))
 
-            # Convert chapter into mp3
-            self.convert_chapter(target_file, remote_dir, grouping)
+            # Remember digests of the published verses, so they are not read back next time
+            if t_dir is not None:
+                record_digests(verses_dir, t_dir)
 
-            # Convert verses into mp3
-            self.convert_verses(verses_dir, remote_dir)
+        # Convert chapter into mp3 while the verses are being converted
+        chapter_conversion = self.convert_chapter(src_file, target_file, remote_dir, grouping, job)
 
-        logging.debug(f'Deleting temporary directory {self.__temp_dir}')
-        rm_tree(self.__temp_dir)
+        # Convert verses into mp3
+        self.convert_verses(verses_dir, remote_dir, job)
 
-        logging.debug('Chapter worker finished!')
+        self.publish_chapter(chapter_conversion, target_file, remote_dir, grouping, job)
+
+        if self.__state is not None:
+            outputs = self.find_chapter_outputs(target_file, verses_dir, remote_dir, grouping)
+            self.__state.record(src_file, entry.size, entry.mtime_ns, outputs, digest)
+
+    def split_verses(self, chapter_file: Path, verses_dir: Path, book: str) -> bool:
+        """ Split chapter file natively. Returns False if it has no verse markers """
+
+        verse_width = 3 if book == 'psa' else 2
+
+        try:
+            with get_metrics().timer('operation', operation='split_wav'):
+                verse_files = split_wav(chapter_file, verses_dir, verse_width)
+        except (RiffError, ValueError, OSError) as e:
+            logging.debug(f'Could not split {chapter_file}: {e}')
+            verse_files = []
+
+        if len(verse_files) == 0:
+            # Leave no partial results for the tool
+            for f in verses_dir.iterdir():
+                f.unlink()
+            return False
+
+        return True
 
-    def convert_chapter(self, chapter_file: Path, remote_dir: Path, grouping: str):
-        """ Convert chapter wav file and copy to remote directory"""
+    def stage_chapter(self, src_file: Path, target_file: Path, job: Job):
+        """ Copy chapter file to temp dir and fix its metadata, if it's not valid """
+
+        if target_file.exists():
+            return
+
+        logging.debug(f'Staging file {src_file} to {target_file}')
+        problem = stage_wav_file(src_file, target_file, self.verbose)
+        if problem is not None:
+            job.metadata_fixed.append(f'{rel_path(src_file, self.__ftp_dir)}: {problem}')
+
+    def convert_chapter(self, src_file: Path, chapter_file: Path, remote_dir: Path, grouping: str, job: Job) \
+            -> Optional[ChapterConversion]:
+        """ Start converting chapter wav file into the renditions that don't exist remotely.
+        Returns None if all the converted files exist remotely """
 
         # Check if filed exist remotely
         chapter_mp3_exists = check_file_exists(chapter_file, remote_dir, 'mp3', grouping)
         chapter_cue_exists = check_file_exists(chapter_file, remote_dir, 'cue', grouping)
+        base_exists = chapter_mp3_exists or chapter_cue_exists
+
+        renditions = {
+            r: [chapter_file] for r in get_renditions()[1:]
+            if not check_file_exists(chapter_file, remote_dir, 'mp3', grouping, r.quality)
+        }
+
+        if base_exists and len(renditions) == 0:
+            logging.debug('Files exist. Skipping...')
+            return None
+
+        self.stage_chapter(src_file, chapter_file, job)
 
-        if not chapter_mp3_exists and not chapter_cue_exists:
+        base = None
+        if not base_exists:
             logging.debug(f'Converting chapter: {chapter_file}')
-            convert_to_mp3(chapter_file, self.verbose)
+            base = start_convert_to_mp3(chapter_file, self.verbose)
+
+        return ChapterConversion(base, renditions, start_encode_renditions(renditions, self.verbose))
+
+    def publish_chapter(self, conversion: Optional[ChapterConversion], chapter_file: Path, remote_dir: Path,
+                        grouping: str, job: Job):
+        """ Wait for chapter conversion and copy converted files to remote directory """
+
+        if conversion is None:
+            return
+
+        if conversion.base is not None:
+            wait_convert_to_mp3(conversion.base, chapter_file)
 
             # Copy converted chapter files
             mp3_file = chapter_file.with_suffix('.mp3')
@@ -124,7 +372,8 @@ class ChapterWorker:
                     f'Copying chapter mp3 {mp3_file} into {remote_dir}'
                 )
                 m_file = copy_file(mp3_file, remote_dir, grouping)
-                self.resources_created.append(str(rel_path(m_file, self.__ftp_dir)))
+                self.__catalog.add(m_file)
+                job.resources_created.append(str(rel_path(m_file, self.__ftp_dir)))
 
             cue_file = chapter_file.with_suffix('.cue')
             if cue_file.exists():
@@ -132,17 +381,26 @@ class ChapterWorker:
                     f'Copying chapter cue {cue_file} into {remote_dir}'
                 )
                 c_file = copy_file(cue_file, remote_dir, grouping)
-                self.resources_created.append(str(rel_path(c_file, self.__ftp_dir)))
-        else:
-            logging.debug('Files exist. Skipping...')
+                self.__catalog.add(c_file)
+                job.resources_created.append(str(rel_path(c_file, self.__ftp_dir)))
 
-    def convert_verses(self, verses_dir: Path, remote_dir: Path):
-        """ Convert verse wav file and copy to remote directory """
+        for future in conversion.futures:
+            wait_tool(future)
+        self.publish_renditions(conversion.renditions, remote_dir, grouping, job)
 
-        for f in verses_dir.iterdir():
+    def convert_verses(self, verses_dir: Path, remote_dir: Path, job: Job):
+        """ Convert verse wav files into the renditions missing remotely and copy them to remote directory """
+
+        pending = []
+        renditions: Dict[Rendition, List[Path]] = {r: [] for r in get_renditions()[1:]}
+        for f in sorted(verses_dir.iterdir()):
             if f.is_dir():
                 continue
 
+            for r in renditions:
+                if not check_file_exists(f, remote_dir, 'mp3', quality=r.quality):
+                    renditions[r].append(f)
+
             mp3_exists = check_file_exists(f, remote_dir, 'mp3')
             cue_exists = check_file_exists(f, remote_dir, 'cue')
 
@@ -150,9 +408,25 @@ class ChapterWorker:
                 logging.debug('Files exist. Skipping...')
                 continue
 
-            logging.debug(f'Converting file: {f}')
-            convert_to_mp3(f, self.verbose)
+            pending.append(f)
+
+        # Other renditions are encoded while the base rendition is being converted
+        futures = start_encode_renditions(renditions, self.verbose)
 
+        if len(pending) > 0:
+            self.publish_verses(pending, remote_dir, job)
+
+        for future in futures:
+            wait_tool(future)
+        self.publish_renditions(renditions, remote_dir, 'verse', job)
+
+    def publish_verses(self, pending: List[Path], remote_dir: Path, job: Job):
+        """ Convert verse wav files with a single tool call and copy them to remote directory """
+
+        logging.debug(f'Converting {len(pending)} verse files')
+        staged_files = convert_to_mp3_batch(pending, job.scratch_dir.joinpath('encode'), self.verbose)
+
+        for f in staged_files:
             # Copy converted verse files
             mp3_file = f.with_suffix('.mp3')
             if mp3_file.exists():
@@ -160,111 +434,149 @@ class ChapterWorker:
                     f'Copying verse mp3 {mp3_file} into {remote_dir}'
                 )
                 m_file = copy_file(mp3_file, remote_dir)
-                self.resources_created.append(str(rel_path(m_file, self.__ftp_dir)))
+                self.__catalog.add(m_file)
+                job.resources_created.append(str(rel_path(m_file, self.__ftp_dir)))
 
             cue_file = f.with_suffix('.cue')
             if cue_file.exists():
                 logging.debug(
-                    f'Copying verse cue {mp3_file} into {remote_dir}'
+                    f'Copying verse cue {cue_file} into {remote_dir}'
                 )
                 c_file = copy_file(cue_file, remote_dir)
-                self.resources_created.append(str(rel_path(c_file, self.__ftp_dir)))
+                self.__catalog.add(c_file)
+                job.resources_created.append(str(rel_path(c_file, self.__ftp_dir)))
 
-    def delete_tr_book_files(self, lang, resource, book):
+    def publish_renditions(self, renditions: Dict[Rendition, List[Path]], remote_dir: Path, grouping: str,
+                           job: Job):
+        """ Copy encoded renditions of the wav files to their remote directories """
+
+        for r, files in renditions.items():
+            for f in files:
+                mp3_file = rendition_file(f, r)
+                if not mp3_file.exists():
+                    continue
+
+                logging.debug(
+                    f'Copying {r.quality} mp3 {mp3_file} into {remote_dir}'
+                )
+                m_file = copy_file(mp3_file, remote_dir, grouping, r.quality)
+                self.__catalog.add(m_file)
+                job.resources_created.append(str(rel_path(m_file, self.__ftp_dir)))
+
+    def find_chapter_outputs(self, chapter_file: Path, verses_dir: Path, remote_dir: Path, grouping: str) -> List[Path]:
+        """ Find remote files that have been produced from the chapter file """
+
+        renditions = get_renditions()[1:]
+
+        outputs = [
+            remote_file_path(chapter_file, remote_dir, 'mp3', grouping),
+            remote_file_path(chapter_file, remote_dir, 'cue', grouping)
+        ]
+        outputs += [remote_file_path(chapter_file, remote_dir, 'mp3', grouping, r.quality) for r in renditions]
+
+        for f in verses_dir.iterdir():
+            if f.is_dir():
+                continue
+
+            outputs.append(remote_file_path(f, remote_dir, 'wav'))
+            outputs.append(remote_file_path(f, remote_dir, 'mp3'))
+            outputs.append(remote_file_path(f, remote_dir, 'cue'))
+            outputs += [remote_file_path(f, remote_dir, 'mp3', quality=r.quality) for r in renditions]
+
+        return [o for o in outputs if self.__catalog.exists(o)]
+
+    def delete_tr_book_files(self, lang, resource, book, job: Job):
         """ Delete tr files of the specified book """
 
         remote_book_dir = self.__ftp_dir.joinpath(lang, resource, book, "CONTENTS")
         book_name_tr = f'{lang}_{resource}_{book}.tr'
 
         wav_book_tr = remote_book_dir.joinpath("tr", "wav", "verse", book_name_tr)
-        if wav_book_tr.exists():
-            wav_book_tr.unlink()
-            self.resources_deleted.append(str(rel_path(wav_book_tr, self.__ftp_dir)))
-
-        mp3_hi_book_tr = remote_book_dir.joinpath("tr", "mp3", "hi", "verse", book_name_tr)
-        if mp3_hi_book_tr.exists():
-            mp3_hi_book_tr.unlink()
-            self.resources_deleted.append(str(rel_path(mp3_hi_book_tr, self.__ftp_dir)))
-
-        mp3_low_book_tr = remote_book_dir.joinpath("tr", "mp3", "low", "verse", book_name_tr)
-        if mp3_low_book_tr.exists():
-            mp3_low_book_tr.unlink()
-            self.resources_deleted.append(str(rel_path(mp3_low_book_tr, self.__ftp_dir)))
-
-    def delete_tr_chapter_files(self, lang, resource, book, chapter):
+        if path_exists(wav_book_tr):
+            remove_file(wav_book_tr)
+            self.__catalog.discard(wav_book_tr)
+            job.resources_deleted.append(str(rel_path(wav_book_tr, self.__ftp_dir)))
+
+        for quality in _published_qualities():
+            mp3_book_tr = remote_book_dir.joinpath("tr", "mp3", quality, "verse", book_name_tr)
+            if path_exists(mp3_book_tr):
+                remove_file(mp3_book_tr)
+                self.__catalog.discard(mp3_book_tr)
+                job.resources_deleted.append(str(rel_path(mp3_book_tr, self.__ftp_dir)))
+
+    def delete_tr_chapter_files(self, lang, resource, book, chapter, job: Job):
         """ Delete tr files of the specified chapter """
 
         remote_chapter_dir = self.__ftp_dir.joinpath(lang, resource, book, chapter, "CONTENTS")
         chapter_name_tr = f'{lang}_{resource}_{book}_c{chapter}.tr'
 
         wav_chapter_tr = remote_chapter_dir.joinpath("tr", "wav", "verse", chapter_name_tr)
-        if wav_chapter_tr.exists():
-            wav_chapter_tr.unlink()
-            self.resources_deleted.append(str(rel_path(wav_chapter_tr, self.__ftp_dir)))
-
-        mp3_hi_chapter_tr = remote_chapter_dir.joinpath("tr", "mp3", "hi", "verse", chapter_name_tr)
-        if mp3_hi_chapter_tr.exists():
-            mp3_hi_chapter_tr.unlink()
-            self.resources_deleted.append(str(rel_path(mp3_hi_chapter_tr, self.__ftp_dir)))
+        if path_exists(wav_chapter_tr):
+            remove_file(wav_chapter_tr)
+            self.__catalog.discard(wav_chapter_tr)
+            job.resources_deleted.append(str(rel_path(wav_chapter_tr, self.__ftp_dir)))
 
-        mp3_low_chapter_tr = remote_chapter_dir.joinpath("tr", "mp3", "low", "verse", chapter_name_tr)
-        if mp3_low_chapter_tr.exists():
-            mp3_low_chapter_tr.unlink()
-            self.resources_deleted.append(str(rel_path(mp3_low_chapter_tr, self.__ftp_dir)))
+        for quality in _published_qualities():
+            mp3_chapter_tr = remote_chapter_dir.joinpath("tr", "mp3", quality, "verse", chapter_name_tr)
+            if path_exists(mp3_chapter_tr):
+                remove_file(mp3_chapter_tr)
+                self.__catalog.discard(mp3_chapter_tr)
+                job.resources_deleted.append(str(rel_path(mp3_chapter_tr, self.__ftp_dir)))
 
-    def delete_chapter_files(self, lang, resource, book, chapter):
-        """ Delete chapter related files (mp3 and cue) """
+    def delete_chapter_files(self, lang, resource, book, chapter, job: Job):
+        """ Delete chapter related files (mp3 of every quality and cue) """
 
         remote_chapter_dir = self.__ftp_dir.joinpath(lang, resource, book, chapter, "CONTENTS")
 
-        mp3_hi_chapter_dir = remote_chapter_dir.joinpath("mp3", "hi", "chapter")
-        if mp3_hi_chapter_dir.exists():
-            rm_tree(mp3_hi_chapter_dir)
-            self.resources_deleted.append(str(rel_path(mp3_hi_chapter_dir, self.__ftp_dir)))
-
-        mp3_low_chapter_dir = remote_chapter_dir.joinpath("mp3", "low", "chapter")
-        if mp3_low_chapter_dir.exists():
-            rm_tree(mp3_low_chapter_dir)
-            self.resources_deleted.append(str(rel_path(mp3_low_chapter_dir, self.__ftp_dir)))
+        for quality in _published_qualities():
+            mp3_chapter_dir = remote_chapter_dir.joinpath("mp3", quality, "chapter")
+            if path_exists(mp3_chapter_dir):
+                rm_tree(mp3_chapter_dir)
+                self.__catalog.discard_tree(mp3_chapter_dir)
+                job.resources_deleted.append(str(rel_path(mp3_chapter_dir, self.__ftp_dir)))
 
         cue_chapter_dir = remote_chapter_dir.joinpath("cue", "chapter")
-        if cue_chapter_dir.exists():
+        if path_exists(cue_chapter_dir):
             rm_tree(cue_chapter_dir)
-            self.resources_deleted.append(str(rel_path(cue_chapter_dir, self.__ftp_dir)))
+            self.__catalog.discard_tree(cue_chapter_dir)
+            job.resources_deleted.append(str(rel_path(cue_chapter_dir, self.__ftp_dir)))
 
-    def delete_verse_files(self, lang, resource, book, chapter):
-        """ Delete verse related files (wav, mp3, cue) """
+    def delete_verse_files(self, lang, resource, book, chapter, job: Job):
+        """ Delete verse related files (wav, mp3 of every quality, cue) """
 
         remote_chapter_dir = self.__ftp_dir.joinpath(lang, resource, book, chapter, "CONTENTS")
 
         wav_verse_files = remote_chapter_dir.joinpath("wav", "verse")
-        if wav_verse_files.exists():
+        if path_exists(wav_verse_files):
             rm_tree(wav_verse_files)
-            self.resources_deleted.append(str(rel_path(wav_verse_files, self.__ftp_dir)))
-
-        mp3_hi_verse_dir = remote_chapter_dir.joinpath("mp3", "hi", "verse")
-        if mp3_hi_verse_dir.exists():
-            rm_tree(mp3_hi_verse_dir)
-            self.resources_deleted.append(str(rel_path(mp3_hi_verse_dir, self.__ftp_dir)))
+            self.__catalog.discard_tree(wav_verse_files)
+            job.resources_deleted.append(str(rel_path(wav_verse_files, self.__ftp_dir)))
 
-        mp3_low_verse_dir = remote_chapter_dir.joinpath("mp3", "low", "verse")
-        if mp3_low_verse_dir.exists():
-            rm_tree(mp3_low_verse_dir)
-            self.resources_deleted.append(str(rel_path(mp3_low_verse_dir, self.__ftp_dir)))
+        for quality in _published_qualities():
+            mp3_verse_dir = remote_chapter_dir.joinpath("mp3", quality, "verse")
+            if path_exists(mp3_verse_dir):
+                rm_tree(mp3_verse_dir)
+                self.__catalog.discard_tree(mp3_verse_dir)
+                job.resources_deleted.append(str(rel_path(mp3_verse_dir, self.__ftp_dir)))
 
         cue_verse_dir = remote_chapter_dir.joinpath("cue", "verse")
-        if cue_verse_dir.exists():
+        if path_exists(cue_verse_dir):
             rm_tree(cue_verse_dir)
-            self.resources_deleted.append(str(rel_path(cue_verse_dir, self.__ftp_dir)))
+            self.__catalog.discard_tree(cue_verse_dir)
+            job.resources_deleted.append(str(rel_path(cue_verse_dir, self.__ftp_dir)))
 
     def get_report(self) -> Dict[str, list]:
         report = {
             "resources_created": self.resources_created,
-            "resources_deleted": self.resources_deleted
+            "resources_deleted": self.resources_deleted,
+            "metadata_fixed": self.metadata_fixed,
+            "errors": self.errors
         }
         return report
 
     def clear_report(self):
         self.resources_created.clear()
         self.resources_deleted.clear()
+        self.metadata_fixed.clear()
+        self.errors.clear()
 
@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import os
+import shutil
+from pathlib import Path
+from tempfile import mkdtemp
+from threading import Lock
+from time import time
+from typing import Dict, List, Tuple
+
+from file_utils import file_digest, stage_file
+from metrics import get_metrics
+
+# Files the encoder writes next to the wav file
+CONVERTED_SUFFIXES = ('.mp3', '.cue')
+
+KEY_MEMO_SIZE = 4096
+
+
+class ConversionCache:
+    """ Local store of converted files (mp3 and cue), keyed by the digest of the wav file
+    (after its metadata has been fixed), its name and the encoder version and settings.
+    A chapter that is split again into the same verses gets its mp3 files from the cache
+    instead of the encoder. The least recently used entries are evicted when the cache
+    grows over its size """
+
+    def __init__(self, directory: Path, max_size: int, version: str):
+        self.__dir = directory
+        self.__dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.version = version
+
+        self.__lock = Lock()
+        # Entry key: (size, last access)
+        self.__entries: Dict[str, Tuple[int, float]] = {}
+        self.__size = 0
+        # Keys of the recently converted files, so a file is read once: (path, size, mtime): key
+        self.__keys: Dict[Tuple[str, int, int], str] = {}
+
+        self.__load()
+
+    def fetch(self, wav_file: Path, output_file: Path = None) -> bool:
+        """ Put the cached converted files of the wav file next to the output file (the wav file by default).
+        Returns False if they are not cached """
+
+        if output_file is None:
+            output_file = wav_file
+
+        key = self.key(wav_file)
+        entry_dir = self.__entry_dir(key)
+
+        with self.__lock:
+            cached = key in self.__entries
+            if cached:
+                self.__entries[key] = (self.__entries[key][0], time())
+
+        get_metrics().hit('conversion_cache', cached)
+        if not cached:
+            return False
+
+        try:
+            for f in entry_dir.iterdir():
+                stage_file(f, output_file.with_suffix(f.suffix))
+            os.utime(entry_dir)
+        except OSError as e:
+            # Evicted by another process in the meantime
+            logging.debug(f'Could not read cache entry {entry_dir}: {e}')
+            for suffix in CONVERTED_SUFFIXES:
+                output_file.with_suffix(suffix).unlink(missing_ok=True)
+            self.__forget(key)
+            return False
+
+        logging.debug(f'Converted files of {wav_file} have been taken from the cache')
+
+        return True
+
+    def store(self, wav_file: Path, output_file: Path = None):
+        """ Save the converted files of the wav file, found next to the output file (the wav file by default) """
+
+        if output_file is None:
+            output_file = wav_file
+
+        outputs = [output_file.with_suffix(s) for s in CONVERTED_SUFFIXES if output_file.with_suffix(s).exists()]
+        if not any(f.suffix == '.mp3' for f in outputs):
+            return
+
+        key = self.key(wav_file)
+
+        with self.__lock:
+            if key in self.__entries:
+                return
+
+        entry_dir = self.__entry_dir(key)
+        entry_dir.parent.mkdir(parents=True, exist_ok=True)
+
+        # Readers never see a partial entry
+        temp_dir = Path(mkdtemp(prefix='.', suffix='.tmp', dir=entry_dir.parent))
+        try:
+            for f in outputs:
+                stage_file(f, temp_dir.joinpath(f.name))
+            os.rename(temp_dir, entry_dir)
+        except OSError as e:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            if not entry_dir.exists():
+                logging.warning(f'Could not store {wav_file} in the conversion cache: {e}')
+                return
+
+        size = _dir_size(entry_dir)
+        with self.__lock:
+            if key not in self.__entries:
+                self.__entries[key] = (size, time())
+                self.__size += size
+
+        self.__evict()
+
+    def key(self, wav_file: Path) -> str:
+        stat = wav_file.stat()
+        file_key = (str(wav_file), stat.st_size, stat.st_mtime_ns)
+
+        with self.__lock:
+            key = self.__keys.get(file_key)
+        if key is not None:
+            return key
+
+        h = hashlib.sha256()
+        h.update(self.version.encode('utf-8'))
+        h.update(b'\0' + wav_file.stem.encode('utf-8'))
+        h.update(b'\0' + file_digest(wav_file).encode('ascii'))
+        key = h.hexdigest()
+
+        with self.__lock:
+            if len(self.__keys) >= KEY_MEMO_SIZE:
+                self.__keys.clear()
+            self.__keys[file_key] = key
+
+        return key
+
+    def __entry_dir(self, key: str) -> Path:
+        return self.__dir.joinpath(key[:2], key)
+
+    def __load(self):
+        """ Index the entries left by the previous runs, the modification time of an entry is its last access """
+
+        for group in self.__dir.iterdir():
+            if not group.is_dir():
+                continue
+            for entry_dir in group.iterdir():
+                if entry_dir.name.startswith('.'):
+                    # Partial entry of a killed process
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    continue
+                size = _dir_size(entry_dir)
+                self.__entries[entry_dir.name] = (size, entry_dir.stat().st_mtime)
+                self.__size += size
+
+        get_metrics().set('conversion_cache_bytes', self.__size)
+
+    def __evict(self):
+        with self.__lock:
+            evicted: List[str] = []
+            if self.__size > self.max_size:
+                for key, (size, _) in sorted(self.__entries.items(), key=lambda e: e[1][1]):
+                    if self.__size <= self.max_size:
+                        break
+                    evicted.append(key)
+                    self.__size -= size
+                    del self.__entries[key]
+            get_metrics().set('conversion_cache_bytes', self.__size)
+
+        for key in evicted:
+            logging.debug(f'Evicting {key} from the conversion cache')
+            shutil.rmtree(self.__entry_dir(key), ignore_errors=True)
+            get_metrics().inc('conversion_cache_evictions')
+
+    def __forget(self, key: str):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__size -= entry[0]
+
+
+def _dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.iterdir())
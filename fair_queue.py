@@ -0,0 +1,91 @@
+import heapq
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Tuple
+
+from metrics import get_metrics
+
+# Service of a job without an estimated cost, so it still counts for its tenant
+MIN_SERVICE = 0.01
+
+
+class FairQueue:
+    """ Ready jobs queued per tenant (lang, resource) of their scope.
+    New uploads go before reconciliation work. Among the tenants with work of the same class,
+    the one that has received the least service (estimated cost of its started jobs) relative to
+    its weight goes next, so a small delivery is not stuck behind a large one. Languages can be
+    weighted and limited to a number of concurrent jobs. Within a tenant, jobs go in the order
+    of the priority key """
+
+    def __init__(self, priority: Callable[[object], tuple], weights: Dict[str, float] = None,
+                 limits: Dict[str, int] = None):
+        self.__priority = priority
+        self.weights = weights or {}
+        self.limits = limits or {}
+
+        self.__queues: Dict[Tuple[str, ...], List[tuple]] = {}
+        self.__virtual: Dict[Tuple[str, ...], float] = {}
+        self.__clock = 0.0
+        self.__running: Dict[str, int] = {}
+        self.__ready_since: Dict[object, float] = {}
+        self.__size = 0
+
+    def __len__(self):
+        return self.__size
+
+    def push(self, job):
+        """ Queue a job whose dependencies have completed. It's a new upload if any of them is """
+
+        job.urgent = job.urgent or any(d.urgent for d in job.depends_on)
+
+        tenant = _tenant(job)
+        queue = self.__queues.setdefault(tenant, [])
+        if not queue:
+            # An idle tenant doesn't save up service for later
+            self.__virtual[tenant] = max(self.__virtual.get(tenant, 0.0), self.__clock)
+
+        heapq.heappush(queue, ((0 if job.urgent else 1,) + self.__priority(job), job))
+        self.__ready_since[job] = monotonic()
+        self.__size += 1
+
+    def peek(self) -> Optional[object]:
+        """ Next job to start, None if the queue is empty or all the queued languages are at their limit """
+
+        best = None
+        best_key = None
+        for tenant, queue in self.__queues.items():
+            if not queue or self.__at_limit(tenant[0]):
+                continue
+
+            key = (queue[0][0][0], self.__virtual[tenant], tenant)
+            if best_key is None or key < best_key:
+                best = queue[0][1]
+                best_key = key
+
+        return best
+
+    def pop(self, job):
+        """ Start the job returned by peek """
+
+        tenant = _tenant(job)
+        heapq.heappop(self.__queues[tenant])
+        self.__size -= 1
+
+        self.__clock = self.__virtual[tenant]
+        self.__virtual[tenant] += max(job.cost, MIN_SERVICE) / self.weights.get(tenant[0], 1.0)
+        self.__running[tenant[0]] = self.__running.get(tenant[0], 0) + 1
+
+        waited = monotonic() - self.__ready_since.pop(job)
+        get_metrics().set_max('job_wait_seconds_max', waited, priority='new' if job.urgent else 'reconcile')
+
+    def finish(self, job):
+        """ The started job has completed """
+
+        self.__running[_tenant(job)[0]] -= 1
+
+    def __at_limit(self, lang: str) -> bool:
+        limit = self.limits.get(lang)
+        return limit is not None and self.__running.get(lang, 0) >= limit
+
+
+def _tenant(job) -> Tuple[str, ...]:
+    return tuple(job.scope[:2]) if job.scope else ('', '')
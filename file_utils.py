@@ -1,24 +1,156 @@
+import errno
+import fcntl
+import hashlib
+import json
 import logging
+import os
 import re
-import zlib
+from contextlib import contextmanager
 from pathlib import Path
-from tempfile import mkdtemp
+from tempfile import mkstemp
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, List, Optional, Set
 
+from metrics import get_metrics
+from riff import read_wav_info, RiffError
 
-def init_temp_dir() -> Path:
-    path = Path(mkdtemp())
-    return path
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# ioctl to clone a file on copy-on-write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Errors meaning that a copy method is not supported for the given files
+UNSUPPORTED_COPY_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF)
 
 
 def rm_tree(path):
+    _rm_tree(path)
+
+    if _destination_view is not None:
+        _destination_view.discard(path)
+
+
+def _rm_tree(path):
     for child in path.iterdir():
         if child.is_file():
             child.unlink()
         else:
-            rm_tree(child)
+            _rm_tree(child)
     path.rmdir()
 
 
+class DestinationView:
+    """ Listings of the remote directories, each read once with scandir and kept up to date with the files
+    this process creates and deletes, so existence checks cost a round trip to the (network) file system
+    per directory instead of per file. A directory that doesn't exist has an empty listing.
+    Changes made by other processes during the run are not seen """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__listings: Dict[Path, Set[str]] = {}
+
+    def exists(self, path: Path) -> bool:
+        get_metrics().inc('destination_checks')
+
+        listing = self.__listing(path.parent)
+        with self.__lock:
+            return path.name in listing
+
+    def is_empty(self, directory: Path) -> bool:
+        """ Check if the directory has no visible files or doesn't exist """
+
+        get_metrics().inc('destination_checks')
+
+        listing = self.__listing(directory)
+        with self.__lock:
+            return not any(not name.startswith('.') for name in listing)
+
+    def add(self, path: Path):
+        """ The file (or directory) has been created, along with its missing parent directories """
+
+        with self.__lock:
+            while path.parent != path:
+                listing = self.__listings.get(path.parent)
+                if listing is not None:
+                    if path.name in listing:
+                        break
+                    listing.add(path.name)
+                path = path.parent
+
+    def discard(self, path: Path):
+        """ The file or directory tree has been deleted """
+
+        with self.__lock:
+            listing = self.__listings.get(path.parent)
+            if listing is not None:
+                listing.discard(path.name)
+
+            for directory in [d for d in self.__listings if d == path or path in d.parents]:
+                self.__listings[directory] = set()
+
+    def __listing(self, directory: Path) -> Set[str]:
+        with self.__lock:
+            listing = self.__listings.get(directory)
+        if listing is not None:
+            return listing
+
+        try:
+            with os.scandir(directory) as entries:
+                names = {e.name for e in entries}
+        except (FileNotFoundError, NotADirectoryError):
+            names = set()
+        get_metrics().inc('destination_listings')
+
+        with self.__lock:
+            return self.__listings.setdefault(directory, names)
+
+
+_destination_view: Optional[DestinationView] = None
+
+
+@contextmanager
+def destination_view():
+    """ Answer the existence checks of the remote files from a DestinationView until the end of the block.
+    A view that is already in use is kept """
+
+    global _destination_view
+    if _destination_view is not None:
+        yield _destination_view
+        return
+
+    _destination_view = DestinationView()
+    try:
+        yield _destination_view
+    finally:
+        _destination_view = None
+
+
+def path_exists(path: Path) -> bool:
+    """ Check if the remote file or directory exists """
+
+    if _destination_view is not None:
+        return _destination_view.exists(path)
+
+    return path.exists()
+
+
+def remove_file(path: Path):
+    """ Delete the remote file """
+
+    path.unlink()
+
+    if _destination_view is not None:
+        _destination_view.discard(path)
+
+
+def record_created(path: Path):
+    """ The remote file has been created by other means than copy_file """
+
+    if _destination_view is not None:
+        _destination_view.add(path)
+
+
 def copy_dir(src_dir: Path, target_dir: Path, grouping='verse', quality='hi', media=None) -> Path:
     """ Iterate src_dir to copy files """
 
@@ -56,9 +188,13 @@ def copy_file(src_file: Path, target_dir: Path, grouping='verse', quality='hi',
 
     logging.debug(f'Copying file: {src_file} to {t_file}')
 
-    if not t_file.exists():
-        t_dir.mkdir(parents=True, exist_ok=True)
-        t_file.write_bytes(src_file.read_bytes())
+    if not path_exists(t_file):
+        if _destination_view is None or not _destination_view.exists(t_dir):
+            t_dir.mkdir(parents=True, exist_ok=True)
+        started = monotonic()
+        copied = publish_file(src_file, t_file)
+        record_copy('publish', 'copy', copied, started)
+        record_created(t_file)
         logging.debug('Copied successfully!')
     else:
         logging.debug('File exists, skipping...')
@@ -66,8 +202,193 @@ def copy_file(src_file: Path, target_dir: Path, grouping='verse', quality='hi',
     return t_file
 
 
-def check_file_exists(file: Path, remote_dir: Path, media: str, grouping='verse', quality='hi') -> bool:
-    """ Check if converted version of the source file exists in remote directory """
+def fast_copy(src_file: Path, dst_file: Path) -> int:
+    """ Copy file content in the kernel (copy_file_range, sendfile),
+    falling back to a chunked copy. Returns the number of copied bytes """
+
+    with src_file.open('rb') as src, dst_file.open('wb') as dst:
+        return _copy_fd(src.fileno(), dst.fileno(), 0)
+
+
+def publish_file(src_file: Path, dst_file: Path) -> int:
+    """ Copy the file into a hidden temporary file next to the destination and rename it,
+    so the destination is either missing or complete, even if the process is killed.
+    Returns the number of copied bytes """
+
+    fd, temp_file = mkstemp(prefix=f'.{dst_file.name}.', suffix='.tmp', dir=dst_file.parent)
+
+    try:
+        try:
+            os.fchmod(fd, 0o644)
+            with src_file.open('rb') as src:
+                copied = _copy_fd(src.fileno(), fd, 0)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.replace(temp_file, dst_file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+    return copied
+
+
+def find_temp_files(directory: Path) -> List[Path]:
+    """ Find hidden temporary files of publishes, digest manifests and TR files """
+
+    return [
+        Path(root, name)
+        for root, _, files in os.walk(directory)
+        for name in files
+        if name.startswith('.') and name.endswith('.tmp')
+    ]
+
+
+def remove_temp_files(directory: Path, max_age: float) -> List[Path]:
+    """ Delete hidden temporary files (of publishes, digest manifests and TR files) that haven't been written
+    for max_age seconds, left behind by a killed process """
+
+    removed = []
+    now = time()
+
+    for path in find_temp_files(directory):
+        try:
+            if now - path.stat().st_mtime < max_age:
+                continue
+            path.unlink()
+        except FileNotFoundError:
+            continue
+
+        logging.debug(f'Removed partial file {path}')
+        removed.append(path)
+
+    return removed
+
+
+def copy_into(src_file: Path, out_fd: int, out_offset: int, offset=0, length=None) -> int:
+    """ Copy file content (or length bytes from offset) into the open file at out_offset.
+    Returns the number of copied bytes """
+
+    with src_file.open('rb') as src:
+        return _copy_fd(src.fileno(), out_fd, out_offset, offset, length)
+
+
+def stage_file(src_file: Path, dst_file: Path, writable=False):
+    """ Put the source file into the scratch directory as cheap as possible.
+    The staged file is a reflink if the file system supports it, otherwise a hardlink
+    (only if the staged file is not going to be modified) or a copy """
+
+    dst_file.parent.mkdir(parents=True, exist_ok=True)
+    started = monotonic()
+
+    if _reflink(src_file, dst_file):
+        record_copy('stage', 'reflink', 0, started)
+        return
+
+    if not writable:
+        try:
+            os.link(src_file, dst_file)
+            record_copy('stage', 'link', 0, started)
+            return
+        except OSError:
+            pass
+
+    copied = fast_copy(src_file, dst_file)
+    record_copy('stage', 'copy', copied, started)
+
+
+def record_copy(operation: str, method: str, copied: int, started: float):
+    """ Count a copy that has started at the given monotonic time """
+
+    metrics = get_metrics()
+    metrics.add_time('copy', monotonic() - started, operation=operation, method=method)
+    metrics.inc('copy_bytes', copied, operation=operation, method=method)
+
+
+def _reflink(src_file: Path, dst_file: Path) -> bool:
+    try:
+        with src_file.open('rb') as src, dst_file.open('wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        if dst_file.exists():
+            dst_file.unlink()
+        return False
+
+
+def _copy_fd(in_fd: int, out_fd: int, out_offset: int, in_offset=0, length=None) -> int:
+    if length is None:
+        length = os.fstat(in_fd).st_size - in_offset
+
+    copied = _copy_file_range(in_fd, out_fd, length, out_offset, in_offset)
+    if copied is None:
+        copied = _sendfile(in_fd, out_fd, length, out_offset, in_offset)
+    if copied is None:
+        copied = _copy_chunks(in_fd, out_fd, length, out_offset, in_offset)
+
+    return copied
+
+
+def _copy_file_range(in_fd: int, out_fd: int, size: int, out_offset=0, in_offset=0):
+    if not hasattr(os, 'copy_file_range'):
+        return None
+
+    offset = 0
+    try:
+        while offset < size:
+            n = os.copy_file_range(
+                in_fd, out_fd, min(size - offset, COPY_CHUNK_SIZE), in_offset + offset, out_offset + offset
+            )
+            if n == 0:
+                break
+            offset += n
+    except OSError as e:
+        if offset == 0 and e.errno in UNSUPPORTED_COPY_ERRORS:
+            return None
+        raise
+
+    return offset
+
+
+def _sendfile(in_fd: int, out_fd: int, size: int, out_offset=0, in_offset=0):
+    # sendfile writes at the current position of the output file
+    os.lseek(out_fd, out_offset, os.SEEK_SET)
+
+    offset = 0
+    try:
+        while offset < size:
+            n = os.sendfile(out_fd, in_fd, in_offset + offset, min(size - offset, COPY_CHUNK_SIZE))
+            if n == 0:
+                break
+            offset += n
+    except OSError as e:
+        if offset == 0 and e.errno in UNSUPPORTED_COPY_ERRORS:
+            return None
+        raise
+
+    return offset
+
+
+def _copy_chunks(in_fd: int, out_fd: int, size: int, out_offset=0, in_offset=0) -> int:
+    buffer = bytearray(1024 * 1024)
+    view = memoryview(buffer)
+    offset = 0
+
+    while offset < size:
+        n = os.preadv(in_fd, [view[:min(len(buffer), size - offset)]], in_offset + offset)
+        if n == 0:
+            break
+        written = 0
+        while written < n:
+            written += os.pwrite(out_fd, view[written:n], out_offset + offset + written)
+        offset += n
+
+    return offset
+
+
+def remote_file_path(file: Path, remote_dir: Path, media: str, grouping='verse', quality='hi') -> Path:
+    """ Get the path of the converted version of the source file in remote directory """
 
     path_without_extension = file.stem
     path_without_extension = re.sub(r'_t[\d]+$', '', path_without_extension)
@@ -80,36 +401,201 @@ def check_file_exists(file: Path, remote_dir: Path, media: str, grouping='verse'
     else:
         r_dir = remote_dir.joinpath(media, grouping)
 
-    r_file = r_dir.joinpath(f'{path_without_extension}.{media}')
+    return r_dir.joinpath(f'{path_without_extension}.{media}')
+
+
+def check_file_exists(file: Path, remote_dir: Path, media: str, grouping='verse', quality='hi') -> bool:
+    """ Check if converted version of the source file exists in remote directory """
+
+    r_file = remote_file_path(file, remote_dir, media, grouping, quality)
 
     logging.debug(f'Checking file: {r_file}')
 
-    return r_file.exists()
+    return path_exists(r_file)
 
 
 def check_dir_empty(src_dir: Path) -> bool:
     """ Check if directory is empty or doesn't exist """
 
-    return not src_dir.exists() or not any(src_dir.iterdir())
+    if _destination_view is not None:
+        return _destination_view.is_empty(src_dir)
+
+    return not src_dir.exists() or not any(not f.name.startswith('.') for f in src_dir.iterdir())
+
+
+class DigestManifest:
+    """ Sidecar file with digests and sizes of the audio of the files in a directory (see audio_digest).
+    An entry stays valid while size and mtime of the file are unchanged """
+
+    file_name = '.digests.json'
+
+    def __init__(self, directory: Path):
+        self.__directory = directory
+        self.__file = directory.joinpath(self.file_name)
+        self.__entries: Dict[str, dict] = {}
+        self.__dirty = False
+
+        try:
+            data = json.loads(self.__file.read_text())
+            self.__entries = data.get('files', {})
+        except (OSError, ValueError):
+            pass
+
+    def digest(self, file: Path, stat: os.stat_result = None) -> str:
+        """ Get digest of the file from the manifest or calculate it if the file has changed """
+
+        if stat is None:
+            stat = file.stat()
+
+        entry = self.__get_entry(file, stat)
+        get_metrics().hit('digest_manifest', entry is not None and 'audio_digest' in entry)
+        if entry is not None and 'audio_digest' in entry:
+            return entry['audio_digest']
+
+        digest = audio_digest(file)
+        self.record(file, digest, stat)
+        return digest
+
+    def audio_size(self, file: Path, stat: os.stat_result = None) -> int:
+        """ Get size of the audio of the file from the manifest or read it from its header """
+
+        if stat is None:
+            stat = file.stat()
+
+        entry = self.__get_entry(file, stat)
+        if entry is not None and 'audio_size' in entry:
+            return entry['audio_size']
+
+        return audio_size(file)
+
+    def record(self, file: Path, digest: str, stat: os.stat_result = None, size: int = None):
+        """ Save known digest (and audio size) of the file """
+
+        if stat is None:
+            stat = file.stat()
+
+        self.__entries[file.name] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'audio_size': size if size is not None else audio_size(file),
+            'audio_digest': digest
+        }
+        self.__dirty = True
+
+    def __get_entry(self, file: Path, stat: os.stat_result) -> Optional[dict]:
+        # Entries of whole file digests written by older versions have no audio digest
+        entry = self.__entries.get(file.name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            return None
+
+        return entry
+
+    def save(self):
+        if not self.__dirty or not self.__directory.exists():
+            return
+
+        fd, tmp = mkstemp(prefix='.digests-', suffix='.tmp', dir=self.__directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'files': self.__entries}, f)
+        os.replace(tmp, self.__file)
+
+        self.__dirty = False
 
 
 def has_new_files(src_dir: Path, target_dir: Path) -> bool:
-    """ Check if files in target_dir are different than in src_dir """
+    """ Check if files in target_dir are different than in src_dir.
+    Only the audio is compared, files that differ in their metadata are the same.
+    Sizes of the audio are compared first, the audio is hashed only if they are equal """
+
+    manifest = DigestManifest(target_dir)
+
+    try:
+        for s in src_dir.iterdir():
+            s_name = re.sub(r'_t[\d]+.*$', s.suffix, s.name)
+            t = target_dir.joinpath(s_name)
+
+            try:
+                t_stat = t.stat()
+            except FileNotFoundError:
+                return True
+
+            if audio_size(s) != manifest.audio_size(t, t_stat):
+                return True
+
+            if audio_digest(s) != manifest.digest(t, t_stat):
+                return True
+    finally:
+        manifest.save()
+
+    return False
+
+
+def record_digests(src_dir: Path, target_dir: Path):
+    """ Save digests of the files copied from src_dir into the manifest of target_dir,
+    so they don't have to be read back from target_dir """
+
+    manifest = DigestManifest(target_dir)
 
     for s in src_dir.iterdir():
+        if s.is_dir():
+            continue
+
         s_name = re.sub(r'_t[\d]+.*$', s.suffix, s.name)
         t = target_dir.joinpath(s_name)
 
-        if not t.exists():
-            return True
+        try:
+            t_stat = t.stat()
+        except FileNotFoundError:
+            continue
 
-        s_hash = zlib.adler32(s.read_bytes())
-        t_hash = zlib.adler32(t.read_bytes())
+        if s.stat().st_size == t_stat.st_size:
+            manifest.record(t, audio_digest(s), t_stat, audio_size(s))
 
-        if s_hash != t_hash:
-            return True
+    manifest.save()
 
-    return False
+
+def file_digest(file: Path, chunk_size=1024 * 1024) -> str:
+    """ Calculate sha256 digest of the file, reading it in chunks """
+
+    h = hashlib.sha256()
+    with file.open('rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def audio_size(file: Path) -> int:
+    """ Size of the audio (data chunk) of the WAV file, read from its header.
+    Size of the whole file if it isn't a WAV file """
+
+    try:
+        return read_wav_info(file).data_size
+    except RiffError:
+        return file.stat().st_size
+
+
+def audio_digest(file: Path, chunk_size=1024 * 1024) -> str:
+    """ Calculate sha256 digest of the audio (data chunk) of the WAV file,
+    of the whole file if it isn't a WAV file """
+
+    try:
+        wav = read_wav_info(file)
+    except RiffError:
+        return file_digest(file, chunk_size)
+
+    h = hashlib.sha256()
+    with file.open('rb') as f:
+        f.seek(wav.data_offset)
+        remaining = wav.data_size
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+
+    return h.hexdigest()
 
 
 def rel_path(src: Path, root: Path) -> Path:
@@ -0,0 +1,236 @@
+import logging
+import os
+import re
+from enum import Enum
+from pathlib import Path
+from threading import RLock
+from time import monotonic
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from metrics import get_metrics
+
+
+class Kind(Enum):
+    CHAPTER_WAV = 1
+    VERSE_WAV = 2
+    MP3 = 3
+    CUE = 4
+    TR = 5
+
+
+class CatalogEntry(NamedTuple):
+    path: Path
+    kind: Kind
+    lang: str
+    resource: str
+    book: str
+    chapter: Optional[str]
+    media: str
+    quality: str
+    grouping: str
+    size: int
+    mtime_ns: int
+
+    @property
+    def key(self) -> Tuple[str, str, str, Optional[str]]:
+        return self.lang, self.resource, self.book, self.chapter
+
+
+class FtpCatalog:
+    """ Index of the FTP tree, built with a single directory walk """
+
+    chapter_regex = r'_c[\d]+\..*$'
+    verse_regex = r'_c[\d]+_v[\d]+(?:-[\d]+)?(?:_t[\d]+)?\..*$'
+
+    def __init__(self, ftp_dir: Path):
+        self.__ftp_dir = ftp_dir
+        self.__root_len = len(ftp_dir.parts)
+        self.__lock = RLock()
+
+        self.__entries: Dict[Path, CatalogEntry] = {}
+        self.__by_kind: Dict[Kind, Dict[Path, CatalogEntry]] = {k: {} for k in Kind}
+        self.__by_book: Dict[Tuple[str, str, str], Dict[Path, CatalogEntry]] = {}
+
+    @classmethod
+    def scan(cls, ftp_dir: Path, scopes: Iterable[Tuple[str, ...]] = None) -> 'FtpCatalog':
+        """ Walk the FTP tree once and index the files the workers need.
+        Scopes (e.g. (lang, resource, book)) limit the walk to those subtrees """
+
+        logging.debug(f'Scanning FTP directory: {ftp_dir}')
+
+        catalog = cls(ftp_dir)
+        started = monotonic()
+
+        if scopes is None:
+            stack = [str(ftp_dir)]
+        else:
+            stack = [str(ftp_dir.joinpath(*scope)) for scope in sorted(set(scopes))]
+
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        # Skip hidden files (lease files, manifests, partial uploads)
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir():
+                            stack.append(entry.path)
+                        elif entry.is_file():
+                            catalog.__add_entry(Path(entry.path), entry.stat())
+            except OSError as e:
+                logging.warning(f'Could not scan directory {current}: {e}')
+
+        logging.debug(f'Scan finished. Found {len(catalog.__entries)} files')
+
+        metrics = get_metrics()
+        metrics.add_time('scan', monotonic() - started)
+        metrics.inc('scan_files', len(catalog.__entries))
+
+        return catalog
+
+    def add(self, path: Path):
+        """ Register a file that has been created during the run """
+
+        try:
+            stat = path.stat()
+        except OSError:
+            return
+        self.__add_entry(path, stat)
+
+    def discard(self, path: Path):
+        """ Forget a file that has been deleted during the run """
+
+        with self.__lock:
+            entry = self.__entries.pop(path, None)
+            if entry is not None:
+                self.__by_kind[entry.kind].pop(path, None)
+                self.__by_book.get(entry.key[:3], {}).pop(path, None)
+
+    def discard_tree(self, path: Path):
+        """ Forget all the files under a deleted directory """
+
+        with self.__lock:
+            for p in [p for p in self.__entries if p == path or path in p.parents]:
+                self.discard(p)
+
+    def exists(self, path: Path) -> bool:
+        with self.__lock:
+            return path in self.__entries
+
+    def get(self, path: Path) -> Optional[CatalogEntry]:
+        with self.__lock:
+            return self.__entries.get(path)
+
+    def entries(self, kind: Kind, lang=None, resource=None, book=None, chapter=None) -> List[CatalogEntry]:
+        """ Get entries of the given kind, optionally filtered by lang/resource/book/chapter """
+
+        with self.__lock:
+            if lang is not None and resource is not None and book is not None:
+                candidates = [e for e in self.__by_book.get((lang, resource, book), {}).values() if e.kind == kind]
+            else:
+                candidates = list(self.__by_kind[kind].values())
+
+        result = []
+        for e in candidates:
+            if lang is not None and e.lang != lang:
+                continue
+            if resource is not None and e.resource != resource:
+                continue
+            if book is not None and e.book != book:
+                continue
+            if chapter is not None and e.chapter != chapter:
+                continue
+            result.append(e)
+
+        result.sort(key=lambda e: str(e.path))
+        return result
+
+    def chapters(self, kinds: Iterable[Kind] = tuple(Kind)) -> List[Tuple[str, str, str, str]]:
+        """ Get (lang, resource, book, chapter) of all the chapters that have files of the given kinds """
+
+        kinds = set(kinds)
+        with self.__lock:
+            chapters = {e.key for e in self.__entries.values() if e.kind in kinds and e.chapter is not None}
+        return sorted(chapters)
+
+    def chapter_wavs(self) -> List[CatalogEntry]:
+        return self.entries(Kind.CHAPTER_WAV)
+
+    def verse_wavs(self) -> List[CatalogEntry]:
+        return self.entries(Kind.VERSE_WAV)
+
+    def tr_files(self) -> List[CatalogEntry]:
+        return self.entries(Kind.TR)
+
+    def __add_entry(self, path: Path, stat: os.stat_result):
+        entry = self.__classify(path, stat)
+        if entry is None:
+            return
+
+        with self.__lock:
+            self.discard(path)
+            self.__entries[path] = entry
+            self.__by_kind[entry.kind][path] = entry
+            self.__by_book.setdefault(entry.key[:3], {})[path] = entry
+
+    def __classify(self, path: Path, stat: os.stat_result) -> Optional[CatalogEntry]:
+        """ Build an entry from the file path or return None if the file is not relevant """
+
+        parts = path.parts[self.__root_len:]
+
+        # Chapter content: lang/resource/book/chapter/CONTENTS/...
+        # Book content: lang/resource/book/CONTENTS/...
+        if len(parts) > 5 and parts[4] == 'CONTENTS':
+            chapter = parts[3]
+            content = parts[5:-1]
+        elif len(parts) > 4 and parts[3] == 'CONTENTS':
+            chapter = None
+            content = parts[4:-1]
+        else:
+            return None
+
+        extension = path.suffix
+        kind = None
+
+        if extension == '.tr' and len(content) > 0 and content[0] == 'tr':
+            kind = Kind.TR
+            content = content[1:]
+        elif chapter is None:
+            return None
+        elif extension == '.wav':
+            if re.search(self.chapter_regex, path.name):
+                kind = Kind.CHAPTER_WAV
+            elif re.search(self.verse_regex, path.name):
+                kind = Kind.VERSE_WAV
+        elif extension == '.mp3':
+            kind = Kind.MP3
+        elif extension == '.cue':
+            kind = Kind.CUE
+
+        if kind is None or len(content) < 2:
+            return None
+
+        media = content[0]
+        if media == 'mp3':
+            if len(content) < 3:
+                return None
+            quality = content[1]
+            grouping = content[2]
+        else:
+            quality = ''
+            grouping = content[1]
+
+        return CatalogEntry(
+            path=path,
+            kind=kind,
+            lang=parts[0],
+            resource=parts[1],
+            book=parts[2],
+            chapter=chapter,
+            media=media,
+            quality=quality,
+            grouping=grouping,
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns
+        )
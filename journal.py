@@ -0,0 +1,96 @@
+import logging
+from pathlib import Path
+from time import time
+from typing import Dict, List, Set, Tuple
+
+from file_utils import remove_temp_files, find_temp_files
+from metrics import get_metrics
+from scheduler import Job
+from state_store import StateStore
+
+# Temporary files not written for this long belong to a killed process,
+# unless the interrupted job runs again (then its files are removed right away)
+TEMP_FILE_AGE = 10 * 60
+
+# Jobs of runs that have never been resumed are forgotten after a week
+JOURNAL_MAX_AGE = 7 * 24 * 60 * 60
+
+
+class JobJournal:
+    """ Write-ahead log of the jobs in the state database. A job is journaled as started before
+    it changes anything and as done with its report when it completes, the journal of a run is
+    cleared when the run finishes. After a crash the next run takes the reports of the done jobs
+    instead of running them again (if their source files are unchanged) and removes the partial
+    files the interrupted jobs have left (an interrupted job stays journaled until they are gone).
+    Done jobs that are not planned again (e.g. chapters recorded in the state) are reported
+    with the run that resumes them """
+
+    def __init__(self, state: StateStore, ftp_dir: Path):
+        self.__state = state
+        self.__ftp_dir = ftp_dir
+        self.__resumed: Set[str] = set()
+
+    def resume(self, jobs: List[Job]) -> Tuple[List[Job], Dict[str, list]]:
+        """ Get the jobs that still have to run, restore the reports of the jobs done before a crash.
+        Returns the pending jobs and the report of the done jobs that are not among them """
+
+        self.__state.clear_journal(before=time() - JOURNAL_MAX_AGE)
+        records = self.__state.get_journal()
+        self.__resumed = set(records)
+
+        pending = []
+        for job in jobs:
+            record = records.get(job.name)
+            if (record is not None and record.status == 'done' and
+                    job.fingerprint is not None and record.fingerprint == job.fingerprint):
+                logging.debug(f'{job} was done before the last run stopped. Skipping...')
+                job.resources_created += record.resources_created
+                job.resources_deleted += record.resources_deleted
+                get_metrics().inc('jobs_resumed', 1, stage=job.stage)
+                continue
+
+            pending.append(job)
+
+        planned = {job.name for job in jobs}
+
+        cleaned = []
+        for record in records.values():
+            if record.status != 'started':
+                continue
+
+            logging.warning(f'Job {record.name} has been interrupted, removing its partial files')
+            if record.scope is not None:
+                # Nothing else writes into the scope of a job this run is going to run
+                directory = self.__ftp_dir.joinpath(*record.scope)
+                remove_temp_files(directory, 0 if record.name in planned else TEMP_FILE_AGE)
+                if len(find_temp_files(directory)) > 0:
+                    logging.debug(f'Partial files of {record.name} are recent, keeping its journal')
+                    self.__resumed.discard(record.name)
+                    continue
+
+            cleaned.append(record.name)
+        self.__state.clear_journal(cleaned)
+
+        report = {'resources_created': [], 'resources_deleted': [], 'errors': []}
+        for record in records.values():
+            if record.status == 'done' and record.name not in planned:
+                report['resources_created'] += record.resources_created
+                report['resources_deleted'] += record.resources_deleted
+
+        return pending, report
+
+    def job_started(self, job: Job):
+        self.__state.journal_job(job.name, job.fingerprint, 'started', job.scope)
+
+    def job_finished(self, job: Job):
+        status = 'failed' if job.error is not None else 'done'
+        self.__state.journal_job(job.name, job.fingerprint, status, job.scope,
+                                 job.resources_created, job.resources_deleted)
+
+    def close(self, jobs: List[Job], interrupted=False):
+        """ The run has finished, its jobs and the jobs it has resumed don't need to be resumed.
+        The journal of an interrupted run is kept, the next run resumes it """
+
+        if not interrupted:
+            self.__state.clear_journal(self.__resumed | {job.name for job in jobs})
+        self.__resumed = set()
@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+import socket
+import uuid
+from pathlib import Path
+from threading import Thread, Event, Lock
+from time import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote
+
+from metrics import get_metrics
+
+
+class Lease:
+    """ Claim of a work unit (lang, resource, book) by this node """
+
+    def __init__(self, scope: Tuple[str, ...], path: Path, token: str):
+        self.scope = scope
+        self.path = path
+        self.token = token
+        self.lost = False
+
+    def __repr__(self):
+        return f'Lease({"/".join(self.scope)})'
+
+
+class LeaseManager:
+    """ Lets several nodes share the work on the same FTP mount without a central service.
+    A work unit is claimed by creating its lease file exclusively (O_EXCL) in a hidden directory
+    of the FTP root. The holder renews its leases in the background, a lease that hasn't been
+    renewed within ttl seconds belongs to a crashed node and is taken over """
+
+    dir_name = '.leases'
+
+    def __init__(self, ftp_dir: Path, node_id: str = None, ttl=600.0, heartbeat: float = None,
+                 on_lost: Callable[[Lease], None] = None):
+        self.__lease_dir = ftp_dir.joinpath(self.dir_name)
+        self.__lease_dir.mkdir(parents=True, exist_ok=True)
+
+        self.node_id = node_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.ttl = ttl
+        self.heartbeat = heartbeat if heartbeat is not None else ttl / 3
+        self.on_lost = on_lost
+
+        self.__lock = Lock()
+        self.__leases: Dict[Tuple[str, ...], Lease] = {}
+        self.__stopped = Event()
+        self.__thread = None
+
+    def acquire(self, scope: Tuple[str, ...]) -> Optional[Lease]:
+        """ Claim the work unit. Returns None if another node holds it """
+
+        scope = tuple(scope)
+        path = self.__lease_dir.joinpath(quote('/'.join(scope), safe='') + '.lease')
+        token = uuid.uuid4().hex
+
+        if not self.__create(path, scope, token):
+            if not self.__steal_expired(path) or not self.__create(path, scope, token):
+                get_metrics().inc('leases_busy')
+                return None
+
+        get_metrics().inc('leases_acquired')
+
+        lease = Lease(scope, path, token)
+        with self.__lock:
+            self.__leases[scope] = lease
+        self.__start_heartbeat()
+
+        logging.debug(f'{self.node_id} acquired {lease}')
+
+        return lease
+
+    def acquire_many(self, scopes: Iterable[Tuple[str, ...]], limit: int) -> List[Lease]:
+        """ Claim up to limit work units that no other node holds """
+
+        leases = []
+        for scope in scopes:
+            if len(leases) >= limit:
+                break
+            lease = self.acquire(scope)
+            if lease is not None:
+                leases.append(lease)
+
+        return leases
+
+    def release(self, lease: Lease):
+        with self.__lock:
+            self.__leases.pop(lease.scope, None)
+
+        # The lease may have been taken over while this node was stalled
+        if not lease.lost and self.__owns(lease):
+            try:
+                lease.path.unlink()
+            except FileNotFoundError:
+                pass
+
+        logging.debug(f'{self.node_id} released {lease}')
+
+    def close(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+        with self.__lock:
+            leases = list(self.__leases.values())
+        for lease in leases:
+            self.release(lease)
+
+    def __create(self, path: Path, scope: Tuple[str, ...], token: str) -> bool:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+
+        try:
+            self.__write(fd, scope, token)
+        finally:
+            os.close(fd)
+
+        return True
+
+    def __write(self, fd: int, scope: Tuple[str, ...], token: str):
+        now = time()
+        data = json.dumps({
+            'node': self.node_id,
+            'token': token,
+            'scope': list(scope),
+            'renewed': now,
+            'expires': now + self.ttl
+        }).encode('utf-8')
+
+        # Written over the previous content and cut afterwards, so the file is never empty
+        os.pwrite(fd, data, 0)
+        os.ftruncate(fd, len(data))
+        os.fsync(fd)
+
+    def __steal_expired(self, path: Path) -> bool:
+        """ Remove the lease of a crashed node. Only one of the nodes trying it at once succeeds:
+        the renamed file is checked to be the expired lease that has been read, a live lease
+        another node has created in the meantime is put back """
+
+        try:
+            with path.open('rb') as f:
+                content = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except FileNotFoundError:
+            # Released in the meantime
+            return True
+
+        try:
+            data = json.loads(content.decode('utf-8'))
+            expires = float(data['expires'])
+            owner = data.get('node')
+        except (ValueError, KeyError, TypeError):
+            # Being written right now or damaged, the modification time tells if it's alive
+            expires = mtime + self.ttl
+            owner = None
+
+        if expires > time():
+            return False
+
+        # Renaming is atomic, the other nodes trying it fail
+        tombstone = path.with_name(f'.{path.name}.{uuid.uuid4().hex}')
+        try:
+            os.rename(path, tombstone)
+        except FileNotFoundError:
+            return True
+
+        try:
+            renamed = tombstone.read_bytes()
+        except FileNotFoundError:
+            renamed = None
+
+        if renamed != content:
+            # Another node has taken it over (or it has been renewed) since it was read
+            logging.debug(f'Lease {path.name} has changed since it was read, putting it back')
+            try:
+                # Never over a lease created after the rename
+                os.link(tombstone, path)
+            except FileExistsError:
+                pass
+            tombstone.unlink(missing_ok=True)
+            return False
+
+        tombstone.unlink()
+        get_metrics().inc('leases_taken_over')
+        logging.warning(f'Took over expired lease {path.name} of {owner}')
+
+        return True
+
+    def __owns(self, lease: Lease) -> bool:
+        try:
+            with lease.path.open('rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+            return data.get('token') == lease.token
+        except (OSError, ValueError):
+            return False
+
+    def __renew(self, lease: Lease) -> bool:
+        """ Extend the lease if this node still holds it """
+
+        try:
+            fd = os.open(lease.path, os.O_RDWR)
+        except FileNotFoundError:
+            return False
+
+        try:
+            # The file checked and the file written are the same, even if it is taken over meanwhile
+            content = os.pread(fd, 64 * 1024, 0)
+            try:
+                if json.loads(content.decode('utf-8')).get('token') != lease.token:
+                    return False
+            except ValueError:
+                return False
+
+            self.__write(fd, lease.scope, lease.token)
+        finally:
+            os.close(fd)
+
+        return True
+
+    def __start_heartbeat(self):
+        with self.__lock:
+            if self.__thread is not None:
+                return
+            self.__thread = Thread(target=self.__run_heartbeat, name='lease-heartbeat', daemon=True)
+            self.__thread.start()
+
+    def __run_heartbeat(self):
+        while not self.__stopped.wait(self.heartbeat):
+            with self.__lock:
+                leases = list(self.__leases.values())
+
+            for lease in leases:
+                try:
+                    renewed = self.__renew(lease)
+                except OSError as e:
+                    logging.warning(f'Could not renew {lease}: {e}')
+                    continue
+
+                if not renewed:
+                    logging.error(f'{lease} has been taken over by another node')
+                    get_metrics().inc('leases_lost')
+                    lease.lost = True
+                    with self.__lock:
+                        self.__leases.pop(lease.scope, None)
+                    if self.on_lost is not None:
+                        self.on_lost(lease)
@@ -0,0 +1,151 @@
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import mkstemp
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """ Measurements of a run (counters, times, maximums), labeled by stage, operation, tool etc.
+    Exported in Prometheus textfile format and as JSON. Every *_hits/*_misses pair gets a *_hit_ratio """
+
+    prefix = 'fetcher'
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__values: Dict[str, Dict[Labels, float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _labels(labels)
+        with self.__lock:
+            values = self.__values.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.__lock:
+            self.__values.setdefault(name, {})[_labels(labels)] = value
+
+    def set_max(self, name: str, value: float, **labels):
+        key = _labels(labels)
+        with self.__lock:
+            values = self.__values.setdefault(name, {})
+            values[key] = max(values.get(key, value), value)
+
+    def add_time(self, name: str, seconds: float, **labels):
+        """ Add a call that took the given time: name_seconds and name_calls """
+
+        self.inc(f'{name}_seconds', seconds, **labels)
+        self.inc(f'{name}_calls', 1, **labels)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """ Measure the block as a call, count it in name_failures if it raises """
+
+        start = monotonic()
+        try:
+            yield
+        except BaseException:
+            self.inc(f'{name}_failures', 1, **labels)
+            raise
+        finally:
+            self.add_time(name, monotonic() - start, **labels)
+
+    def hit(self, name: str, hit: bool, **labels):
+        """ Count a cache hit or a skipped item (name_hits) or a miss (name_misses) """
+
+        self.inc(f'{name}_hits' if hit else f'{name}_misses', 1, **labels)
+
+    def reset(self):
+        with self.__lock:
+            self.__values = {}
+
+    def values(self) -> Dict[str, Dict[Labels, float]]:
+        """ Copy of the values with the hit ratios """
+
+        with self.__lock:
+            values = {name: dict(v) for name, v in self.__values.items()}
+
+        bases = {n[:-len('_hits')] for n in values if n.endswith('_hits')} | \
+                {n[:-len('_misses')] for n in values if n.endswith('_misses')}
+
+        for base in bases:
+            hits = values.get(f'{base}_hits', {})
+            misses = values.get(f'{base}_misses', {})
+            ratios = {}
+            for key in set(hits) | set(misses):
+                total = hits.get(key, 0) + misses.get(key, 0)
+                ratios[key] = hits.get(key, 0) / total if total > 0 else 0.0
+            values[f'{base}_hit_ratio'] = ratios
+
+        return values
+
+    def to_json(self) -> dict:
+        return {
+            'timestamp': time(),
+            'metrics': {
+                f'{self.prefix}_{name}': [
+                    {'labels': dict(key), 'value': value} for key, value in sorted(values.items())
+                ]
+                for name, values in sorted(self.values().items())
+            }
+        }
+
+    def to_prometheus(self) -> str:
+        """ Values of the last run are gauges """
+
+        lines = []
+        for name, values in sorted(self.values().items()):
+            metric = f'{self.prefix}_{name}'
+            lines.append(f'# TYPE {metric} gauge')
+            for key, value in sorted(values.items()):
+                labels = ','.join(f'{k}="{_escape(v)}"' for k, v in key)
+                lines.append(f'{metric}{{{labels}}} {_format(value)}' if labels else f'{metric} {_format(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, prometheus_file: Path = None, json_file: Path = None):
+        """ Replace the files at once, so the collector never reads a partial file """
+
+        if prometheus_file is not None:
+            _write_atomic(prometheus_file, self.to_prometheus())
+        if json_file is not None:
+            _write_atomic(json_file, json.dumps(self.to_json(), indent=2) + '\n')
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    return _metrics
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format(value: float) -> str:
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(file: Path, text: str):
+    file.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = mkstemp(prefix=f'.{file.name}.', dir=file.parent)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, file)
+    except BaseException:
+        os.unlink(tmp)
+        raise
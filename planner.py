@@ -0,0 +1,150 @@
+import json
+import logging
+from pathlib import Path
+from functools import partial
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+from fair_queue import FairQueue
+from file_utils import rel_path
+from riff import read_wav_info, wav_duration, wav_sample_rate, RiffError, WavInfo
+from scheduler import Job, rank_jobs, job_priority
+
+# Cost model, in estimated seconds of a single job
+TOOL_CALL_COST = 1.0                    # Starting a tool (JVM)
+ENCODE_COST = 0.05                      # Encoding a second of audio into mp3
+COPY_COST = 1 / (100 * 1024 * 1024)    # Copying a byte from or to the FTP mount
+
+# Mono 16 bit 44.1 kHz, assumed for files without a readable header
+DEFAULT_BYTE_RATE = 44100 * 2
+
+
+def estimate_cost(tool_calls=0, audio_seconds=0.0, copy_bytes=0) -> float:
+    return tool_calls * TOOL_CALL_COST + audio_seconds * ENCODE_COST + copy_bytes * COPY_COST
+
+
+def read_header(file: Path) -> Optional[WavInfo]:
+    """ WAV header of the file, None if it can't be read """
+
+    try:
+        return read_wav_info(file)
+    except (RiffError, ValueError, OSError) as e:
+        logging.debug(f'Could not read header of {file}: {e}')
+        return None
+
+
+def audio_seconds(wav: Optional[WavInfo], size: int) -> float:
+    """ Duration from the header, estimated from the file size without it """
+
+    if wav is not None:
+        try:
+            return wav_duration(wav)
+        except RiffError:
+            pass
+
+    return size / DEFAULT_BYTE_RATE
+
+
+def byte_rate(wav: Optional[WavInfo]) -> float:
+    """ Bytes of audio per second, to estimate the duration of similar files from their size """
+
+    if wav is not None:
+        try:
+            return wav_sample_rate(wav) * wav.block_align
+        except RiffError:
+            pass
+
+    return DEFAULT_BYTE_RATE
+
+
+def simulate(jobs: List[Job], workers: int, language_weights: Dict[str, float] = None,
+             language_limits: Dict[str, int] = None) -> Tuple[Dict[Job, float], float]:
+    """ Start times of the jobs and the makespan, if every job took its estimated cost.
+    Jobs are picked in the order of the scheduler """
+
+    order = {job: i for i, job in enumerate(jobs)}
+    waiting = {job: len([d for d in job.depends_on if d in order]) for job in jobs}
+    dependents: Dict[Job, List[Job]] = {job: [] for job in jobs}
+    for job in jobs:
+        for d in job.depends_on:
+            if d in order:
+                dependents[d].append(job)
+
+    ready = FairQueue(partial(job_priority, order=order), language_weights, language_limits)
+    for job in jobs:
+        if waiting[job] == 0:
+            ready.push(job)
+
+    running: List[Tuple[float, int, Job]] = []
+    starts: Dict[Job, float] = {}
+    now = 0.0
+
+    while len(ready) > 0 or running:
+        while len(running) < max(1, workers):
+            job = ready.peek()
+            if job is None:
+                break
+            ready.pop(job)
+            starts[job] = now
+            running.append((now + job.cost, order[job], job))
+
+        running.sort(key=lambda r: r[:2])
+        now, _, finished = running.pop(0)
+        ready.finish(finished)
+        for d in dependents[finished]:
+            waiting[d] -= 1
+            if waiting[d] == 0:
+                ready.push(d)
+
+    return starts, now
+
+
+def build_plan(jobs: List[Job], ftp_dir: Path, workers: int, language_weights: Dict[str, float] = None,
+               language_limits: Dict[str, int] = None) -> dict:
+    """ Jobs a run would start, in the order they would start, with their estimated costs
+    and the resources they would create or delete """
+
+    rank_jobs(jobs)
+    starts, makespan = simulate(jobs, workers, language_weights, language_limits)
+
+    planned = []
+    for job in sorted(jobs, key=lambda j: (starts[j], j.name)):
+        planned.append({
+            'name': job.name,
+            'stage': job.stage,
+            'scope': list(job.scope) if job.scope is not None else None,
+            'cost': round(job.cost, 3),
+            'critical_path': round(job.rank, 3),
+            'start': round(starts[job], 3),
+            'urgent': job.urgent,
+            'depends_on': [d.name for d in job.depends_on],
+            'resources_created': [describe_resource(job, p, ftp_dir) for p in job.planned_created],
+            'resources_deleted': [describe_resource(job, p, ftp_dir) for p in job.planned_deleted]
+        })
+
+    return {
+        'timestamp': time(),
+        'input_dir': str(ftp_dir),
+        'workers': workers,
+        'jobs': len(jobs),
+        'cost': round(sum(job.cost for job in jobs), 3),
+        'critical_path': round(max((job.rank for job in jobs), default=0.0), 3),
+        'makespan': round(makespan, 3),
+        'resources_created': sum(len(job.planned_created) for job in jobs),
+        'resources_deleted': sum(len(job.planned_deleted) for job in jobs),
+        'plan': planned
+    }
+
+
+def describe_resource(job: Job, path: Path, ftp_dir: Path) -> dict:
+    return {'path': str(rel_path(path, ftp_dir)), 'conditional': path in job.planned_conditional}
+
+
+def write_plan(plan: dict, file: Path = None):
+    """ Write the plan into the file, or print it if no file is given """
+
+    text = json.dumps(plan, indent=2) + '\n'
+    if file is None:
+        print(text, end='')
+    else:
+        file.write_text(text)
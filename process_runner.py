@@ -0,0 +1,250 @@
+import asyncio
+import codecs
+import logging
+from collections import deque
+from concurrent.futures import Future, CancelledError
+from threading import Thread, Lock, Event
+from time import monotonic
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from metrics import get_metrics
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class ProcessError(Exception):
+    """ External tool failed. Carries the tail of its error output """
+
+    def __init__(self, message: str, returncode: int = None, stderr: str = ''):
+        super().__init__(message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class ProcessTimeout(ProcessError):
+    pass
+
+
+class ProcessCancelled(ProcessError):
+    pass
+
+
+class ProcessResult(NamedTuple):
+    returncode: int
+    stdout: str
+    stderr: str
+
+
+class ProcessRunner:
+    """ Run subprocesses on an asyncio event loop in a background thread.
+    Limits the number of concurrent processes per tool and streams their output """
+
+    def __init__(self, limits: Dict[str, int] = None, timeout: Optional[float] = None, output_limit=64 * 1024):
+        self.__limits = dict(limits or {})
+        self.__timeout = timeout
+        self.__output_limit = output_limit
+
+        self.__semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.__waiting: Dict[str, int] = {}
+        self.__lock = Lock()
+        self.__futures = set()
+        self.__started: Dict[str, int] = {}
+
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = Thread(target=self.__run_loop, name='process-runner', daemon=True)
+        self.__thread.start()
+
+    def submit(self, tool: str, command: List[str], timeout: Optional[float] = None, verbose=False,
+               call: Callable[[Optional[float], Event], Optional[ProcessResult]] = None) -> Future:
+        """ Start the process without waiting for it. The future raises ProcessError if the process fails.
+        A given call (e.g. to a resident daemon) executes the command in a worker thread instead,
+        within the same limits. It gets the timeout and an event set when the future is cancelled.
+        The process is started only if the call returns None """
+
+        # The tool timeout and the remaining time of the job, whichever is shorter
+        timeouts = [t for t in (timeout, self.__timeout) if t is not None]
+        timeout = min(timeouts) if timeouts else None
+
+        future = asyncio.run_coroutine_threadsafe(
+            self.__run(tool, [str(c) for c in command], timeout, verbose, call),
+            self.__loop
+        )
+
+        with self.__lock:
+            self.__futures.add(future)
+        future.add_done_callback(self.__forget)
+
+        return future
+
+    def run(self, tool: str, command: List[str], timeout: Optional[float] = None, verbose=False) -> ProcessResult:
+        """ Run the process and wait for it to finish """
+
+        return wait(self.submit(tool, command, timeout, verbose))
+
+    def started_processes(self) -> Dict[str, int]:
+        """ Number of processes started per tool """
+
+        with self.__lock:
+            return dict(self.__started)
+
+    def cancel_all(self):
+        """ Kill all running processes and drop the queued ones """
+
+        with self.__lock:
+            futures = list(self.__futures)
+
+        for future in futures:
+            future.cancel()
+
+    def close(self):
+        self.cancel_all()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
+
+    def __run_loop(self):
+        asyncio.set_event_loop(self.__loop)
+        self.__loop.run_forever()
+
+    def __forget(self, future: Future):
+        with self.__lock:
+            self.__futures.discard(future)
+
+    def __get_semaphore(self, tool: str) -> Optional[asyncio.Semaphore]:
+        # Called in the loop thread only
+        if tool not in self.__limits:
+            return None
+
+        if tool not in self.__semaphores:
+            self.__semaphores[tool] = asyncio.Semaphore(self.__limits[tool])
+
+        return self.__semaphores[tool]
+
+    async def __run(self, tool: str, command: List[str], timeout: Optional[float], verbose: bool,
+                    call: Optional[Callable]) -> ProcessResult:
+        semaphore = self.__get_semaphore(tool)
+
+        if semaphore is None:
+            return await self.__execute(tool, command, timeout, verbose, call)
+
+        if semaphore.locked():
+            # All the processes of the tool are running, measure the queue
+            metrics = get_metrics()
+            self.__waiting[tool] = self.__waiting.get(tool, 0) + 1
+            metrics.set_max('tool_queue_depth_max', self.__waiting[tool], tool=tool)
+
+            started = monotonic()
+            try:
+                await semaphore.acquire()
+            finally:
+                self.__waiting[tool] -= 1
+            metrics.inc('tool_wait_seconds', monotonic() - started, tool=tool)
+        else:
+            await semaphore.acquire()
+
+        try:
+            return await self.__execute(tool, command, timeout, verbose, call)
+        finally:
+            semaphore.release()
+
+    async def __execute(self, tool: str, command: List[str], timeout: Optional[float], verbose: bool,
+                        call: Optional[Callable]) -> ProcessResult:
+        if call is not None:
+            cancelled = Event()
+            try:
+                result = await self.__loop.run_in_executor(None, call, timeout, cancelled)
+            except asyncio.CancelledError:
+                # The thread can't be interrupted, the call has to stop by itself
+                cancelled.set()
+                raise
+
+            if result is not None:
+                if verbose:
+                    for line in result.stdout.splitlines():
+                        logging.debug(f'{tool}: {line}')
+                return self.__check(tool, result)
+
+        logging.debug(f'Running {tool}: {" ".join(command)}')
+
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            raise ProcessError(f'Could not start {tool}: {e}')
+
+        with self.__lock:
+            self.__started[tool] = self.__started.get(tool, 0) + 1
+        get_metrics().inc('tool_processes', 1, tool=tool)
+
+        stdout = deque()
+        stderr = deque()
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    self.__read_stream(process.stdout, stdout, tool, verbose),
+                    self.__read_stream(process.stderr, stderr, tool, verbose),
+                    process.wait()
+                ),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            await self.__kill(process)
+            raise ProcessTimeout(f'{tool} timed out after {timeout:.1f} seconds', None, ''.join(stderr))
+        except asyncio.CancelledError:
+            await self.__kill(process)
+            raise
+
+        return self.__check(tool, ProcessResult(process.returncode, ''.join(stdout), ''.join(stderr)))
+
+    @staticmethod
+    def __check(tool: str, result: ProcessResult) -> ProcessResult:
+        if result.returncode != 0:
+            raise ProcessError(f'{tool} exited with code {result.returncode}', result.returncode, result.stderr)
+
+        return result
+
+    async def __read_stream(self, stream: asyncio.StreamReader, tail: deque, tool: str, verbose: bool):
+        """ Log the output as it arrives and keep its tail for the error report """
+
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        size = 0
+
+        while True:
+            chunk = await stream.read(STREAM_CHUNK_SIZE)
+            text = decoder.decode(chunk, final=not chunk)
+
+            if text:
+                if verbose:
+                    for line in text.splitlines():
+                        logging.debug(f'{tool}: {line}')
+
+                tail.append(text)
+                size += len(text)
+                while size > self.__output_limit and len(tail) > 1:
+                    size -= len(tail.popleft())
+
+            if not chunk:
+                break
+
+    @staticmethod
+    async def __kill(process):
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+
+
+def wait(future: Future) -> ProcessResult:
+    """ Wait for a submitted process """
+
+    try:
+        return future.result()
+    except CancelledError:
+        raise ProcessCancelled('Process has been cancelled')
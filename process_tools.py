@@ -1,48 +1,348 @@
+import hashlib
 import logging
-import subprocess
-import sys
+from concurrent.futures import Future
+from functools import partial
+from pathlib import Path
+from threading import Event
+from time import monotonic
+from typing import Dict, List, NamedTuple, Optional
+
+from conversion_cache import ConversionCache
+from file_utils import stage_file, file_digest
+from riff import check_metadata
+from metrics import get_metrics
+from process_runner import ProcessRunner, ProcessResult, ProcessError, ProcessTimeout, ProcessCancelled, wait
+from scheduler import current_job
+from tool_daemon import ToolDaemonPool, ToolDaemonError, ToolDaemonTimeout, ToolDaemonCancelled
+
+_tool_daemon: Optional[ToolDaemonPool] = None
+_process_runner: Optional[ProcessRunner] = None
+_tool_command = ['java', '-jar']
+_conversion_cache: Optional[ConversionCache] = None
+_ffmpeg_command: Optional[List[str]] = None
+
+ENCODER_JAR = 'tools/audio-compressor-cli.jar'
+ENCODER_ARGS = ['-f', 'mp3']
+
+# Quality of the mp3 files (and cue files) the encoder creates with its default settings
+BASE_QUALITY = 'hi'
+
+
+class Rendition(NamedTuple):
+    """ Mp3 version of the audio, published into mp3/<quality>/<grouping>.
+    Without a bitrate it's encoded with the default settings of the encoder """
+    quality: str
+    bitrate: Optional[int] = None
+
+    @property
+    def base(self) -> bool:
+        """ The base rendition (hi) is converted by the encoder along with the cue file """
+
+        return self.quality == BASE_QUALITY
+
+
+_renditions: List[Rendition] = [Rendition(BASE_QUALITY)]
+
+
+def use_tool_daemon(daemon: Optional[ToolDaemonPool]):
+    """ Run tools in resident daemons instead of starting a new JVM per call """
+
+    global _tool_daemon
+    _tool_daemon = daemon
+
+
+def use_process_runner(runner: Optional[ProcessRunner]):
+    """ Run tool processes with the given runner (concurrency limits, timeouts) """
+
+    global _process_runner
+    _process_runner = runner
+
+
+def use_tool_command(command: List[str]):
+    """ Command that runs a tool in a new process. The jar path and the tool arguments are appended to it """
+
+    global _tool_command
+    _tool_command = list(command)
+
+
+def use_conversion_cache(cache: Optional[ConversionCache]):
+    """ Take converted files from the cache instead of the encoder, if they have been converted before """
+
+    global _conversion_cache
+    _conversion_cache = cache
+
+
+def use_renditions(renditions: List[Rendition]):
+    """ Encode the wav files into the given renditions (with a bitrate) besides the base rendition.
+    Needs ffmpeg, see use_ffmpeg """
+
+    global _renditions
+    _renditions = [Rendition(BASE_QUALITY)] + [r for r in renditions if not r.base]
+
+
+def get_renditions() -> List[Rendition]:
+    """ Base rendition followed by the other configured renditions """
+
+    return list(_renditions)
+
+
+def use_ffmpeg(command: Optional[List[str]]):
+    """ Encode the renditions with ffmpeg, which decodes a wav file once for all of them """
+
+    global _ffmpeg_command
+    _ffmpeg_command = list(command) if command is not None else None
+
+
+def encoder_version() -> str:
+    """ Identifies the encoder (its jar and the command running it) and its settings for the conversion cache """
+
+    h = hashlib.sha256()
+    h.update(' '.join(_tool_command + ENCODER_ARGS).encode('utf-8'))
+    try:
+        h.update(file_digest(Path(ENCODER_JAR)).encode('ascii'))
+    except OSError:
+        pass
+
+    return h.hexdigest()
+
+
+def get_process_runner() -> ProcessRunner:
+    global _process_runner
+    if _process_runner is None:
+        _process_runner = ProcessRunner()
+    return _process_runner
 
 
 def fix_metadata(input_file, verbose=False):
-    run_process(
-        f'java -jar tools/bttConverter.jar -f {input_file} -m chunk',
-        verbose
+    run_tool(
+        'tools/bttConverter.jar',
+        ['-f', input_file, '-m', 'chunk'],
+        verbose,
+        'fix_metadata'
     )
 
 
+def stage_wav_file(src_file: Path, target_file: Path, verbose=False) -> Optional[str]:
+    """ Put the wav file into the scratch directory, fixing its metadata only if it isn't valid.
+    A valid file is staged read-only (it may be a link). Returns the problem that has been fixed """
+
+    try:
+        problem = check_metadata(src_file)
+    except OSError as e:
+        problem = str(e)
+    get_metrics().hit('valid_metadata', problem is None)
+
+    stage_file(src_file, target_file, writable=problem is not None)
+
+    if problem is None:
+        logging.debug(f'Metadata of {src_file} is valid')
+        return None
+
+    # Try to fix wav metadata
+    logging.debug(f'Fixing metadata of {target_file}: {problem}')
+    fix_metadata(target_file, verbose)
+
+    return problem
+
+
 def split_chapter(input_file, output_dir, verbose=False):
-    run_process(
-        f'java -jar tools/tr-chunk-browser-cli.jar -s -f {input_file} -o {output_dir}',
-        verbose
+    run_tool(
+        'tools/tr-chunk-browser-cli.jar',
+        ['-s', '-f', input_file, '-o', output_dir],
+        verbose,
+        'split_chapter'
     )
 
 
 def convert_to_mp3(input_file_or_dir, verbose=False):
-    run_process(
-        f'java -jar tools/audio-compressor-cli.jar -f mp3 -i {input_file_or_dir}',
-        verbose
+    run_tool(
+        ENCODER_JAR,
+        ENCODER_ARGS + ['-i', input_file_or_dir],
+        verbose,
+        'convert_to_mp3'
     )
 
 
-def create_tr(input_dir, verbose=False):
-    run_process(
-        f'java -jar tools/aoh-cli.jar -c -tr {input_dir}',
-        verbose
-    )
+def start_convert_to_mp3(input_file: Path, verbose=False) -> Future:
+    """ Start converting without waiting for the result, see wait_convert_to_mp3.
+    Converted files of the cache are put next to the file right away """
 
+    if _conversion_cache is not None and _conversion_cache.fetch(input_file):
+        future = Future()
+        future.set_result(None)
+        return future
 
-def run_process(command, verbose=False):
-    process = subprocess.run(
-        command,
-        capture_output=True,
-        universal_newlines=True,
-        shell=True
+    return start_tool(
+        ENCODER_JAR,
+        ENCODER_ARGS + ['-i', input_file],
+        verbose,
+        'convert_to_mp3'
     )
 
-    if process.returncode != 0:
-        logging.error("A fatal error occurred")
-        logging.debug(process.stderr)
-        sys.exit(1)
-    else:
-        if verbose:
-            logging.debug(process.stdout)
+
+def wait_convert_to_mp3(future: Future, input_file: Path):
+    """ Wait for the conversion started by start_convert_to_mp3 and save the converted files in the cache """
+
+    wait_tool(future)
+
+    if _conversion_cache is not None:
+        _conversion_cache.store(input_file)
+
+
+def convert_to_mp3_batch(input_files: List[Path], staging_dir: Path, verbose=False) -> List[Path]:
+    """ Convert several wav files with a single tool invocation.
+    Files are staged into staging_dir, converted files are created next to the staged ones.
+    Files found in the conversion cache are not staged, only their converted files are put into staging_dir """
+
+    staging_dir.mkdir(parents=True, exist_ok=True)
+
+    staged_files = []
+    converted = []
+    for f in input_files:
+        staged = staging_dir.joinpath(f.name)
+        staged_files.append(staged)
+
+        if _conversion_cache is not None and _conversion_cache.fetch(f, staged):
+            continue
+
+        stage_file(f, staged)
+        converted.append((f, staged))
+
+    if len(converted) > 0:
+        convert_to_mp3(staging_dir, verbose)
+
+    if _conversion_cache is not None:
+        for f, staged in converted:
+            _conversion_cache.store(f, staged)
+
+    return staged_files
+
+
+def rendition_file(wav_file: Path, rendition: Rendition) -> Path:
+    """ Mp3 file of the rendition encoded from the wav file, in a directory named after its quality
+    next to the wav file """
+
+    return wav_file.parent.joinpath(rendition.quality, f'{wav_file.stem}.mp3')
+
+
+def start_encode_renditions(pending: Dict[Rendition, List[Path]], verbose=False) -> List[Future]:
+    """ Start encoding wav files into the renditions (with a bitrate) they are missing, see rendition_file.
+    Every file is decoded once by ffmpeg and encoded into all its renditions in the same process.
+    The base rendition is left to the encoder, which writes the cue files """
+
+    pending = {r: files for r, files in pending.items() if not r.base and len(files) > 0}
+    if len(pending) == 0:
+        return []
+
+    if _ffmpeg_command is None:
+        raise ProcessError(f'Encoding {", ".join(r.quality for r in pending)} renditions needs ffmpeg')
+
+    by_file: Dict[Path, List[Rendition]] = {}
+    for r, files in pending.items():
+        for f in files:
+            by_file.setdefault(f, []).append(r)
+
+    futures = []
+    for f, renditions in by_file.items():
+        command = _ffmpeg_command + ['-nostdin', '-y', '-loglevel', 'error', '-i', f]
+        for r in renditions:
+            output_file = rendition_file(f, r)
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            command += ['-map', '0:a', '-codec:a', 'libmp3lame', '-b:a', f'{r.bitrate}k', output_file]
+
+        futures.append(start_process(command, verbose, 'encode_renditions'))
+
+    return futures
+
+
+def run_tool(jar: str, args: list, verbose=False, operation: str = None):
+    """ Run jar tool and wait for it. Raises ProcessError if the tool fails """
+
+    wait_tool(start_tool(jar, args, verbose, operation))
+
+
+def start_tool(jar: str, args: list, verbose=False, operation: str = None) -> Future:
+    """ Start jar tool in a new process (or in a resident daemon), so the caller can do other work meanwhile.
+    The call is measured as the operation (name of the tool by default) """
+
+    if operation is None:
+        operation = Path(jar).stem
+
+    future = _start_tool(jar, [str(a) for a in args], verbose)
+    future.add_done_callback(partial(_record_operation, operation, monotonic()))
+
+    return future
+
+
+def start_process(command: list, verbose=False, operation: str = None) -> Future:
+    """ Start a command in a new process, limited and measured like a tool
+    (the operation is the name of the program by default) """
+
+    name = Path(command[0]).name
+    if operation is None:
+        operation = name
+
+    job = current_job()
+    if job is not None:
+        job.check_cancelled()
+    timeout = job.remaining_time() if job is not None else None
+
+    future = get_process_runner().submit(name, [str(c) for c in command], timeout, verbose)
+    if job is not None:
+        job.track(future)
+    future.add_done_callback(partial(_record_operation, operation, monotonic()))
+
+    return future
+
+
+def _start_tool(jar: str, args: List[str], verbose: bool) -> Future:
+
+    job = current_job()
+    if job is not None:
+        job.check_cancelled()
+    timeout = job.remaining_time() if job is not None else None
+
+    # The daemon call waits for the tool limits and is cancelled with the job like a process
+    call = partial(_call_tool_daemon, _tool_daemon, jar, args) if _tool_daemon is not None else None
+
+    future = get_process_runner().submit(Path(jar).stem, _tool_command + [jar] + args, timeout, verbose, call)
+    if job is not None:
+        job.track(future)
+
+    return future
+
+
+def _call_tool_daemon(daemon: ToolDaemonPool, jar: str, args: List[str], timeout: Optional[float],
+                      cancelled: Event) -> Optional[ProcessResult]:
+    """ Execute the tool call in a resident daemon. Returns None if the daemon is not available """
+
+    try:
+        return ProcessResult(*daemon.call(jar, args, timeout, cancelled))
+    except ToolDaemonTimeout as e:
+        raise ProcessTimeout(str(e))
+    except ToolDaemonCancelled as e:
+        raise ProcessCancelled(str(e))
+    except ToolDaemonError as e:
+        logging.warning(f'Tool daemon is not available: {e}. Running {jar} in a new process')
+        return None
+
+
+def _record_operation(operation: str, started: float, future: Future):
+    metrics = get_metrics()
+    metrics.add_time('operation', monotonic() - started, operation=operation)
+    if future.cancelled() or future.exception() is not None:
+        metrics.inc('operation_failures', 1, operation=operation)
+
+
+def wait_tool(future: Future):
+    """ Wait for a started tool """
+
+    try:
+        wait(future)
+    except ProcessError as e:
+        logging.debug(e.stderr)
+        raise
+
+
+def run_process(command: list, verbose=False):
+    get_process_runner().run(Path(command[0]).name, command, verbose=verbose)
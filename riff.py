@@ -0,0 +1,319 @@
+import json
+import logging
+import mmap
+import re
+import struct
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+CHUNK_HEADER = struct.Struct('<4sI')
+CUE_POINT = struct.Struct('<II4sIII')
+
+# Recorder metadata (JSON in the IART field of the INFO list) the tools expect
+METADATA_KEYS = ('language', 'version', 'slug', 'book_number', 'mode', 'chapter', 'startv', 'endv')
+
+# PCM and extensible PCM
+PCM_FORMATS = (1, 0xFFFE)
+
+
+class RiffError(Exception):
+    pass
+
+
+class Chunk(NamedTuple):
+    id: bytes
+    offset: int
+    size: int
+
+
+class CuePoint(NamedTuple):
+    id: int
+    sample_offset: int
+
+
+class WavInfo(NamedTuple):
+    """ Layout of a WAV file: where the audio is and how it is marked """
+
+    fmt: bytes
+    block_align: int
+    data_offset: int
+    data_size: int
+    cues: List[CuePoint]
+    labels: Dict[int, str]
+    info: Dict[bytes, bytes]
+
+
+def read_chunks(buffer, start: int, end: int) -> List[Chunk]:
+    """ Read chunk headers between start and end. Sizes are clamped to the buffer """
+
+    chunks = []
+    offset = start
+
+    while offset + CHUNK_HEADER.size <= end:
+        chunk_id, size = CHUNK_HEADER.unpack_from(buffer, offset)
+        data_offset = offset + CHUNK_HEADER.size
+
+        # Recorders that were stopped abruptly leave wrong sizes behind
+        size = min(size, end - data_offset)
+        chunks.append(Chunk(chunk_id, data_offset, size))
+
+        offset = data_offset + size + (size & 1)
+
+    return chunks
+
+
+def parse_wav(buffer) -> WavInfo:
+    """ Parse RIFF header, format, data, cue and LIST (adtl labels, INFO) chunks """
+
+    if len(buffer) < 12 or buffer[0:4] != b'RIFF' or buffer[8:12] != b'WAVE':
+        raise RiffError('Not a RIFF WAVE file')
+
+    fmt = None
+    data = None
+    cues = []
+    labels = {}
+    info = {}
+
+    for chunk in read_chunks(buffer, 12, len(buffer)):
+        if chunk.id == b'data':
+            # The audio itself is never read here
+            data = chunk
+            continue
+
+        body = bytes(buffer[chunk.offset:chunk.offset + chunk.size])
+
+        if chunk.id == b'fmt ':
+            fmt = body
+        elif chunk.id == b'cue ' and chunk.size >= 4:
+            (count,) = struct.unpack_from('<I', body, 0)
+            count = min(count, (chunk.size - 4) // CUE_POINT.size)
+            for i in range(count):
+                cue_id, _, _, _, _, sample_offset = CUE_POINT.unpack_from(body, 4 + i * CUE_POINT.size)
+                cues.append(CuePoint(cue_id, sample_offset))
+        elif chunk.id == b'LIST' and chunk.size >= 4:
+            list_type = body[0:4]
+            for sub in read_chunks(buffer, chunk.offset + 4, chunk.offset + chunk.size):
+                sub_body = bytes(buffer[sub.offset:sub.offset + sub.size])
+                if list_type == b'adtl' and sub.id == b'labl' and sub.size >= 4:
+                    (cue_id,) = struct.unpack_from('<I', sub_body, 0)
+                    labels[cue_id] = sub_body[4:].split(b'\0', 1)[0].decode('utf-8', 'replace').strip()
+                elif list_type == b'INFO':
+                    info[sub.id] = sub_body.split(b'\0', 1)[0]
+
+    if fmt is None or len(fmt) < 16:
+        raise RiffError('Missing format chunk')
+    if data is None:
+        raise RiffError('Missing data chunk')
+
+    (block_align,) = struct.unpack_from('<H', fmt, 12)
+    if block_align == 0:
+        raise RiffError('Invalid block align')
+
+    return WavInfo(fmt, block_align, data.offset, data.size, cues, labels, info)
+
+
+def read_wav_info(input_file: Path) -> WavInfo:
+    """ Parse the chunks of the file without reading its audio """
+
+    with open(input_file, 'rb') as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise RiffError('Empty file')
+
+        with buffer:
+            return parse_wav(buffer)
+
+
+def check_metadata(input_file: Path, mode='chunk') -> Optional[str]:
+    """ Check that the file is a complete PCM WAV file with the recorder metadata in the given mode
+    and a label on every cue point. Only the chunks before and after the audio are read.
+    Returns the problem, None if the file is valid """
+
+    with open(input_file, 'rb') as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return 'Empty file'
+
+        with buffer:
+            try:
+                wav = parse_wav(buffer)
+            except RiffError as e:
+                return str(e)
+
+            (riff_size,) = struct.unpack_from('<I', buffer, 4)
+            _, data_size = CHUNK_HEADER.unpack_from(buffer, wav.data_offset - CHUNK_HEADER.size)
+            file_size = len(buffer)
+
+    if riff_size + 8 != file_size:
+        return f'RIFF size {riff_size + 8} differs from the file size {file_size}'
+    if data_size != wav.data_size:
+        return f'Data chunk is truncated ({wav.data_size} of {data_size} bytes)'
+
+    (format_tag,) = struct.unpack_from('<H', wav.fmt, 0)
+    if format_tag not in PCM_FORMATS:
+        return f'Audio format {format_tag} is not PCM'
+
+    if b'IART' not in wav.info:
+        return 'Missing recorder metadata'
+
+    try:
+        metadata = json.loads(wav.info[b'IART'].decode('utf-8'))
+    except ValueError:
+        return 'Recorder metadata is not valid JSON'
+
+    if not isinstance(metadata, dict):
+        return 'Recorder metadata is not an object'
+
+    missing = [k for k in METADATA_KEYS if not str(metadata.get(k) or '').strip()]
+    if missing:
+        return f'Missing {", ".join(missing)} in recorder metadata'
+
+    if metadata['mode'] != mode:
+        return f'Recorder metadata is in {metadata["mode"]} mode'
+
+    if any(cue.id not in wav.labels for cue in wav.cues):
+        return 'Cue points without labels'
+
+    return None
+
+
+def wav_duration(wav: WavInfo) -> float:
+    """ Duration of the audio in seconds """
+
+    return wav.data_size // wav.block_align / wav_sample_rate(wav)
+
+
+def wav_sample_rate(wav: WavInfo) -> int:
+    (sample_rate,) = struct.unpack_from('<I', wav.fmt, 4)
+    if sample_rate == 0:
+        raise RiffError('Invalid sample rate')
+
+    return sample_rate
+
+
+def split_wav(input_file: Path, output_dir: Path, verse_width=2) -> List[Path]:
+    """ Split chapter file into verse files at its cue points, labels give the verse numbers.
+    Audio is copied as it is from the memory-mapped file. Returns an empty list,
+    if the file has no usable markers """
+
+    with open(input_file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            wav = parse_wav(buffer)
+
+            verses = get_verses(wav, verse_width)
+            if len(verses) == 0:
+                return []
+
+            frames = wav.data_size // wav.block_align
+            output_files = []
+
+            for i, (label, text, start) in enumerate(verses):
+                # Audio before the first marker belongs to the first verse
+                if i == 0:
+                    start = 0
+                end = verses[i + 1][2] if i + 1 < len(verses) else frames
+
+                data = memoryview(buffer)[
+                    wav.data_offset + start * wav.block_align:wav.data_offset + end * wav.block_align
+                ]
+
+                output_file = output_dir.joinpath(f'{input_file.stem}_v{label}.wav')
+                try:
+                    write_wav(output_file, wav.fmt, data, text, get_verse_info(wav.info, label))
+                finally:
+                    data.release()
+
+                output_files.append(output_file)
+
+    logging.debug(f'Split {input_file} into {len(output_files)} verses')
+
+    return output_files
+
+
+def get_verses(wav: WavInfo, verse_width: int) -> List[tuple]:
+    """ Get (zero-padded label, label, sample offset) of the verses in order.
+    Empty if markers are missing or are not verse numbers """
+
+    frames = wav.data_size // wav.block_align
+    verses = []
+    seen = set()
+
+    for cue in sorted(wav.cues, key=lambda c: c.sample_offset):
+        text = wav.labels.get(cue.id)
+        if text is None:
+            return []
+
+        match = re.fullmatch(r'(\d+)(?:-(\d+))?', text)
+        if not match:
+            return []
+
+        label = match.group(1).zfill(verse_width)
+        if match.group(2) is not None:
+            label += '-' + match.group(2).zfill(verse_width)
+
+        if label in seen:
+            return []
+        seen.add(label)
+
+        verses.append((label, text, min(cue.sample_offset, frames)))
+
+    return verses
+
+
+def get_verse_info(info: Dict[bytes, bytes], label: str) -> Dict[bytes, bytes]:
+    """ Copy chapter INFO chunk. Adjust verse range of the recorder metadata (JSON in IART) """
+
+    info = dict(info)
+
+    try:
+        metadata = json.loads(info[b'IART'].decode('utf-8'))
+    except (KeyError, ValueError):
+        return info
+
+    if not isinstance(metadata, dict):
+        return info
+
+    first, _, last = label.partition('-')
+    metadata['startv'] = str(int(first))
+    metadata['endv'] = str(int(last or first))
+    if isinstance(metadata.get('markers'), dict):
+        metadata['markers'] = {str(int(first)): 0}
+
+    info[b'IART'] = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+
+    return info
+
+
+def write_wav(output_file: Path, fmt: bytes, data, label: Optional[str] = None, info: Dict[bytes, bytes] = None):
+    """ Write WAV file with a cue point and a label at the start, if the label is given """
+
+    chunks = [(b'fmt ', fmt)]
+
+    if info:
+        body = b'INFO'
+        for key, value in info.items():
+            body += pack_chunk(key, value + b'\0')
+        chunks.append((b'LIST', body))
+
+    if label is not None:
+        chunks.append((b'cue ', struct.pack('<I', 1) + CUE_POINT.pack(1, 0, b'data', 0, 0, 0)))
+        labl = pack_chunk(b'labl', struct.pack('<I', 1) + label.encode('utf-8') + b'\0')
+        chunks.append((b'LIST', b'adtl' + labl))
+
+    header = b''.join(pack_chunk(chunk_id, body) for chunk_id, body in chunks)
+    data_size = len(data)
+    riff_size = 4 + len(header) + CHUNK_HEADER.size + data_size + (data_size & 1)
+
+    with open(output_file, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', riff_size) + b'WAVE')
+        f.write(header)
+        f.write(CHUNK_HEADER.pack(b'data', data_size))
+        f.write(data)
+        if data_size & 1:
+            f.write(b'\0')
+
+
+def pack_chunk(chunk_id: bytes, body: bytes) -> bytes:
+    return CHUNK_HEADER.pack(chunk_id, len(body)) + body + (b'\0' if len(body) & 1 else b'')
@@ -0,0 +1,320 @@
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from contextvars import ContextVar
+from functools import partial
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from fair_queue import FairQueue
+from metrics import get_metrics
+from scratch import ScratchManager
+
+_current_job: ContextVar[Optional['Job']] = ContextVar('current_job', default=None)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """ Unit of work with its own scratch directory and report.
+    Scope (lang, resource, book[, chapter]) is used to find the jobs it depends on.
+    Scratch size is the estimated space the job needs in its scratch directory,
+    cost is its estimated run time in seconds. Fingerprint identifies the state of its sources,
+    a journaled job is resumed only if it is the same. Urgent jobs process new uploads,
+    they go before the reconciliation of the published content """
+
+    def __init__(self, name: str, func: Callable[['Job'], None], timeout: Optional[float] = None,
+                 scope: Tuple[str, ...] = None, scratch_size=0, cost=0.0, fingerprint: Optional[str] = None,
+                 urgent=False):
+        self.name = name
+        self.func = func
+        self.timeout = timeout
+        self.scope = scope
+        self.scratch_size = scratch_size
+        self.cost = cost
+        self.fingerprint = fingerprint
+        self.urgent = urgent
+        self.rank = cost
+        self.depends_on: List[Job] = []
+        self.scratch_dir = None
+        self.deadline = None
+        self.cancelled = False
+        self.skipped = False
+        self.error = None
+
+        self.resources_created = []
+        self.resources_deleted = []
+        # Source files whose metadata had to be fixed, with the problem
+        self.metadata_fixed = []
+
+        # Resources the job is expected to create or delete, filled when a plan is described.
+        # Conditional ones are changed only if the published verses differ from the new ones
+        self.planned_created: List[Path] = []
+        self.planned_deleted: List[Path] = []
+        self.planned_conditional: Set[Path] = set()
+
+        self.__lock = Lock()
+        self.__futures = set()
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None or self.skipped
+
+    @property
+    def stage(self) -> str:
+        """ Kind of the job, the first word of its name (chapter, verses, tr) """
+
+        return self.name.split(' ', 1)[0]
+
+    def remaining_time(self) -> Optional[float]:
+        """ Seconds left until the job times out, None if it has no timeout """
+
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - monotonic())
+
+    def track(self, future: Future):
+        """ Cancel the future (tool process) if the job is cancelled """
+
+        with self.__lock:
+            if self.cancelled:
+                future.cancel()
+                return
+            self.__futures.add(future)
+        future.add_done_callback(self.__untrack)
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(f'{self} has been cancelled')
+
+    def cancel(self):
+        with self.__lock:
+            self.cancelled = True
+            futures = list(self.__futures)
+
+        for future in futures:
+            future.cancel()
+
+    def __untrack(self, future: Future):
+        with self.__lock:
+            self.__futures.discard(future)
+
+    def __repr__(self):
+        return f'Job({self.name})'
+
+
+def current_job() -> Optional[Job]:
+    """ Job running in the current thread """
+
+    return _current_job.get()
+
+
+class JobScheduler:
+    """ Run jobs on a pool of threads. Jobs spend most of their time waiting
+    for external tools, so threads are enough to keep all the cores busy.
+    A job starts as soon as the jobs it depends on have finished. Ready jobs are shared fairly
+    between languages and resources (see FairQueue), new uploads go first. Within a resource the job
+    with the most estimated work ahead of it (its cost and the costs of the jobs waiting for it) goes first,
+    so the longest chains don't end up running alone at the end of the run. Among jobs of equal cost
+    the later stages go first, so the results of a book are complete as early as possible.
+    A failed job is recorded in its report and doesn't stop the other jobs,
+    only the jobs that depend on it are skipped.
+    A job waits for its scratch space to be available, its directory is deleted when it completes.
+    Jobs are written into the journal (if given) when they start and when they finish """
+
+    def __init__(self, scratch: ScratchManager, jobs=1, timeout: Optional[float] = None, journal=None,
+                 language_weights: Dict[str, float] = None, language_limits: Dict[str, int] = None):
+        self.__scratch = scratch
+        self.__journal = journal
+        self.jobs = max(1, jobs)
+        self.timeout = timeout
+        self.language_weights = language_weights
+        self.language_limits = language_limits
+
+    def run(self, jobs: List[Job]) -> List[Job]:
+        """ Run all jobs and return them in the order they were given """
+
+        metrics = get_metrics()
+
+        order = {job: i for i, job in enumerate(jobs)}
+        waiting: Dict[Job, int] = {}
+        dependents: Dict[Job, List[Job]] = {job: [] for job in jobs}
+        ready = FairQueue(partial(job_priority, order=order), self.language_weights, self.language_limits)
+
+        rank_jobs(jobs)
+
+        for job in jobs:
+            metrics.inc('jobs_planned', 1, stage=job.stage)
+            deps = [d for d in job.depends_on if d in order]
+            waiting[job] = len(deps)
+            for d in deps:
+                dependents[d].append(job)
+            if not deps:
+                ready.push(job)
+
+        def complete(finished: Job):
+            ready.finish(finished)
+            for d in dependents[finished]:
+                waiting[d] -= 1
+                if waiting[d] == 0:
+                    ready.push(d)
+            metrics.set_max('ready_jobs_max', len(ready))
+
+        metrics.set_max('ready_jobs_max', len(ready))
+
+        try:
+            if self.jobs == 1:
+                while len(ready) > 0:
+                    job = ready.peek()
+                    ready.pop(job)
+                    self.__scratch.try_reserve(job, job.scratch_size, force=True)
+                    self.__start_job(job)
+                    complete(job)
+                return jobs
+
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                running: Dict[Future, Job] = {}
+
+                while len(ready) > 0 or running:
+                    while len(running) < self.jobs:
+                        # Empty, or the languages of the ready jobs are at their limits
+                        job = ready.peek()
+                        if job is None:
+                            break
+
+                        # Out of scratch space, wait for the running jobs to free it.
+                        # A job bigger than the budget runs alone
+                        if not self.__scratch.try_reserve(job, job.scratch_size, force=len(running) == 0):
+                            break
+
+                        ready.pop(job)
+                        running[executor.submit(self.__start_job, job)] = job
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        job = running.pop(future)
+                        future.result()
+                        complete(job)
+        except BaseException:
+            # Interrupted, kill the running tools
+            for job in jobs:
+                job.cancel()
+            raise
+
+        return jobs
+
+    def __start_job(self, job: Job):
+        try:
+            failed = [d for d in job.depends_on if d.failed]
+            if failed:
+                job.skipped = True
+                get_metrics().inc('jobs_skipped', 1, stage=job.stage)
+                logging.warning(f'Skipping {job}, {failed[0]} has failed')
+                return
+
+            self.__run_job(job)
+        finally:
+            self.__scratch.release(job)
+
+    def __run_job(self, job: Job):
+        if job.cancelled:
+            return
+
+        job.scratch_dir = self.__scratch.create_dir(job)
+
+        timeout = job.timeout if job.timeout is not None else self.timeout
+        if timeout is not None:
+            job.deadline = monotonic() + timeout
+
+        logging.debug(f'Running {job} in {job.scratch_dir}')
+
+        metrics = get_metrics()
+        started = monotonic()
+
+        if self.__journal is not None:
+            self.__journal.job_started(job)
+
+        token = _current_job.set(job)
+        try:
+            job.func(job)
+        except Exception as e:
+            job.error = str(e) or type(e).__name__
+            metrics.inc('job_failures', 1, stage=job.stage)
+            logging.error(f'{job} failed: {job.error}')
+            logging.debug(traceback.format_exc())
+
+            # Stop the tools the job has started in the background
+            job.cancel()
+        finally:
+            _current_job.reset(token)
+            metrics.add_time('job', monotonic() - started, stage=job.stage)
+
+        # An interrupted job stays started in the journal
+        if self.__journal is not None:
+            self.__journal.job_finished(job)
+
+        if job.error is None:
+            logging.debug(f'{job} finished')
+
+
+def job_priority(job: Job, order: Dict[Job, int]) -> tuple:
+    """ Sort key of the ready jobs of a resource: longest critical path first,
+    then jobs with dependencies (later stages), then the given order """
+
+    return -job.rank, 0 if job.depends_on else 1, order[job]
+
+
+def rank_jobs(jobs: List[Job]):
+    """ Set the rank of every job to its cost plus the longest chain of jobs waiting for it """
+
+    dependents: Dict[Job, List[Job]] = {job: [] for job in jobs}
+    for job in jobs:
+        for d in job.depends_on:
+            if d in dependents:
+                dependents[d].append(job)
+
+    ranks: Dict[Job, float] = {}
+
+    def rank(job: Job) -> float:
+        if job not in ranks:
+            ranks[job] = job.cost + max((rank(d) for d in dependents[job]), default=0.0)
+        return ranks[job]
+
+    for job in jobs:
+        job.rank = rank(job)
+
+
+def merge_reports(jobs: List[Job], resources_created: list, resources_deleted: list, errors: list = None,
+                  metadata_fixed: list = None):
+    """ Append job reports to the worker report in job order """
+
+    for job in jobs:
+        resources_created += job.resources_created
+        resources_deleted += job.resources_deleted
+
+        if metadata_fixed is not None:
+            metadata_fixed += job.metadata_fixed
+
+        if errors is not None and job.error is not None:
+            errors.append(f'{job.name}: {job.error}')
+
+
+def link_jobs(downstream: List[Job], upstream: List[Job]):
+    """ Make every downstream job depend on the upstream jobs inside its scope,
+    e.g. a book job depends on the jobs of all the chapters of the book """
+
+    by_scope: Dict[Tuple[str, ...], List[Job]] = {}
+    for job in upstream:
+        if job.scope is None:
+            continue
+        for i in range(1, len(job.scope) + 1):
+            by_scope.setdefault(job.scope[:i], []).append(job)
+
+    for job in downstream:
+        if job.scope is None:
+            continue
+        job.depends_on += [d for d in by_scope.get(job.scope, []) if d is not job]
@@ -0,0 +1,105 @@
+import logging
+import os
+import shutil
+from pathlib import Path
+from tempfile import mkdtemp
+from threading import Lock
+from typing import Dict, Optional
+
+from metrics import get_metrics
+
+
+class ScratchManager:
+    """ Scratch directories of the jobs of a run under a common root (e.g. a tmpfs).
+    Every job gets its own directory, deleted as soon as the job completes.
+    Jobs reserve their estimated scratch size, the scheduler starts a job only
+    when its reservation fits into the byte budget """
+
+    def __init__(self, root: Path = None, budget: Optional[int] = None):
+        if root is not None:
+            root.mkdir(parents=True, exist_ok=True)
+
+        self.budget = budget
+        self.__dir = Path(mkdtemp(prefix='fetcher-', dir=root))
+        self.__lock = Lock()
+        self.__reserved: Dict[object, int] = {}
+        self.__dirs: Dict[object, Path] = {}
+
+        if budget is not None:
+            free = shutil.disk_usage(self.__dir).free
+            if free < budget:
+                logging.warning(f'Scratch budget {budget} is more than the free space {free} in {self.__dir}')
+
+    @property
+    def path(self) -> Path:
+        return self.__dir
+
+    def reserved(self) -> int:
+        with self.__lock:
+            return sum(self.__reserved.values())
+
+    def try_reserve(self, job, size: int, force=False) -> bool:
+        """ Reserve scratch space for the job. Fails if it doesn't fit into the budget, unless forced
+        (a job bigger than the budget runs alone) """
+
+        with self.__lock:
+            reserved = sum(self.__reserved.values())
+            if not force and self.budget is not None and reserved + size > self.budget:
+                get_metrics().inc('scratch_waits')
+                return False
+
+            self.__reserved[job] = size
+            get_metrics().set_max('scratch_reserved_bytes_max', reserved + size)
+
+        return True
+
+    def create_dir(self, job, prefix='job-') -> Path:
+        path = Path(mkdtemp(prefix=prefix, dir=self.__dir))
+        with self.__lock:
+            self.__dirs[job] = path
+        return path
+
+    def release(self, job):
+        """ Delete the scratch directory of the job and free its reservation """
+
+        with self.__lock:
+            self.__reserved.pop(job, None)
+            path = self.__dirs.pop(job, None)
+
+        if path is None:
+            return
+
+        get_metrics().set_max('scratch_job_bytes_max', _dir_size(path))
+        _remove(path)
+
+    def close(self):
+        logging.debug(f'Deleting scratch directory {self.__dir}')
+        _remove(self.__dir)
+
+    def __enter__(self) -> 'ScratchManager':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _dir_size(path: Path) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _remove(path: Path):
+    # Killed tools may still be writing their last files
+    try:
+        shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.warning(f'Could not delete scratch directory {path}: {e}')
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,218 @@
+import json
+import logging
+import sqlite3
+from pathlib import Path
+from threading import RLock
+from time import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from file_utils import file_digest
+
+
+class JobRecord(NamedTuple):
+    """ Journal entry of a job """
+
+    name: str
+    fingerprint: Optional[str]
+    status: str
+    scope: Optional[List[str]]
+    resources_created: List[str]
+    resources_deleted: List[str]
+    updated: float
+
+
+class StateStore:
+    """ Persistent record of processed source files and the outputs they produced,
+    and the journal of the jobs of the unfinished runs """
+
+    def __init__(self, db_file: Path):
+        self.__db_file = db_file
+        self.__db_file.parent.mkdir(parents=True, exist_ok=True)
+
+        self.__lock = RLock()
+
+        # The store is shared by the jobs running in parallel
+        self.__conn = sqlite3.connect(str(db_file), check_same_thread=False)
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__conn.execute('PRAGMA foreign_keys=ON')
+        self.__conn.executescript(
+            '''
+            CREATE TABLE IF NOT EXISTS sources (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS outputs (
+                source TEXT NOT NULL REFERENCES sources(path) ON DELETE CASCADE,
+                path TEXT NOT NULL,
+                PRIMARY KEY (source, path)
+            );
+            CREATE TABLE IF NOT EXISTS journal (
+                job TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                status TEXT NOT NULL,
+                scope TEXT,
+                created TEXT NOT NULL,
+                deleted TEXT NOT NULL,
+                updated REAL NOT NULL
+            );
+            '''
+        )
+        self.__conn.commit()
+
+    def is_unchanged(self, path: Path, size: int, mtime_ns: int, exists: Callable[[Path], bool]) -> bool:
+        """ Check if the source file has already been processed and all its outputs still exist """
+
+        row = self.__get_source(path)
+        if row is None:
+            return False
+
+        r_size, r_mtime_ns, r_digest = row
+
+        if r_size != size:
+            return False
+
+        if r_mtime_ns != mtime_ns:
+            # The file has been touched, compare the content before deciding
+            digest = file_digest(path)
+            if digest != r_digest:
+                return False
+
+            logging.debug(f'File {path} was touched, but the content is the same')
+            with self.__lock, self.__conn:
+                self.__conn.execute(
+                    'UPDATE sources SET mtime_ns = ?, updated = ? WHERE path = ?',
+                    (mtime_ns, time(), str(path))
+                )
+
+        outputs = self.get_outputs(path)
+        return len(outputs) > 0 and all(exists(o) for o in outputs)
+
+    def record(self, path: Path, size: int, mtime_ns: int, outputs: Iterable[Path], digest: str = None):
+        """ Save the state of the processed source file and its outputs """
+
+        if digest is None:
+            digest = file_digest(path)
+
+        with self.__lock, self.__conn:
+            self.__conn.execute('DELETE FROM sources WHERE path = ?', (str(path),))
+            self.__conn.execute(
+                'INSERT INTO sources (path, size, mtime_ns, digest, updated) VALUES (?, ?, ?, ?, ?)',
+                (str(path), size, mtime_ns, digest, time())
+            )
+            self.__conn.executemany(
+                'INSERT OR IGNORE INTO outputs (source, path) VALUES (?, ?)',
+                [(str(path), str(o)) for o in outputs]
+            )
+
+    def forget(self, path: Path):
+        """ Remove the source file from the state """
+
+        with self.__lock, self.__conn:
+            self.__conn.execute('DELETE FROM sources WHERE path = ?', (str(path),))
+
+    def get_outputs(self, path: Path) -> List[Path]:
+        with self.__lock:
+            rows = self.__conn.execute(
+                'SELECT path FROM outputs WHERE source = ? ORDER BY path', (str(path),)
+            ).fetchall()
+        return [Path(r[0]) for r in rows]
+
+    def clear(self):
+        """ Drop the whole state, so every source is processed again """
+
+        with self.__lock, self.__conn:
+            self.__conn.execute('DELETE FROM outputs')
+            self.__conn.execute('DELETE FROM sources')
+            self.__conn.execute('DELETE FROM journal')
+
+    def journal_job(self, name: str, fingerprint: Optional[str], status: str, scope: Iterable[str] = None,
+                    resources_created: List[str] = (), resources_deleted: List[str] = ()):
+        """ Write the status of the job into the journal, committed before the job goes on """
+
+        with self.__lock, self.__conn:
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO journal (job, fingerprint, status, scope, created, deleted, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    name, fingerprint, status,
+                    json.dumps(list(scope)) if scope is not None else None,
+                    json.dumps(list(resources_created)),
+                    json.dumps(list(resources_deleted)),
+                    time()
+                )
+            )
+
+    def get_journal(self) -> Dict[str, JobRecord]:
+        with self.__lock:
+            rows = self.__conn.execute(
+                'SELECT job, fingerprint, status, scope, created, deleted, updated FROM journal'
+            ).fetchall()
+
+        return {
+            r[0]: JobRecord(r[0], r[1], r[2], json.loads(r[3]) if r[3] is not None else None,
+                            json.loads(r[4]), json.loads(r[5]), r[6])
+            for r in rows
+        }
+
+    def clear_journal(self, names: Iterable[str] = None, before: float = None):
+        """ Remove the jobs (all of them by default, or only those updated before the given time) """
+
+        with self.__lock, self.__conn:
+            if names is not None:
+                self.__conn.executemany('DELETE FROM journal WHERE job = ?', [(n,) for n in names])
+            elif before is not None:
+                self.__conn.execute('DELETE FROM journal WHERE updated < ?', (before,))
+            else:
+                self.__conn.execute('DELETE FROM journal')
+
+    def verify(self) -> Tuple[int, int]:
+        """ Check every record against the file system and drop the invalid ones.
+        Returns the number of valid and invalid records """
+
+        valid = 0
+        invalid = 0
+
+        with self.__lock:
+            rows = self.__conn.execute('SELECT path, size, mtime_ns, digest FROM sources ORDER BY path').fetchall()
+        for path, size, mtime_ns, digest in rows:
+            source = Path(path)
+            reason = self.__verify_source(source, size, digest)
+
+            if reason is None:
+                valid += 1
+                continue
+
+            logging.warning(f'Invalid state of {source}: {reason}')
+            self.forget(source)
+            invalid += 1
+
+        return valid, invalid
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()
+
+    def __verify_source(self, source: Path, size: int, digest: str) -> Optional[str]:
+        if not source.exists():
+            return 'source file is missing'
+
+        if source.stat().st_size != size:
+            return 'source file size has changed'
+
+        if file_digest(source) != digest:
+            return 'source file content has changed'
+
+        for o in self.get_outputs(source):
+            if not o.exists():
+                return f'output file {o} is missing'
+
+        return None
+
+    def __get_source(self, path: Path) -> Optional[Tuple[int, int, str]]:
+        with self.__lock:
+            return self.__conn.execute(
+                'SELECT size, mtime_ns, digest FROM sources WHERE path = ?', (str(path),)
+            ).fetchone()
@@ -0,0 +1,139 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from time import sleep, time
+
+from leases import LeaseManager
+
+SCOPE = ('en', 'ulb', 'gen')
+PROCESSES = 8
+
+
+def _race(ftp_dir: str, node_id: str, ttl: float, barrier, results, done):
+    """ Claims the scope as soon as all the processes are ready, and holds it until the test is done """
+
+    manager = LeaseManager(Path(ftp_dir), node_id, ttl=ttl)
+    barrier.wait()
+    lease = manager.acquire(SCOPE)
+    results.put((node_id, lease is not None))
+    done.wait()
+    manager.close()
+
+
+def _crash(ftp_dir: str, node_id: str, ttl: float):
+    """ Claims the scope and dies without releasing it """
+
+    manager = LeaseManager(Path(ftp_dir), node_id, ttl=ttl, heartbeat=3600)
+    os._exit(0 if manager.acquire(SCOPE) is not None else 1)
+
+
+class LeaseTest(unittest.TestCase):
+    """ Leases shared by local processes on the same directory """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.ftp_dir = Path(self.directory.name)
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.close()
+        self.directory.cleanup()
+
+    def manager(self, node_id: str, **kwargs) -> LeaseManager:
+        manager = LeaseManager(self.ftp_dir, node_id, **kwargs)
+        self.managers.append(manager)
+        return manager
+
+    def lease_data(self) -> dict:
+        path, = self.ftp_dir.joinpath(LeaseManager.dir_name).glob('*.lease')
+        return json.loads(path.read_text())
+
+    def race(self, ttl: float) -> list:
+        """ Processes claiming the scope at once, returns the nodes that got it """
+
+        barrier = multiprocessing.Barrier(PROCESSES)
+        results = multiprocessing.Queue()
+        done = multiprocessing.Event()
+        processes = [multiprocessing.Process(target=_race, args=(str(self.ftp_dir), f'node-{i}', ttl, barrier,
+                                                                 results, done))
+                     for i in range(PROCESSES)]
+        for process in processes:
+            process.start()
+
+        try:
+            owners = [node_id for node_id, acquired in (results.get(timeout=30) for _ in processes) if acquired]
+            self.assertEqual(self.lease_data()['node'], owners[0] if owners else None)
+        finally:
+            done.set()
+            for process in processes:
+                process.join(30)
+
+        return owners
+
+    def test_acquire(self):
+        lease = self.manager('a').acquire(SCOPE)
+
+        self.assertIsNotNone(lease)
+        self.assertEqual(self.lease_data()['node'], 'a')
+        self.assertEqual(self.lease_data()['token'], lease.token)
+        self.assertIsNone(self.manager('b').acquire(SCOPE))
+
+    def test_release(self):
+        manager = self.manager('a')
+        manager.release(manager.acquire(SCOPE))
+
+        self.assertIsNotNone(self.manager('b').acquire(SCOPE))
+        self.assertEqual(self.lease_data()['node'], 'b')
+
+    def test_renew(self):
+        self.manager('a', ttl=0.5, heartbeat=0.1).acquire(SCOPE)
+        expires = self.lease_data()['expires']
+
+        sleep(1)
+
+        # Renewed past its first expiry, so it isn't taken over
+        self.assertGreater(self.lease_data()['expires'], expires)
+        self.assertIsNone(self.manager('b', ttl=0.5).acquire(SCOPE))
+
+    def test_lost(self):
+        lost = []
+        manager = self.manager('a', ttl=60, heartbeat=0.1, on_lost=lost.append)
+        lease = manager.acquire(SCOPE)
+
+        # Taken over while this node was stalled
+        data = dict(self.lease_data(), node='b', token='other')
+        lease.path.write_text(json.dumps(data))
+        sleep(0.5)
+
+        self.assertEqual(lost, [lease])
+        self.assertTrue(lease.lost)
+        manager.release(lease)
+        self.assertEqual(self.lease_data()['node'], 'b')
+
+    def test_race(self):
+        self.assertEqual(len(self.race(ttl=60)), 1)
+
+    def test_race_expired(self):
+        crashed = multiprocessing.Process(target=_crash, args=(str(self.ftp_dir), 'crashed', 0.5))
+        crashed.start()
+        crashed.join(30)
+        self.assertEqual(crashed.exitcode, 0)
+
+        # Not taken over while it is alive
+        self.assertIsNone(self.manager('a', ttl=0.5).acquire(SCOPE))
+        self.assertGreater(self.lease_data()['expires'], time())
+
+        sleep(1)
+
+        owners = self.race(ttl=60)
+        self.assertEqual(len(owners), 1)
+        self.assertNotEqual(owners[0], 'crashed')
+        self.assertEqual(list(self.ftp_dir.joinpath(LeaseManager.dir_name).glob('.*')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
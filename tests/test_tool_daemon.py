@@ -0,0 +1,117 @@
+import sys
+import unittest
+from pathlib import Path
+from time import monotonic, sleep
+
+import process_tools
+from process_runner import ProcessRunner, ProcessError, ProcessTimeout
+from tool_daemon import ToolDaemonPool, ToolDaemonError, ToolDaemonTimeout
+
+ROOT_DIR = Path(__file__).absolute().parent.parent
+STUB_DAEMON = [sys.executable, str(ROOT_DIR.joinpath('benchmarks', 'stub_tool_daemon.py'))]
+
+
+class ToolDaemonTest(unittest.TestCase):
+    """ Tool daemons with the stub daemon of the benchmarks """
+
+    def setUp(self):
+        self.pool = ToolDaemonPool(STUB_DAEMON)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_call(self):
+        returncode, stdout, stderr = self.pool.call('tools/bttConverter.jar', ['-f', 'a b.wav', '-m', 'chunk'])
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, 'tools/bttConverter.jar -f a b.wav -m chunk')
+        self.assertEqual(stderr, '')
+
+    def test_failure(self):
+        returncode, _, _ = self.pool.call('tools/bttConverter.jar', ['--stub-fail'])
+
+        self.assertEqual(returncode, 1)
+
+    def test_crash(self):
+        with self.assertRaises(ToolDaemonError):
+            self.pool.call('tools/bttConverter.jar', ['--stub-crash'])
+
+        # Started again by the next call
+        self.assertEqual(self.pool.call('tools/bttConverter.jar', ['-f', 'a.wav'])[0], 0)
+
+    def test_timeout(self):
+        started = monotonic()
+        with self.assertRaises(ToolDaemonTimeout):
+            self.pool.call('tools/bttConverter.jar', ['--stub-sleep', '5'], timeout=0.3)
+        self.assertLess(monotonic() - started, 2)
+
+        self.assertEqual(self.pool.call('tools/bttConverter.jar', ['-f', 'a.wav'])[0], 0)
+
+    def test_unavailable(self):
+        pool = ToolDaemonPool([str(Path(__file__).parent.joinpath('missing-daemon'))])
+
+        with self.assertRaises(ToolDaemonError):
+            pool.call('tools/bttConverter.jar', [])
+
+
+class ToolDaemonCallTest(unittest.TestCase):
+    """ Tool calls of process_tools executed in the stub daemon """
+
+    def setUp(self):
+        self.runner = ProcessRunner({'bttConverter': 1})
+        self.pool = ToolDaemonPool(STUB_DAEMON)
+        process_tools.use_process_runner(self.runner)
+        process_tools.use_tool_daemon(self.pool)
+
+    def tearDown(self):
+        process_tools.use_tool_daemon(None)
+        process_tools.use_process_runner(None)
+        process_tools.use_tool_command(['java', '-jar'])
+        self.pool.close()
+        self.runner.close()
+
+    def test_call(self):
+        process_tools.run_tool('tools/bttConverter.jar', ['-f', 'a.wav'])
+
+        self.assertEqual(self.runner.started_processes(), {})
+
+    def test_failure(self):
+        with self.assertRaises(ProcessError):
+            process_tools.run_tool('tools/bttConverter.jar', ['--stub-fail'])
+
+    def test_timeout(self):
+        process_tools.use_process_runner(ProcessRunner(timeout=0.3))
+
+        with self.assertRaises(ProcessTimeout):
+            process_tools.run_tool('tools/bttConverter.jar', ['--stub-sleep', '5'])
+
+    def test_tool_limit(self):
+        started = monotonic()
+        futures = [process_tools.start_tool('tools/bttConverter.jar', ['--stub-sleep', '0.3']) for _ in range(3)]
+        for future in futures:
+            process_tools.wait_tool(future)
+
+        # A single call of the tool at once
+        self.assertGreaterEqual(monotonic() - started, 0.9)
+
+    def test_cancel(self):
+        future = process_tools.start_tool('tools/bttConverter.jar', ['--stub-sleep', '5'])
+        sleep(0.3)
+        future.cancel()
+
+        # The daemon is killed instead of being held until the call ends
+        started = monotonic()
+        process_tools.run_tool('tools/bttConverter.jar', ['-f', 'a.wav'])
+        self.assertLess(monotonic() - started, 2)
+
+    def test_fallback(self):
+        process_tools.use_tool_daemon(ToolDaemonPool([str(Path(__file__).parent.joinpath('missing-daemon'))]))
+        process_tools.use_tool_command([sys.executable, '-c', 'pass'])
+
+        process_tools.run_tool('tools/bttConverter.jar', ['-f', 'a.wav'])
+
+        self.assertEqual(self.runner.started_processes(), {'bttConverter': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+import json
+import logging
+import os
+import queue
+import selectors
+import struct
+import subprocess
+from threading import Lock, Event
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+# Frames are a 4 bytes big-endian length followed by a UTF-8 JSON document.
+#
+# Request:  {"id": 1, "args": ["-f", "file.wav", "-m", "chunk"]}
+# Response: {"id": 1, "returncode": 0, "stdout": "...", "stderr": "..."}
+#
+# The daemon is started as `<command> <jar>` and serves calls of that tool only,
+# so it keeps the tool classes loaded and JIT-compiled between calls.
+
+HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class ToolDaemonError(Exception):
+    pass
+
+
+class ToolDaemonTimeout(ToolDaemonError):
+    pass
+
+
+class ToolDaemonCancelled(ToolDaemonError):
+    pass
+
+
+# How often a waiting call checks if it has been cancelled
+CANCEL_CHECK_INTERVAL = 0.1
+
+
+class ToolDaemon:
+    """ Long-lived tool process that executes calls sent over its stdin/stdout """
+
+    def __init__(self, command: List[str], jar: str, timeout: Optional[float] = None):
+        self.__command = command + [jar]
+        self.__jar = jar
+        self.__timeout = timeout
+        self.__process = None
+        self.__request_id = 0
+
+    def call(self, args: List[str], timeout: Optional[float] = None, cancelled: Event = None) \
+            -> Tuple[int, str, str]:
+        """ Execute tool call, restarting the daemon once if it has crashed.
+        A daemon that times out or whose call is cancelled is killed, it's started again by the next call """
+
+        if timeout is None:
+            timeout = self.__timeout
+
+        try:
+            return self.__call(args, timeout, cancelled)
+        except (ToolDaemonTimeout, ToolDaemonCancelled):
+            self.close()
+            raise
+        except ToolDaemonError as e:
+            logging.warning(f'Tool daemon {self.__jar} crashed: {e}. Restarting...')
+            self.close()
+
+        try:
+            return self.__call(args, timeout, cancelled)
+        except ToolDaemonError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.__process is None:
+            return
+
+        if self.__process.poll() is None:
+            self.__process.kill()
+        self.__process.wait()
+
+        self.__process.stdin.close()
+        self.__process.stdout.close()
+        self.__process = None
+
+    def __call(self, args: List[str], timeout: Optional[float], cancelled: Optional[Event]) -> Tuple[int, str, str]:
+        self.__ensure_started()
+
+        self.__request_id += 1
+        request = {'id': self.__request_id, 'args': [str(a) for a in args]}
+
+        try:
+            self.__write_frame(request)
+        except OSError as e:
+            raise ToolDaemonError(f'Could not send request: {e}')
+
+        deadline = monotonic() + timeout if timeout is not None else None
+        response = self.__read_frame(deadline, cancelled)
+
+        if response.get('id') != self.__request_id:
+            raise ToolDaemonError(f'Unexpected response id: {response.get("id")}')
+
+        return int(response['returncode']), response.get('stdout', ''), response.get('stderr', '')
+
+    def __ensure_started(self):
+        if self.__process is not None and self.__process.poll() is None:
+            return
+
+        self.close()
+
+        logging.debug(f'Starting tool daemon: {" ".join(self.__command)}')
+        try:
+            self.__process = subprocess.Popen(
+                self.__command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                bufsize=0
+            )
+        except OSError as e:
+            raise ToolDaemonError(f'Could not start tool daemon: {e}')
+
+    def __write_frame(self, message: dict):
+        data = json.dumps(message).encode('utf-8')
+        self.__process.stdin.write(HEADER.pack(len(data)) + data)
+        self.__process.stdin.flush()
+
+    def __read_frame(self, deadline: Optional[float], cancelled: Optional[Event]) -> dict:
+        header = self.__read_exactly(HEADER.size, deadline, cancelled)
+        (length,) = HEADER.unpack(header)
+
+        if length > MAX_FRAME_SIZE:
+            raise ToolDaemonError(f'Response frame is too large: {length}')
+
+        data = self.__read_exactly(length, deadline, cancelled)
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError as e:
+            raise ToolDaemonError(f'Malformed response: {e}')
+
+    def __read_exactly(self, size: int, deadline: Optional[float], cancelled: Optional[Event]) -> bytes:
+        fd = self.__process.stdout.fileno()
+        buffer = b''
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+
+            while len(buffer) < size:
+                if cancelled is not None and cancelled.is_set():
+                    raise ToolDaemonCancelled(f'Call of tool daemon {self.__jar} has been cancelled')
+
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise ToolDaemonTimeout(f'Tool daemon {self.__jar} timed out')
+                if cancelled is not None and (remaining is None or remaining > CANCEL_CHECK_INTERVAL):
+                    remaining = CANCEL_CHECK_INTERVAL
+
+                if not selector.select(remaining):
+                    continue
+
+                chunk = os.read(fd, size - len(buffer))
+                if not chunk:
+                    raise ToolDaemonError('Tool daemon closed the connection')
+                buffer += chunk
+
+        return buffer
+
+
+class ToolDaemonPool:
+    """ Small pool of tool daemons per tool """
+
+    def __init__(self, command: List[str], size=1, timeout: Optional[float] = None):
+        self.__command = command
+        self.__size = max(1, size)
+        self.__timeout = timeout
+
+        self.__lock = Lock()
+        self.__pools: Dict[str, queue.Queue] = {}
+        self.__daemons: List[ToolDaemon] = []
+
+    def call(self, jar: str, args: List[str], timeout: Optional[float] = None, cancelled: Event = None) \
+            -> Tuple[int, str, str]:
+        """ Execute tool call on a free daemon of the tool """
+
+        pool = self.__get_pool(jar)
+
+        daemon = pool.get()
+        try:
+            if cancelled is not None and cancelled.is_set():
+                raise ToolDaemonCancelled(f'Call of tool daemon {jar} has been cancelled')
+            return daemon.call(args, timeout, cancelled)
+        finally:
+            pool.put(daemon)
+
+    def close(self):
+        with self.__lock:
+            for daemon in self.__daemons:
+                daemon.close()
+
+    def __get_pool(self, jar: str) -> queue.Queue:
+        with self.__lock:
+            if jar not in self.__pools:
+                pool = queue.Queue()
+                for _ in range(self.__size):
+                    daemon = ToolDaemon(self.__command, jar, self.__timeout)
+                    self.__daemons.append(daemon)
+                    pool.put(daemon)
+                self.__pools[jar] = pool
+
+            return self.__pools[jar]
@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import struct
+from pathlib import Path
+from tempfile import mkstemp
+from time import monotonic
+from typing import Dict, List, NamedTuple, Union
+
+from file_utils import copy_into, record_copy
+
+# TR files are "archives of holding" as created by tools/aoh-cli.jar:
+#
+#   magic "aoh!" (4 bytes big-endian), TOC length (8 bytes big-endian), TOC (UTF-8 JSON), file data
+#
+# TOC: {"root":{"en":{"ulb":{"gen":{"01":{"en_ulb_b01_gen_c01_v01.wav":{"start":"0","length":"1234"}}}}}}}
+# Directories and files are sorted by name (Java string order), file data follows in the same order.
+# Start offsets are relative to the beginning of the data. Names are not escaped.
+
+MAGIC = 0x616f6821
+HEADER = struct.Struct('>Iq')
+
+
+class TrError(Exception):
+    pass
+
+
+class Member(NamedTuple):
+    """ Content of a file inside a container: length bytes at offset of the file """
+
+    file: Path
+    offset: int
+    length: int
+
+
+def read_tr(tr_file: Path, root='root') -> Dict[str, Member]:
+    """ Read TOC of a TR file. Returns paths inside the container (without root) and where their content is """
+
+    with tr_file.open('rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise TrError(f'File {tr_file} is too short')
+
+        magic, toc_length = HEADER.unpack(header)
+        if magic != MAGIC or toc_length < 0:
+            raise TrError(f'File {tr_file} is not a TR file')
+
+        toc_data = f.read(toc_length)
+        if len(toc_data) < toc_length:
+            raise TrError(f'TOC of {tr_file} is truncated')
+
+    try:
+        toc = json.loads(toc_data.decode('utf-8'))
+    except ValueError as e:
+        # Names are not escaped by aoh-cli, so some TOCs are not valid JSON
+        raise TrError(f'Could not parse TOC of {tr_file}: {e}')
+
+    if not isinstance(toc, dict) or not isinstance(toc.get(root), dict):
+        raise TrError(f'TOC of {tr_file} has no {root} directory')
+
+    data_offset = HEADER.size + toc_length
+    members = {}
+
+    stack = [('', toc[root])]
+    while stack:
+        prefix, node = stack.pop()
+        for name, child in node.items():
+            if not isinstance(child, dict):
+                raise TrError(f'Invalid TOC entry {prefix}{name} in {tr_file}')
+
+            if _is_file_entry(child):
+                members[prefix + name] = Member(tr_file, data_offset + int(child['start']), int(child['length']))
+            else:
+                stack.append((f'{prefix}{name}/', child))
+
+    return members
+
+
+def build_tr(members: Dict[str, Union[Path, Member]], output_file: Path, root='root'):
+    """ Stream files into a TR file. Members map paths inside the container (lang/resource/book/chapter/file)
+    to source files or to the content of files in other containers.
+    The TR file is written next to output_file and moved into its place when complete """
+
+    tree: dict = {}
+    for name, src_file in members.items():
+        *dirs, file_name = name.split('/')
+        node = tree
+        for d in dirs:
+            node = node.setdefault(d, {})
+        node[file_name] = src_file
+
+    files: List[Member] = []
+    toc = ('{' + _toc_entry(root, tree, files, [0]) + '}').encode('utf-8')
+    header = HEADER.pack(MAGIC, len(toc)) + toc
+
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_file = mkstemp(prefix='.', suffix='.tmp', dir=output_file.parent)
+
+    try:
+        try:
+            os.fchmod(fd, 0o644)
+            _write_all(fd, header, 0)
+
+            offset = len(header)
+            for member in _merge_ranges(files):
+                started = monotonic()
+                copied = copy_into(member.file, fd, offset, member.offset, member.length)
+                record_copy('pack', 'copy', copied, started)
+                if copied != member.length:
+                    raise TrError(f'File {member.file} has changed while packing')
+                offset += member.length
+
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.replace(temp_file, output_file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+    logging.debug(f'Packed {len(files)} files into {output_file}')
+
+
+def _toc_entry(name: str, node: Union[dict, Path, Member], files: List[Member], position: List[int]) -> str:
+    if isinstance(node, dict):
+        # Java sorts strings by UTF-16 code units
+        children = sorted(node, key=lambda n: n.encode('utf-16-be'))
+        return f'"{name}":{{' + ','.join(_toc_entry(c, node[c], files, position) for c in children) + '}'
+
+    if not isinstance(node, Member):
+        node = Member(node, 0, node.stat().st_size)
+
+    entry = f'"{name}":{{"start":"{position[0]}","length":"{node.length}"}}'
+
+    files.append(node)
+    position[0] += node.length
+
+    return entry
+
+
+def _merge_ranges(files: List[Member]) -> List[Member]:
+    """ Join adjacent ranges of the same file, so a chapter container is copied at once """
+
+    merged: List[Member] = []
+    for member in files:
+        if merged and merged[-1].file == member.file and merged[-1].offset + merged[-1].length == member.offset:
+            merged[-1] = merged[-1]._replace(length=merged[-1].length + member.length)
+        else:
+            merged.append(member)
+
+    return merged
+
+
+def _is_file_entry(node: dict) -> bool:
+    return (
+        set(node) == {'start', 'length'} and
+        isinstance(node['start'], str) and node['start'].isdigit() and
+        isinstance(node['length'], str) and node['length'].isdigit()
+    )
+
+
+def _write_all(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    written = 0
+    while written < len(data):
+        written += os.pwrite(fd, view[written:], offset + written)
@@ -1,171 +1,293 @@
-import json
 import logging
 import re
-from enum import Enum
+from functools import partial
 from pathlib import Path
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, NamedTuple, Optional, Set, Union
 
-from file_utils import init_temp_dir, rm_tree, copy_file, rel_path
-from process_tools import create_tr
+from file_utils import rel_path, destination_view, path_exists, record_created
+from ftp_catalog import FtpCatalog, Kind, CatalogEntry
+from metrics import get_metrics
+from planner import estimate_cost
+from process_tools import get_renditions, BASE_QUALITY
+from scheduler import Job, JobScheduler, merge_reports, link_jobs
+from scratch import ScratchManager
+from tr_container import build_tr, read_tr, Member, TrError
 
 
-class Group(Enum):
-    BOOK = 1
-    CHAPTER = 2
+class TrKey(NamedTuple):
+    """ Identifies a TR file. Book TR files have no chapter """
+
+    lang: str
+    resource: str
+    book: str
+    chapter: Optional[str]
+    media: str
+    quality: str
+    grouping: str
+
+    def book_key(self) -> 'TrKey':
+        return self._replace(chapter=None)
+
+    def __str__(self):
+        parts = [self.lang, self.resource, self.book, self.chapter, self.media, self.quality, self.grouping]
+        return '/'.join(p for p in parts if p)
 
 
 class TrWorker:
 
-    def __init__(self, input_dir: Path, verbose=False):
+    def __init__(self, input_dir: Path, verbose=False, jobs=1):
         self.__ftp_dir = input_dir
-        self.__temp_dir = None
-
-        self.__book_tr_files = []
-        self.__chapter_tr_files = []
+        self.__catalog = None
 
         self.__verse_regex = r'_c[\d]+_v[\d]+(?:_t[\d]+)?\..*$'
-        self.__tr_regex = r'^.*?\/.*?\/.*?\/.*?(?:\/([\d]+))?\/CONTENTS\/tr\/(?:wav|mp3)(?:\/(?:hi|low))?\/verse'
 
         self.verbose = verbose
+        self.jobs = jobs
+        self.job_timeout = None
+        self.scratch_root = None
+        self.scratch_budget = None
 
         self.resources_created = []
         self.resources_deleted = []
+        self.errors = []
 
-    def execute(self):
+    def execute(self, catalog: FtpCatalog = None):
         """ Execute worker """
 
         logging.debug("TR worker started!")
 
+        with ScratchManager(self.scratch_root, self.scratch_budget) as scratch:
+            with destination_view():
+                jobs = self.plan_jobs(catalog)
+
+                scheduler = JobScheduler(scratch, self.jobs, self.job_timeout)
+                scheduler.run(jobs)
+            self.finish(jobs)
+
+        logging.debug('TR worker finished!')
+
+    def plan_jobs(self, catalog: FtpCatalog = None, describe=False, upstream: List[Job] = None) -> List[Job]:
+        """ Create a job per chapter and per book that needs TR files: its TR files are missing,
+        or the upstream (chapter and verse) jobs are going to change its verse files.
+        Verse files are grouped when the job starts, so the job can wait for the upstream jobs.
+        Cost is estimated from the verse files published so far. Described TR files include the ones
+        of the verse files the upstream jobs publish """
+
         self.clear_report()
-        self.__temp_dir = init_temp_dir()
+        self.__catalog = catalog if catalog is not None else FtpCatalog.scan(self.__ftp_dir)
 
-        existent_tr = self.find_existent_tr()
+        changed = {tuple(job.scope[:4]) for job in upstream or [] if job.scope is not None}
 
-        media = ['wav', 'mp3/hi', 'mp3/low']
-        for m in media:
-            for src_file in self.__ftp_dir.rglob(f'{m}/verse/*.*'):
-                if src_file.suffix == '.tr':
-                    continue
+        # Described upstream jobs that publish verse files (not chunks) make TR files. The ones they delete
+        # are created again, conditionally if their deletion is
+        published = set()
+        deleted: Dict[Path, bool] = {}
+        for job in upstream or []:
+            if job.scope is not None and any('verse' in (p.name, p.parent.name) for p in job.planned_created):
+                published.add(tuple(job.scope[:4]))
+            for p in job.planned_deleted:
+                deleted[p] = deleted.get(p, True) and p in job.planned_conditional
 
-                # Process verse files only
-                if not re.search(self.__verse_regex, str(src_file)):
-                    continue
+        chapters = self.__catalog.chapters((Kind.CHAPTER_WAV, Kind.VERSE_WAV, Kind.MP3))
+        books = sorted({c[:3] for c in chapters})
 
-                self.__book_tr_files.append(src_file)
-                self.__chapter_tr_files.append(src_file)
+        chapter_groups, book_groups = self.plan_tr_groups()
+        groups: Dict[Tuple[str, ...], Dict[TrKey, List[Path]]] = {}
+        for key, files in list(chapter_groups.items()) + list(book_groups.items()):
+            scope = (key.lang, key.resource, key.book, key.chapter) if key.chapter is not None else key[:3]
+            groups.setdefault(scope, {})[key] = files
 
-                # Extract necessary path parts
-                root_parts = self.__ftp_dir.parts
-                parts = src_file.parts[len(root_parts):]
+        # Create chapter TRs
+        chapter_jobs = []
+        for scope in chapters:
+            if scope in groups or scope in changed:
+                job = self.create_job(scope, groups.get(scope, {}))
+                if describe:
+                    self.describe_job(job, groups.get(scope, {}), scope in published, deleted)
+                chapter_jobs.append(job)
+
+        # Create book TRs, they are composed of the chapter TRs
+        changed_books = {s[:3] for s in changed} | {job.scope[:3] for job in chapter_jobs}
+        published_books = {s[:3] for s in published}
+        book_jobs = []
+        for scope in books:
+            if scope in groups or scope in changed_books:
+                job = self.create_job(scope, groups.get(scope, {}))
+                if describe:
+                    self.describe_job(job, groups.get(scope, {}), scope in published_books, deleted)
+                book_jobs.append(job)
+
+        link_jobs(book_jobs, chapter_jobs)
+
+        return chapter_jobs + book_jobs
+
+    def create_job(self, scope: Tuple[str, ...], groups: Dict[TrKey, List[Path]]) -> Job:
+        size = 0
+        for files in groups.values():
+            for f in files:
+                entry = self.__catalog.get(f)
+                size += entry.size if entry is not None else 0
+
+        return Job(f'tr {"/".join(scope)}', partial(self.create_tr_files, scope), scope=scope,
+                   cost=estimate_cost(copy_bytes=size))
+
+    def describe_job(self, job: Job, groups: Dict[TrKey, List[Path]], published: bool,
+                     deleted: Dict[Path, bool]):
+        """ Find the TR files the job would create: the missing ones of the published verse files and,
+        if upstream jobs publish verse files in the scope, the ones of their files (wav, mp3/hi and mp3/low).
+        TR files that exist are created again only if the upstream jobs delete them """
+
+        job.planned_created += [self.get_tr_path(key) for key in groups]
+        if not published:
+            return
+
+        scope = job.scope
+        chapter = scope[3] if len(scope) > 3 else None
+
+        qualities = {BASE_QUALITY}
+        qualities.update(r.quality for r in get_renditions() if r.quality == 'low')
+        qualities.update(e.quality for e in self.find_verse_files(scope) if e.media == 'mp3')
+
+        keys = [TrKey(*scope[:3], chapter, 'wav', '', 'verse')]
+        keys += [TrKey(*scope[:3], chapter, 'mp3', q, 'verse') for q in sorted(qualities)]
+
+        for key in keys:
+            tr_file = self.get_tr_path(key)
+            if tr_file in job.planned_created:
+                continue
+
+            if not path_exists(tr_file):
+                job.planned_created.append(tr_file)
+            elif tr_file in deleted:
+                job.planned_created.append(tr_file)
+                if deleted[tr_file]:
+                    job.planned_conditional.add(tr_file)
+
+    def finish(self, jobs: List[Job]):
+        """ Collect reports of the finished jobs """
+
+        merge_reports(jobs, self.resources_created, self.resources_deleted, self.errors)
+
+    def create_tr_files(self, scope: Tuple[str, ...], job: Job):
+        """ Create missing TR files of the chapter (lang, resource, book, chapter) or the book (lang, resource, book) """
+
+        chapter_groups, book_groups = self.plan_tr_groups(scope=scope)
+        groups = chapter_groups if len(scope) > 3 else book_groups
+
+        for key in groups:
+            self.create_tr_file(key, groups[key], job)
+
+    def plan_tr_groups(self, catalog: FtpCatalog = None, scope: Tuple[str, ...] = None) \
+            -> Tuple[Dict[TrKey, List[Path]], Dict[TrKey, List[Path]]]:
+        """ Group verse files into chapter and book TR files that don't exist yet.
+        Scope (lang, resource, book[, chapter]) limits the files to a book or a chapter """
+
+        if catalog is not None:
+            self.__catalog = catalog
+
+        existent_tr = self.find_existent_tr(scope)
+
+        chapter_groups: Dict[TrKey, List[Path]] = {}
+        book_groups: Dict[TrKey, List[Path]] = {}
+
+        for entry in self.find_verse_files(scope):
+            chapter_key = TrKey(
+                entry.lang,
+                entry.resource,
+                entry.book,
+                entry.chapter,
+                entry.media,
+                entry.quality,
+                entry.grouping
+            )
+            book_key = chapter_key.book_key()
+
+            if chapter_key not in existent_tr:
+                chapter_groups.setdefault(chapter_key, []).append(entry.path)
 
-                lang = parts[0]
-                resource = parts[1]
-                book = parts[2]
-                chapter = parts[3]
-                media = parts[5]
-                quality = parts[6] if media == 'mp3' else ''
-                grouping = parts[7] if media == 'mp3' else parts[6]
+            if book_key not in existent_tr:
+                book_groups.setdefault(book_key, []).append(entry.path)
+
+        return chapter_groups, book_groups
 
-                regex = fr'{lang}\/{resource}\/{book}(?:\/{chapter})?\/' \
-                        fr'CONTENTS\/tr\/{media}(?:\/{quality})?\/{grouping}'
+    def find_existent_tr(self, scope: Tuple[str, ...] = None) -> Set[TrKey]:
+        """ Find tr files that exist in the remote directory """
 
-                for group, tr in existent_tr:
-                    if not re.search(regex, str(tr)):
-                        continue
+        existent_tr = set()
+        for entry in self.__entries(Kind.TR, scope):
+            if entry.grouping != 'verse' or entry.media not in ('wav', 'mp3'):
+                continue
+            if entry.media == 'mp3' and entry.quality not in ('hi', 'low'):
+                continue
+
+            existent_tr.add(
+                TrKey(
+                    entry.lang,
+                    entry.resource,
+                    entry.book,
+                    entry.chapter,
+                    entry.media,
+                    entry.quality,
+                    entry.grouping
+                )
+            )
 
-                    if group == Group.BOOK and src_file in self.__book_tr_files:
-                        self.__book_tr_files.remove(src_file)
-                    elif group == Group.CHAPTER and src_file in self.__chapter_tr_files:
-                        self.__chapter_tr_files.remove(src_file)
+        return existent_tr
 
-        # Create chapter TRs
-        chapter_groups = self.group_files(self.__chapter_tr_files, Group.CHAPTER)
-        for key in chapter_groups:
-            self.create_tr_file(key, chapter_groups[key])
+    def find_verse_files(self, scope: Tuple[str, ...] = None) -> List[CatalogEntry]:
+        """ Find verse files (wav, mp3/hi, mp3/low) that can be packed into tr files """
 
-        # Create book TRs
-        book_groups = self.group_files(self.__book_tr_files, Group.BOOK)
-        for key in book_groups:
-            self.create_tr_file(key, book_groups[key])
+        verse_files = []
+        for entry in self.__entries(Kind.VERSE_WAV, scope) + self.__entries(Kind.MP3, scope):
+            if entry.grouping != 'verse':
+                continue
+            if entry.media == 'mp3' and entry.quality not in ('hi', 'low'):
+                continue
+            if entry.media not in ('wav', 'mp3'):
+                continue
 
-        logging.debug(f'Deleting temporary directory {self.__temp_dir}')
-        rm_tree(self.__temp_dir)
+            # Process verse files only
+            if not re.search(self.__verse_regex, entry.path.name):
+                continue
 
-        logging.debug('TR worker finished!')
+            verse_files.append(entry)
 
-    def find_existent_tr(self) -> List[Tuple[Group, Path]]:
-        """ Find tr files that exist in the remote directory """
+        return verse_files
 
-        existent_tr = []
-        media = ['wav', 'mp3/hi', 'mp3/low']
-        for m in media:
-            for src_file in self.__ftp_dir.rglob(f'tr/{m}/verse/*.tr'):
-                match = re.match(self.__tr_regex, str(src_file))
-                if match.group(1) is not None:
-                    existent_tr.append((Group.CHAPTER, src_file))
-                else:
-                    existent_tr.append((Group.BOOK, src_file))
+    def __entries(self, kind: Kind, scope: Tuple[str, ...] = None) -> List[CatalogEntry]:
+        """ Catalog entries of the whole tree, a book or a chapter """
 
-        return existent_tr
+        if scope is None:
+            return self.__catalog.entries(kind)
 
-    def group_files(self, files: List[Path], group: Group) -> Dict[str, List[Path]]:
-        """ Group files into Book groups and Chapter groups """
-
-        dic = {}
-        root_parts = self.__ftp_dir.parts
-        for f in files:
-            parent = f.parent
-            parts = parent.parts[len(root_parts):]
-
-            lang = parts[0]
-            resource = parts[1]
-            book = parts[2]
-            chapter = parts[3]
-            media = parts[5]
-            quality = parts[6] if media == 'mp3' else ''
-            grouping = parts[7] if media == 'mp3' else parts[6]
-
-            parts_dic = {
-                'lang': lang,
-                'resource': resource,
-                'book': book,
-                'media': media,
-                'quality': quality,
-                'grouping': grouping
-            }
-
-            if group == Group.CHAPTER:
-                parts_dic['chapter'] = chapter
-
-            key = json.dumps(parts_dic)
-
-            if key not in dic:
-                dic[key] = []
-            dic[key].append(f)
-
-        return dic
-
-    def create_tr_file(self, dic: str, files: List[Path]):
-        """ Create tr file and copy it to the remote directory"""
-
-        parts = json.loads(dic)
-
-        lang = parts['lang']
-        resource = parts['resource']
-        book = parts['book']
-        chapter = parts['chapter'] if 'chapter' in parts else None
-        media = parts['media']
-        quality = parts['quality']
-        grouping = parts['grouping']
-
-        root_dir = self.__temp_dir.joinpath('root')
-        target_dir = root_dir.joinpath(lang, resource, book)
-
-        if chapter is not None:
-            remote_dir = self.__ftp_dir.joinpath(lang, resource, book, chapter, "CONTENTS")
-        else:
-            remote_dir = self.__ftp_dir.joinpath(lang, resource, book, "CONTENTS")
+        entries = self.__catalog.entries(kind, *scope[:3])
+        if len(scope) > 3:
+            entries = [e for e in entries if e.chapter == scope[3]]
+
+        return entries
 
+    def create_tr_file(self, key: TrKey, files: List[Path], job: Job):
+        """ Pack verse files right into the tr file in the remote directory.
+        Book TR files take the content of up to date chapter TR files """
+
+        lang = key.lang
+        resource = key.resource
+        book = key.book
+        chapter = key.chapter
+
+        tr_file = self.get_tr_path(key)
+
+        metrics = get_metrics()
+
+        exists = path_exists(tr_file)
+        metrics.hit('skip', exists, stage='tr')
+
+        if exists:
+            logging.debug(f'File {tr_file} exists, skipping...')
+            return
+
+        # Files of every chapter directory
+        chapter_members: Dict[str, Dict[str, Path]] = {}
         for file in files:
             target_chapter = chapter
             if target_chapter is None:
@@ -174,36 +296,71 @@ class TrWorker:
                     raise Exception('Could not define chapter from the file name.')
                 target_chapter = match.group(1)
 
-            target_chapter_dir = target_dir.joinpath(self.zero_pad_chapter(target_chapter, book))
-            target_chapter_dir.mkdir(parents=True, exist_ok=True)
+            name = f'{lang}/{resource}/{book}/{self.zero_pad_chapter(target_chapter, book)}/{file.name}'
+            chapter_dir = rel_path(file, self.__ftp_dir).parts[3]
+            chapter_members.setdefault(chapter_dir, {})[name] = file
 
-            target_file = target_chapter_dir.joinpath(file.name)
+        members: Dict[str, Union[Path, Member]] = {}
+        for chapter_dir in chapter_members:
+            reused = None
+            if chapter is None:
+                # Copy the content of chapter TR files instead of every single verse file
+                reused = self.find_chapter_tr_content(key._replace(chapter=chapter_dir), chapter_members[chapter_dir])
+                metrics.hit('chapter_tr_reuse', reused is not None)
 
-            # Copy source file to temp dir
-            logging.debug(f'Copying file {file} to {target_file}')
-            target_file.write_bytes(file.read_bytes())
+            members.update(reused if reused is not None else chapter_members[chapter_dir])
 
         # Create TR file
-        logging.debug('Creating TR file')
-        create_tr(root_dir, self.verbose)
-        tr = self.__temp_dir.joinpath('root.tr')
+        logging.debug(f'Creating TR file {tr_file}')
+        with metrics.timer('operation', operation='create_tr'):
+            build_tr(members, tr_file)
+        record_created(tr_file)
 
-        if chapter is not None:
-            new_tr = Path(tr.parent, f'{lang}_{resource}_{book}_c{chapter}.tr')
-        else:
-            new_tr = Path(tr.parent, f'{lang}_{resource}_{book}.tr')
+        self.__catalog.add(tr_file)
+        job.resources_created.append(str(rel_path(tr_file, self.__ftp_dir)))
+
+    def find_chapter_tr_content(self, key: TrKey, files: Dict[str, Path]) -> Optional[Dict[str, Member]]:
+        """ Get the content of the chapter TR file, if it holds the same versions of the files """
+
+        tr_file = self.get_tr_path(key)
+        if not self.__catalog.exists(tr_file):
+            return None
 
-        tr.rename(new_tr)
+        try:
+            tr_mtime_ns = tr_file.stat().st_mtime_ns
+            content = read_tr(tr_file)
+        except (OSError, TrError) as e:
+            logging.debug(f'Could not read {tr_file}: {e}')
+            return None
 
-        # Copy tr file to remote dir
-        logging.debug(
-            f'Copying {new_tr} to {remote_dir}'
-        )
-        t_file = copy_file(new_tr, remote_dir, grouping, quality, media)
-        self.resources_created.append(str(rel_path(t_file, self.__ftp_dir)))
+        if set(content) != set(files):
+            return None
 
-        rm_tree(root_dir)
-        new_tr.unlink()
+        for name, file in files.items():
+            stat = file.stat()
+
+            # The file has been replaced after the chapter TR was created
+            if stat.st_size != content[name].length or stat.st_mtime_ns > tr_mtime_ns:
+                return None
+
+        logging.debug(f'Reusing content of {tr_file}')
+
+        return content
+
+    def get_tr_path(self, key: TrKey) -> Path:
+        """ Get the path of the tr file in the remote directory """
+
+        if key.chapter is not None:
+            remote_dir = self.__ftp_dir.joinpath(key.lang, key.resource, key.book, key.chapter, "CONTENTS")
+            name = f'{key.lang}_{key.resource}_{key.book}_c{key.chapter}.tr'
+        else:
+            remote_dir = self.__ftp_dir.joinpath(key.lang, key.resource, key.book, "CONTENTS")
+            name = f'{key.lang}_{key.resource}_{key.book}.tr'
+
+        if key.media == 'mp3':
+            return remote_dir.joinpath('tr', key.media, key.quality, key.grouping, name)
+        else:
+            return remote_dir.joinpath('tr', key.media, key.grouping, name)
 
     @staticmethod
     def zero_pad_chapter(chapter: str, book: str) -> str:
@@ -217,10 +374,12 @@ class TrWorker:
     def get_report(self) -> Dict[str, list]:
         report = {
             "resources_created": self.resources_created,
-            "resources_deleted": self.resources_deleted
+            "resources_deleted": self.resources_deleted,
+            "errors": self.errors
         }
         return report
 
     def clear_report(self):
         self.resources_created.clear()
         self.resources_deleted.clear()
+        self.errors.clear()
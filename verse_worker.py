@@ -1,107 +1,243 @@
+import hashlib
 import logging
-import re
+from functools import partial
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List
 
-from file_utils import init_temp_dir, rm_tree, copy_file, check_file_exists, rel_path
-from process_tools import fix_metadata, convert_to_mp3
+from file_utils import copy_file, check_file_exists, rel_path, remote_file_path, destination_view
+from ftp_catalog import FtpCatalog, CatalogEntry
+from metrics import get_metrics
+from planner import read_header, byte_rate, estimate_cost
+from process_tools import stage_wav_file, convert_to_mp3_batch, wait_tool, get_renditions, rendition_file, \
+    start_encode_renditions, Rendition
+from scheduler import Job, JobScheduler, merge_reports
+from scratch import ScratchManager
 
 
 class VerseWorker:
 
-    def __init__(self, input_dir: Path, verbose=False):
+    def __init__(self, input_dir: Path, verbose=False, jobs=1):
         self.__ftp_dir = input_dir
-        self.__temp_dir = None
-
-        self.__verse_regex = r'_c[\d]+_v[\d]+(?:-[\d]+)?(?:_t[\d]+)?\..*$'
+        self.__catalog = None
 
         self.verbose = verbose
+        self.jobs = jobs
+        self.job_timeout = None
+        self.scratch_root = None
+        self.scratch_budget = None
 
         self.resources_created = []
         self.resources_deleted = []
+        self.metadata_fixed = []
+        self.errors = []
 
-    def execute(self):
+    def execute(self, catalog: FtpCatalog = None):
         logging.debug("Verse worker started!")
 
-        self.clear_report()
-        self.__temp_dir = init_temp_dir()
+        with ScratchManager(self.scratch_root, self.scratch_budget) as scratch:
+            with destination_view():
+                jobs = self.plan_jobs(catalog)
 
-        for src_file in self.__ftp_dir.rglob('*.wav'):
-            # Process verse/chunk files only
-            if not re.search(self.__verse_regex, str(src_file)):
-                continue
+                scheduler = JobScheduler(scratch, self.jobs, self.job_timeout)
+                scheduler.run(jobs)
+            self.finish(jobs)
 
-            # Extract necessary path parts
-            root_parts = self.__ftp_dir.parts
-            parts = src_file.parts[len(root_parts):]
+        logging.debug('Verse worker finished!')
 
-            lang = parts[0]
-            resource = parts[1]
-            book = parts[2]
-            chapter = parts[3]
-            media = parts[5]
-            grouping = parts[7] if media == 'mp3' else parts[6]
+    def plan_jobs(self, catalog: FtpCatalog = None, describe=False) -> List[Job]:
+        """ Create a job per directory of verse files that haven't been converted.
+        Describe lists the resources every job is expected to create """
 
-            target_dir = self.__temp_dir.joinpath(lang, resource, book, chapter, grouping)
-            remote_dir = self.__ftp_dir.joinpath(lang, resource, book, chapter, "CONTENTS")
-            target_dir.mkdir(parents=True, exist_ok=True)
-            target_file = target_dir.joinpath(src_file.name)
+        self.clear_report()
+        self.__catalog = catalog if catalog is not None else FtpCatalog.scan(self.__ftp_dir)
 
-            logging.debug(f'Found verse file: {src_file}')
+        groups = {}
+        for entry in self.__catalog.verse_wavs():
+            logging.debug(f'Found verse file: {entry.path}')
 
-            mp3_exists = check_file_exists(src_file, remote_dir, 'mp3', grouping)
-            cue_exists = check_file_exists(src_file, remote_dir, 'cue', grouping)
+            converted = self.is_converted(entry)
+            get_metrics().hit('skip', converted, stage='verses')
 
-            if mp3_exists and cue_exists:
+            if converted:
                 logging.debug(f'Files exist. Skipping...')
                 continue
 
-            # Copy source file to temp dir
-            logging.debug(f'Copying file {src_file} to {target_file}')
-            target_file.write_bytes(src_file.read_bytes())
-
-            # Try to fix wav metadata
-            logging.debug(f'Fixing metadata: {target_file}')
-            fix_metadata(target_file, self.verbose)
-
-            # Convert verse into mp3
-            self.convert_verse(target_file, remote_dir, grouping)
-
-        logging.debug(f'Deleting temporary directory {self.__temp_dir}')
-        rm_tree(self.__temp_dir)
-
-        logging.debug('Verse worker finished!')
+            # Group pending files of the same directory to convert them at once
+            key = (entry.lang, entry.resource, entry.book, entry.chapter, entry.grouping)
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(entry)
+
+        jobs = []
+        for key in groups:
+            entries = groups[key]
+            size = sum(e.size for e in entries)
+
+            # Verses of a directory share their format, the first header gives the duration of all of them
+            renditions = len(get_renditions())
+            cost = estimate_cost(
+                tool_calls=len(entries) + renditions,
+                audio_seconds=size / byte_rate(read_header(entries[0].path)) * renditions,
+                copy_bytes=size * 2
+            )
+
+            # Staged verses, their copies for the encoder and the mp3 files
+            fingerprint = hashlib.sha1(
+                '\n'.join(f'{e.path.name}:{e.size}:{e.mtime_ns}' for e in entries).encode('utf-8')
+            ).hexdigest()
+
+            # Verses without mp3 files are new uploads
+            job = Job(f'verses {"/".join(key)}', partial(self.process_verses, entries), scope=key[:4],
+                      scratch_size=size * 3, cost=cost, fingerprint=fingerprint, urgent=True)
+            if describe:
+                self.describe_job(entries, job)
+            jobs.append(job)
+
+        return jobs
+
+    def describe_job(self, entries: List[CatalogEntry], job: Job):
+        """ Find the resources the job would create """
+
+        for entry in entries:
+            remote_dir = self.__ftp_dir.joinpath(entry.lang, entry.resource, entry.book, entry.chapter, "CONTENTS")
+            for r in self.missing_renditions(entry):
+                if r.base:
+                    job.planned_created.append(remote_file_path(entry.path, remote_dir, 'mp3', entry.grouping))
+                    job.planned_created.append(remote_file_path(entry.path, remote_dir, 'cue', entry.grouping))
+                else:
+                    job.planned_created.append(
+                        remote_file_path(entry.path, remote_dir, 'mp3', entry.grouping, r.quality)
+                    )
+
+    def finish(self, jobs: List[Job]):
+        """ Collect reports of the finished jobs """
+
+        merge_reports(jobs, self.resources_created, self.resources_deleted, self.errors, self.metadata_fixed)
+
+    def is_converted(self, entry: CatalogEntry) -> bool:
+        """ Check if mp3 files of every rendition and the cue file of the verse file exist """
+
+        return len(self.missing_renditions(entry)) == 0
+
+    def missing_renditions(self, entry: CatalogEntry) -> List[Rendition]:
+        """ Renditions of the verse file that don't exist remotely.
+        The base rendition is missing if its mp3 or the cue file doesn't exist """
+
+        remote_dir = self.__ftp_dir.joinpath(entry.lang, entry.resource, entry.book, entry.chapter, "CONTENTS")
+
+        missing = []
+        for r in get_renditions():
+            if r.base:
+                mp3_exists = check_file_exists(entry.path, remote_dir, 'mp3', entry.grouping)
+                cue_exists = check_file_exists(entry.path, remote_dir, 'cue', entry.grouping)
+                exists = mp3_exists and cue_exists
+            else:
+                exists = check_file_exists(entry.path, remote_dir, 'mp3', entry.grouping, r.quality)
+
+            if not exists:
+                missing.append(r)
+
+        return missing
+
+    def process_verses(self, entries: List[CatalogEntry], job: Job):
+        """ Fix and convert verse files of the same directory """
+
+        # The chapter job may have replaced or converted the files in the meantime
+        missing = {e.path: self.missing_renditions(e) for e in entries if self.__catalog.exists(e.path)}
+        entries = [e for e in entries if len(missing.get(e.path, [])) > 0]
+        if len(entries) == 0:
+            return
+
+        first = entries[0]
+        grouping = first.grouping
+
+        remote_dir = self.__ftp_dir.joinpath(first.lang, first.resource, first.book, first.chapter, "CONTENTS")
+        target_dir = job.scratch_dir.joinpath('source')
+        target_dir.mkdir(parents=True, exist_ok=True)
+
+        target_files = []
+        renditions: Dict[Rendition, List[Path]] = {}
+        for entry in entries:
+            src_file = entry.path
+            target_file = target_dir.joinpath(src_file.name)
 
-    def convert_verse(self, verse_file: Path, remote_dir: Path, grouping: str):
-        """ Convert verse wav file and copy to remote directory """
-
-        logging.debug(f'Converting verse: {verse_file}')
-        convert_to_mp3(verse_file, self.verbose)
-
-        # Copy converted verse file (mp3 and cue)
-        mp3_file = verse_file.with_suffix('.mp3')
-        logging.debug(
-            f'Copying verse mp3 {mp3_file} into {remote_dir}'
-        )
-        if mp3_file.exists():
-            m_file = copy_file(mp3_file, remote_dir, grouping)
-            self.resources_created.append(str(rel_path(m_file, self.__ftp_dir)))
-
-        cue_file = verse_file.with_suffix('.cue')
-        logging.debug(
-            f'Copying verse cue {cue_file} into {remote_dir}'
-        )
-        if cue_file.exists():
-            c_file = copy_file(cue_file, remote_dir, grouping)
-            self.resources_created.append(str(rel_path(c_file, self.__ftp_dir)))
+            # Copy source file to temp dir, fixing its metadata if needed
+            logging.debug(f'Staging file {src_file} to {target_file}')
+            problem = stage_wav_file(src_file, target_file, self.verbose)
+            if problem is not None:
+                job.metadata_fixed.append(f'{rel_path(src_file, self.__ftp_dir)}: {problem}')
+
+            for r in missing[src_file]:
+                if r.base:
+                    target_files.append(target_file)
+                else:
+                    renditions.setdefault(r, []).append(target_file)
+
+        # Other renditions are encoded while the base rendition is being converted
+        futures = start_encode_renditions(renditions, self.verbose)
+
+        # Convert verses into mp3
+        if len(target_files) > 0:
+            self.convert_verses(target_files, remote_dir, grouping, job)
+
+        for future in futures:
+            wait_tool(future)
+        self.publish_renditions(renditions, remote_dir, grouping, job)
+
+    def convert_verses(self, verse_files: List[Path], remote_dir: Path, grouping: str, job: Job):
+        """ Convert verse wav files with a single tool call and copy them to remote directory """
+
+        logging.debug(f'Converting {len(verse_files)} verse files')
+        staged_files = convert_to_mp3_batch(verse_files, job.scratch_dir.joinpath('encode'), self.verbose)
+
+        for verse_file in staged_files:
+            # Copy converted verse file (mp3 and cue)
+            mp3_file = verse_file.with_suffix('.mp3')
+            logging.debug(
+                f'Copying verse mp3 {mp3_file} into {remote_dir}'
+            )
+            if mp3_file.exists():
+                m_file = copy_file(mp3_file, remote_dir, grouping)
+                self.__catalog.add(m_file)
+                job.resources_created.append(str(rel_path(m_file, self.__ftp_dir)))
+
+            cue_file = verse_file.with_suffix('.cue')
+            logging.debug(
+                f'Copying verse cue {cue_file} into {remote_dir}'
+            )
+            if cue_file.exists():
+                c_file = copy_file(cue_file, remote_dir, grouping)
+                self.__catalog.add(c_file)
+                job.resources_created.append(str(rel_path(c_file, self.__ftp_dir)))
+
+    def publish_renditions(self, renditions: Dict[Rendition, List[Path]], remote_dir: Path, grouping: str,
+                           job: Job):
+        """ Copy encoded renditions of the verse files to their remote directories """
+
+        for r, files in renditions.items():
+            for f in files:
+                mp3_file = rendition_file(f, r)
+                if not mp3_file.exists():
+                    continue
+
+                logging.debug(
+                    f'Copying {r.quality} mp3 {mp3_file} into {remote_dir}'
+                )
+                m_file = copy_file(mp3_file, remote_dir, grouping, r.quality)
+                self.__catalog.add(m_file)
+                job.resources_created.append(str(rel_path(m_file, self.__ftp_dir)))
 
     def get_report(self) -> Dict[str, list]:
         report = {
             "resources_created": self.resources_created,
-            "resources_deleted": self.resources_deleted
+            "resources_deleted": self.resources_deleted,
+            "metadata_fixed": self.metadata_fixed,
+            "errors": self.errors
         }
         return report
 
     def clear_report(self):
         self.resources_created.clear()
         self.resources_deleted.clear()
+        self.metadata_fixed.clear()
+        self.errors.clear()
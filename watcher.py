@@ -0,0 +1,271 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+from pathlib import Path
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# File systems where changes made by other hosts don't produce inotify events
+NETWORK_FILE_SYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse', 'fuse.sshfs', '9p', 'ceph', 'glusterfs')
+
+
+class InotifyWatcher:
+    """ Recursive inotify watch of a directory tree """
+
+    def __init__(self, root: Path):
+        self.__root = root
+        self.__watches: Dict[int, Path] = {}
+        self.overflowed = False
+
+        libc_name = ctypes.util.find_library('c')
+        self.__libc = ctypes.CDLL(libc_name, use_errno=True)
+
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.__add_tree(root)
+
+    def read(self, timeout: float) -> List[Path]:
+        """ Wait for events up to timeout seconds and return changed files """
+
+        ready, _, _ = select.select([self.__fd], [], [], timeout)
+        if not ready:
+            return []
+
+        changed = []
+        while True:
+            try:
+                data = os.read(self.__fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            changed += self.__parse(data)
+
+        return changed
+
+    def close(self):
+        os.close(self.__fd)
+
+    def __parse(self, data: bytes) -> List[Path]:
+        changed = []
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('Inotify event queue overflowed')
+                self.overflowed = True
+                continue
+
+            if mask & IN_IGNORED or mask & IN_DELETE_SELF or mask & IN_MOVE_SELF:
+                self.__watches.pop(wd, None)
+                continue
+
+            directory = self.__watches.get(wd)
+            if directory is None or not name:
+                continue
+
+            path = directory.joinpath(name)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may have been created before the watch was added
+                    changed += self.__add_tree(path)
+                continue
+
+            changed.append(path)
+
+        return changed
+
+    def __add_tree(self, root: Path) -> List[Path]:
+        """ Watch the directory and all its subdirectories. Returns the files found """
+
+        files = []
+        stack = [root]
+
+        while stack:
+            directory = stack.pop()
+            self.__add_watch(directory)
+
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(Path(entry.path))
+                        else:
+                            files.append(Path(entry.path))
+            except OSError:
+                continue
+
+        return files
+
+    def __add_watch(self, directory: Path):
+        wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(str(directory)), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, 'Inotify watch limit reached, increase fs.inotify.max_user_watches')
+            logging.debug(f'Could not watch {directory}: {os.strerror(error)}')
+            return
+
+        self.__watches[wd] = directory
+
+
+class PollingWatcher:
+    """ Detect changed files by comparing snapshots of the tree """
+
+    def __init__(self, root: Path, interval: float):
+        self.__root = root
+        self.__interval = interval
+        self.__snapshot = self.__take_snapshot()
+        self.__next_poll = monotonic() + interval
+        self.overflowed = False
+
+    def read(self, timeout: float) -> List[Path]:
+        """ Wait up to timeout seconds and return files changed since the previous poll """
+
+        now = monotonic()
+        if now < self.__next_poll:
+            wait = min(timeout, self.__next_poll - now)
+            select.select([], [], [], wait)
+            if monotonic() < self.__next_poll:
+                return []
+
+        snapshot = self.__take_snapshot()
+        changed = [p for p, stat in snapshot.items() if self.__snapshot.get(p) != stat]
+
+        self.__snapshot = snapshot
+        self.__next_poll = monotonic() + self.__interval
+
+        return changed
+
+    def close(self):
+        pass
+
+    def __take_snapshot(self) -> Dict[Path, Tuple[int, int]]:
+        snapshot = {}
+        stack = [str(self.__root)]
+
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            snapshot[Path(entry.path)] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+
+        return snapshot
+
+
+class Debouncer:
+    """ Hold changed files until they stop changing (uploads finished) """
+
+    def __init__(self, delay: float):
+        self.__delay = delay
+        self.__pending: Dict[Path, Tuple[float, Optional[int]]] = {}
+
+    def add(self, path: Path):
+        self.__pending[path] = (monotonic(), self.__size(path))
+
+    def pop_settled(self) -> List[Path]:
+        """ Return files that haven't changed for the debounce delay """
+
+        now = monotonic()
+        settled = []
+
+        for path, (last_change, size) in list(self.__pending.items()):
+            if now - last_change < self.__delay:
+                continue
+
+            current_size = self.__size(path)
+            if current_size != size:
+                # Still being uploaded, without generating events (polling, network fs)
+                self.__pending[path] = (now, current_size)
+                continue
+
+            del self.__pending[path]
+            if current_size is not None:
+                settled.append(path)
+
+        return settled
+
+    @staticmethod
+    def __size(path: Path) -> Optional[int]:
+        try:
+            return path.stat().st_size
+        except OSError:
+            return None
+
+
+def is_network_fs(path: Path) -> bool:
+    """ Check if the path is on a file system that doesn't support inotify for remote changes """
+
+    path = str(path.absolute())
+    fs_type = None
+    mount_point_length = -1
+
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+
+                mount_point = fields[1]
+                if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                    if len(mount_point) > mount_point_length:
+                        mount_point_length = len(mount_point)
+                        fs_type = fields[2]
+    except OSError:
+        return False
+
+    return fs_type is not None and (fs_type in NETWORK_FILE_SYSTEMS or fs_type.startswith('fuse'))
+
+
+def create_watcher(root: Path, mode='auto', poll_interval=300.0):
+    """ Create inotify watcher if possible, otherwise fall back to polling """
+
+    if mode == 'auto' and is_network_fs(root):
+        logging.warning(f'{root} is on a network file system, polling for changes')
+        mode = 'poll'
+
+    if mode in ('auto', 'inotify'):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as e:
+            if mode == 'inotify':
+                raise
+            logging.warning(f'Inotify is not available: {e}. Polling for changes')
+
+    return PollingWatcher(root, poll_interval)
@@ -3,12 +3,14 @@
 directory=
 hour=
 minute=
+jobs=
 trace=
 verbose=
+watch=
 
 usage()
 {
-    echo "usage: worker.sh [[[-i directory ] [-hr hour ] [-mn minute ] [-t] [-v]] | [-h]]"
+    echo "usage: worker.sh [[[-i directory ] [-hr hour ] [-mn minute ] [-j jobs ] [-w] [-t] [-v]] | [-h]]"
 }
 
 while [ "$1" != "" ]; do
@@ -22,6 +24,11 @@ while [ "$1" != "" ]; do
         -mn | --minute )        shift
                                 minute=$1
                                 ;;
+        -j | --jobs )           shift
+                                jobs=$1
+                                ;;
+        -w | --watch )          watch="--watch"
+                                ;;
         -t | --trace )          trace="--trace"
                                 ;;
         -v | --verbose )        verbose="--verbose"
@@ -48,5 +55,9 @@ if [[ -z "$minute" ]]; then
   minute=0
 fi
 
-python app.py -i "$directory" -hr "$hour" -mn "$minute" "$trace" "$verbose"
+if [[ -z "$jobs" ]]; then
+  jobs=1
+fi
+
+python app.py -i "$directory" -hr "$hour" -mn "$minute" -j "$jobs" "$watch" "$trace" "$verbose"
 